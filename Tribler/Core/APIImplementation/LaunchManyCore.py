@@ -104,7 +104,7 @@ class TriblerLaunchMany(TaskManager):
 
             if self.session.get_torrent_store():
                 from Tribler.Core.leveldbstore import LevelDbStore
-                self.torrent_store = LevelDbStore(self.session.get_torrent_store_dir())
+                self.torrent_store = LevelDbStore(self.session.get_torrent_store_dir(), compress=True)
 
             if self.session.get_enable_metadata():
                 from Tribler.Core.leveldbstore import LevelDbStore
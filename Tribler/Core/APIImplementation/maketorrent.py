@@ -6,8 +6,12 @@
 import sys
 import os
 import logging
-from hashlib import sha1
+from bisect import bisect_right
+from hashlib import sha1, sha256
 from copy import copy
+from itertools import imap
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from time import time
 from types import LongType
 from libtorrent import bencode
@@ -20,13 +24,24 @@ from Tribler.Core.Utilities.utilities import validTorrentFile
 
 logger = logging.getLogger(__name__)
 
+# The amount of data a hashing worker reads and hashes in one go
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+# The buffer size with which the hashing workers open files
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+# Minimum number of seconds between two calls to the progress callback
+PROGRESS_INTERVAL = 0.5
+# Size of the blocks that are the leaves of the per-file merkle trees (BEP 52)
+MERKLE_BLOCK_SIZE = 16 * 1024
 
-def make_torrent_file(input, userabortflag=None, userprogresscallback=lambda x: None):
+
+def make_torrent_file(input, userabortflag=None, userprogresscallback=lambda x: None, num_workers=None,
+                      merkle=False):
     """ Create a torrent file from the supplied input.
 
     Returns a (infohash,metainfo) pair, or (None,None) on userabort. """
 
-    (info, piece_length) = makeinfo(input, userabortflag, userprogresscallback)
+    (info, piece_length) = makeinfo(input, userabortflag, userprogresscallback, num_workers=num_workers,
+                                    merkle=merkle)
     if userabortflag is not None and userabortflag.isSet():
         return None, None
     if info is None:
@@ -81,16 +96,18 @@ def uniconvert(s, enc):
     return s.encode(enc)
 
 
-def makeinfo(input, userabortflag, userprogresscallback):
-    """ Calculate hashes and create torrent file's 'info' part """
+def makeinfo(input, userabortflag, userprogresscallback, num_workers=None, merkle=False):
+    """ Calculate hashes and create torrent file's 'info' part
+
+    @param num_workers The number of threads hashing the pieces, by default
+    the number of CPUs.
+    @param merkle Whether to add the BEP 52 merkle root of every file as
+    'pieces root'.
+    """
     encoding = input['encoding']
 
-    pieces = []
-    sh = sha1()
-    done = 0
     fs = []
     totalsize = 0
-    totalhashed = 0
 
     # 1. Determine which files should go into the torrent (=expand any dirs
     # specified by user in input['files']
@@ -135,49 +152,27 @@ def makeinfo(input, userabortflag, userprogresscallback):
         piece_length = input['piece length']
 
     # 4. Read files and calc hashes
-    for p, f, size in subs:
-        pos = 0
-
-        h = open(f, 'rb')
-
-        while pos < size:
-            a = min(size - pos, piece_length - done)
-
-            # See if the user cancelled
-            if userabortflag is not None and userabortflag.isSet():
-                return None, None
-
-            readpiece = h.read(a)
-
-            # See if the user cancelled
-            if userabortflag is not None and userabortflag.isSet():
-                return None, None
-
-            sh.update(readpiece)
-
-            done += a
-            pos += a
-            totalhashed += a
-
-            if done == piece_length:
-                pieces.append(sh.digest())
-                done = 0
-                sh = sha1()
+    hasher = PieceHasher([(f, size) for _, f, size in subs], piece_length, num_workers, userabortflag,
+                         userprogresscallback, num_passes=2 if merkle else 1)
+    pieces = hasher.hash_pieces()
+    if pieces is None:
+        return None, None
 
-            if userprogresscallback is not None:
-                userprogresscallback(float(totalhashed) / float(totalsize))
+    roots = None
+    if merkle:
+        roots = hasher.hash_merkle_roots()
+        if roots is None:
+            return None, None
 
+    for index, (p, f, size) in enumerate(subs):
         newdict = {'length': num2num(size),
                    'path': uniconvertl(p, encoding),
                    'path.utf-8': uniconvertl(p, 'utf-8')}
+        if roots and roots[index] is not None:
+            newdict['pieces root'] = roots[index]
 
         fs.append(newdict)
 
-        h.close()
-
-    if done > 0:
-        pieces.append(sh.digest())
-
     # 5. Create info dict
     if len(subs) == 1:
         flkey = 'length'
@@ -200,10 +195,171 @@ def makeinfo(input, userabortflag, userprogresscallback):
                 'name.utf-8': uniconvert(name, 'utf-8')}
 
     infodict.update({'pieces': ''.join(pieces)})
+    if len(subs) == 1 and roots and roots[0] is not None:
+        infodict['pieces root'] = roots[0]
 
     return infodict, piece_length
 
 
+class PieceHasher(object):
+    """
+    Calculates the piece hashes of a list of files. As the piece boundaries follow from the file sizes, the pieces can
+    be hashed independently of each other. The pieces are divided in chunks of about HASH_CHUNK_SIZE bytes, which are
+    read and hashed on a pool of threads. hashlib releases the GIL while hashing large buffers, as does reading from a
+    file, so the threads can use multiple cores.
+    """
+
+    def __init__(self, files, piece_length, num_workers=None, userabortflag=None, userprogresscallback=None,
+                 num_passes=1):
+        """
+        @param files A list of (filename, size) tuples, in torrent order.
+        @param piece_length The piece length of the torrent.
+        @param num_workers The number of hashing threads, by default the number of CPUs.
+        @param num_passes The number of times the files will be hashed (e.g. 2 when the merkle roots are added as
+        well), so the progress runs from 0 to 1 once over all passes.
+        """
+        self.files = files
+        self.piece_length = piece_length
+        self.num_workers = num_workers or cpu_count()
+        self.userabortflag = userabortflag
+        self.userprogresscallback = userprogresscallback
+        self.num_passes = num_passes
+        self.bytes_hashed = 0
+
+        # Empty files take no space in the torrent, so they are left out when looking up offsets
+        self.offsets = []
+        self.nonempty_files = []
+        self.total_size = 0
+        for filename, size in files:
+            if size > 0:
+                self.offsets.append(self.total_size)
+                self.nonempty_files.append((filename, size))
+                self.total_size += size
+
+    def is_aborted(self):
+        return self.userabortflag is not None and self.userabortflag.isSet()
+
+    def read(self, offset, length):
+        """
+        Read length bytes at offset from the concatenation of all files.
+        """
+        index = bisect_right(self.offsets, offset) - 1
+        data = []
+        while length > 0 and index < len(self.nonempty_files):
+            filename, size = self.nonempty_files[index]
+            start = offset - self.offsets[index]
+            to_read = min(size - start, length)
+            with open(filename, 'rb', READ_BUFFER_SIZE) as f:
+                f.seek(start)
+                data.append(f.read(to_read))
+            offset += to_read
+            length -= to_read
+            index += 1
+        return ''.join(data)
+
+    def hash_chunk(self, chunk):
+        """
+        Hash the pieces first_piece up to last_piece.
+        @return A (list of piece hashes, number of bytes hashed) tuple, or None if the user aborted.
+        """
+        first_piece, last_piece = chunk
+        if self.is_aborted():
+            return None
+
+        offset = first_piece * self.piece_length
+        data = self.read(offset, min((last_piece - first_piece) * self.piece_length, self.total_size - offset))
+        hashes = [sha1(buffer(data, position, self.piece_length)).digest()
+                  for position in xrange(0, len(data), self.piece_length)]
+        return hashes, len(data)
+
+    def hash_merkle_root(self, filename):
+        """
+        Calculate the BEP 52 merkle root of a file: the SHA-256 hashes of its 16 KiB blocks are the leaves of a binary
+        tree, which are padded with zero hashes up to a power of two.
+        @return A (merkle root, number of bytes hashed) tuple, or None if the user aborted.
+        """
+        leaves = []
+        size = 0
+        with open(filename, 'rb', READ_BUFFER_SIZE) as f:
+            while True:
+                if self.is_aborted():
+                    return None
+                data = f.read(HASH_CHUNK_SIZE)
+                if not data:
+                    break
+                leaves.extend(sha256(buffer(data, position, MERKLE_BLOCK_SIZE)).digest()
+                              for position in xrange(0, len(data), MERKLE_BLOCK_SIZE))
+                size += len(data)
+
+        if not leaves:
+            return None, 0
+
+        num_leaves = 1
+        while num_leaves < len(leaves):
+            num_leaves *= 2
+        layer = leaves + ['\0' * 32] * (num_leaves - len(leaves))
+        while len(layer) > 1:
+            layer = [sha256(layer[i] + layer[i + 1]).digest() for i in xrange(0, len(layer), 2)]
+        return layer[0], size
+
+    def hash_pieces(self):
+        """
+        @return The list of piece hashes, or None if the user aborted.
+        """
+        num_pieces = (self.total_size + self.piece_length - 1) // self.piece_length
+        pieces_per_chunk = max(1, HASH_CHUNK_SIZE // self.piece_length)
+        chunks = [(first_piece, min(first_piece + pieces_per_chunk, num_pieces))
+                  for first_piece in xrange(0, num_pieces, pieces_per_chunk)]
+
+        pieces = []
+        for hashes in self._run(self.hash_chunk, chunks):
+            pieces.extend(hashes)
+        return pieces if not self.is_aborted() else None
+
+    def hash_merkle_roots(self):
+        """
+        @return The merkle root of every file, None for empty files, or None if the user aborted.
+        """
+        roots = [None] * len(self.files)
+        nonempty = [index for index, (_, size) in enumerate(self.files) if size > 0]
+        for index, root in zip(nonempty, self._run(self.hash_merkle_root,
+                                                    [self.files[index][0] for index in nonempty])):
+            roots[index] = root
+        return roots if not self.is_aborted() else None
+
+    def _run(self, func, jobs):
+        """
+        Run func for all jobs, in parallel if there is more than one worker and job, and report the progress.
+        @return The results in the order of the jobs, up to the first job that was aborted.
+        """
+        pool = ThreadPool(min(self.num_workers, len(jobs))) if self.num_workers > 1 and len(jobs) > 1 else None
+        results = []
+        last_progress = time()
+        try:
+            for result in (pool.imap if pool else imap)(func, jobs):
+                if result is None or self.is_aborted():
+                    return results
+
+                result, size = result
+                results.append(result)
+                self.bytes_hashed += size
+
+                if self.userprogresscallback is not None and time() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time()
+                    self.report_progress()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        if self.userprogresscallback is not None and self.total_size > 0:
+            self.report_progress()
+        return results
+
+    def report_progress(self):
+        self.userprogresscallback(min(1.0, float(self.bytes_hashed) / (self.total_size * self.num_passes)))
+
+
 def subfiles(d):
     """ Return list of (pathlist,local filename) tuples for all the files in
     directory 'd' """
@@ -3,6 +3,10 @@
 
 import logging
 import threading
+from collections import defaultdict
+from heapq import heappush, heappop
+from itertools import count
+from time import time
 
 from Tribler.Core.Utilities.twisted_utils import callInThreadPool
 from Tribler.Core.simpledefs import (NTFY_TORRENTS, NTFY_PLAYLISTS, NTFY_COMMENTS,
@@ -29,10 +33,26 @@ class Notifier(object):
         self.use_pool = use_pool
 
         self.observers = []
+        # the observers indexed by (subject, changeType), so notify only has to look at the interested observers
+        self.observer_index = defaultdict(list)
+        # the events of cache > 0 observers that have not been dispatched yet, and the time they will be dispatched at
         self.observerscache = {}
         self.observertimers = {}
         self.observerLock = threading.Lock()
 
+        # a single dispatcher thread sends the cached events in batches, ordered by their dispatch time
+        self._dispatch_condition = threading.Condition(self.observerLock)
+        self._dispatch_queue = []
+        self._dispatch_sequence = count()
+        self._dispatcher = None
+
+        # events_emitted counts the calls to notify, the other counters count the events per observer: an event
+        # that two observers are interested in is delivered (or coalesced, or dropped) twice.
+        self.events_emitted = 0
+        self.events_delivered = 0
+        self.events_coalesced = 0
+        self.events_dropped = 0
+
     def add_observer(self, func, subject, changeTypes=[NTFY_UPDATE, NTFY_INSERT, NTFY_DELETE], id=None, cache=0):
         """
         Add observer function which will be called upon certain event
@@ -47,29 +67,38 @@ class Notifier(object):
         assert subject in self.SUBJECTS, 'Subject %s not in SUBJECTS' % subject
 
         obs = (func, subject, changeTypes, id, cache)
-        self.observerLock.acquire()
-        self.observers.append(obs)
-        self.observerLock.release()
+        with self.observerLock:
+            self.observers.append(obs)
+            for changeType in set(changeTypes):
+                self.observer_index[(subject, changeType)].append(obs)
 
     def remove_observer(self, func):
         """ Remove all observers with function func
         """
         with self.observerLock:
-            i = 0
-            while i < len(self.observers):
-                ofunc = self.observers[i][0]
-                if ofunc == func:
-                    del self.observers[i]
+            self.observers = [obs for obs in self.observers if obs[0] != func]
+            for key, observers in self.observer_index.items():
+                observers = [obs for obs in observers if obs[0] != func]
+                if observers:
+                    self.observer_index[key] = observers
                 else:
-                    i += 1
+                    del self.observer_index[key]
+
+            # the entry in the dispatch queue is skipped as it no longer matches the dispatch time in observertimers
+            self.events_dropped += len(self.observerscache.pop(func, []))
+            self.observertimers.pop(func, None)
 
     def remove_observers(self):
         with self.observerLock:
-            for timer in self.observertimers.values():
-                timer.cancel()
+            self.events_dropped += sum(len(events) for events in self.observerscache.itervalues())
             self.observerscache = {}
             self.observertimers = {}
             self.observers = []
+            self.observer_index = defaultdict(list)
+
+            self._dispatch_queue = []
+            self._dispatcher = None
+            self._dispatch_condition.notify()
 
     def notify(self, subject, changeType, obj_id, *args):
         """
@@ -80,47 +109,73 @@ class Notifier(object):
 
         args = [subject, changeType, obj_id] + list(args)
 
-        self.observerLock.acquire()
-        for ofunc, osubject, ochangeTypes, oid, cache in self.observers:
-            try:
-                if (subject == osubject and
-                    changeType in ochangeTypes and
-                        (oid is None or oid == obj_id)):
+        with self.observerLock:
+            self.events_emitted += 1
+            for ofunc, _, _, oid, cache in self.observer_index.get((subject, changeType), []):
+                try:
+                    if oid is not None and oid != obj_id:
+                        continue
 
                     if not cache:
                         tasks.append(ofunc)
+                    elif ofunc in self.observerscache:
+                        self.observerscache[ofunc].append(args)
+                        self.events_coalesced += 1
                     else:
-                        if ofunc not in self.observerscache:
-                            def doQueue(ofunc):
-                                self.observerLock.acquire()
-                                if ofunc in self.observerscache:
-                                    events = self.observerscache[ofunc]
-                                    del self.observerscache[ofunc]
-                                    del self.observertimers[ofunc]
-                                else:
-                                    events = []
-                                self.observerLock.release()
-
-                                if events:
-                                    if self.use_pool:
-                                        callInThreadPool(ofunc, events)
-                                    else:
-                                        ofunc(events)
-
-                            t = threading.Timer(cache, doQueue, (ofunc,))
-                            t.setName("Notifier-timer-%s" % subject)
-                            t.start()
-
-                            self.observerscache[ofunc] = []
-                            self.observertimers[ofunc] = t
+                        self.observerscache[ofunc] = [args]
+                        self._schedule_dispatch(ofunc, cache)
+                except:
+                    self._logger.exception("OIDs were %s %s", repr(oid), repr(obj_id))
 
-                        self.observerscache[ofunc].append(args)
-            except:
-                self._logger.exception("OIDs were %s %s", repr(oid), repr(obj_id))
+            self.events_delivered += len(tasks)
 
-        self.observerLock.release()
         for task in tasks:
             if self.use_pool:
                 callInThreadPool(task, *args)
             else:
                 task(*args)  # call observer function in this thread
+
+    def _schedule_dispatch(self, ofunc, cache):
+        """
+        Schedules the cached events of ofunc to be dispatched in cache seconds, must be called with observerLock held.
+        """
+        dispatch_time = time() + cache
+        self.observertimers[ofunc] = dispatch_time
+        heappush(self._dispatch_queue, (dispatch_time, next(self._dispatch_sequence), ofunc))
+
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="Notifier-dispatcher")
+            self._dispatcher.setDaemon(True)
+            self._dispatcher.start()
+        else:
+            self._dispatch_condition.notify()
+
+    def _dispatch_loop(self):
+        while True:
+            with self.observerLock:
+                while True:
+                    if self._dispatcher is not threading.currentThread():
+                        return
+
+                    now = time()
+                    if self._dispatch_queue and self._dispatch_queue[0][0] <= now:
+                        break
+                    self._dispatch_condition.wait(self._dispatch_queue[0][0] - now if self._dispatch_queue else None)
+
+                batches = []
+                while self._dispatch_queue and self._dispatch_queue[0][0] <= now:
+                    dispatch_time, _, ofunc = heappop(self._dispatch_queue)
+                    if self.observertimers.get(ofunc) == dispatch_time:
+                        del self.observertimers[ofunc]
+                        events = self.observerscache.pop(ofunc)
+                        self.events_delivered += len(events)
+                        batches.append((ofunc, events))
+
+            for ofunc, events in batches:
+                try:
+                    if self.use_pool:
+                        callInThreadPool(ofunc, events)
+                    else:
+                        ofunc(events)
+                except:
+                    self._logger.exception("Observer %s failed to handle %d events", repr(ofunc), len(events))
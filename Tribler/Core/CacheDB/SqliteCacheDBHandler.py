@@ -9,16 +9,18 @@ import threading
 import json
 from copy import deepcopy
 from pprint import pformat
-from struct import unpack_from
 from time import time
 from traceback import print_exc
 from collections import OrderedDict, defaultdict
 from libtorrent import bencode
 from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python.threadable import isInIOThread
 
 from Tribler.Core.CacheDB.sqlitecachedb import bin2str, str2bin
 from Tribler.Core.TorrentDef import TorrentDef
-from Tribler.Core.Utilities.search_utils import split_into_keywords, filter_keywords
+from Tribler.Core.Utilities.search_utils import (split_into_keywords, filter_keywords, search_rank, unpack_matchinfo,
+                                                 TrigramIndex, CompletionIndex, get_max_edit_distance)
 from Tribler.Core.Utilities.unicode import dunno2unicode
 from Tribler.Core.simpledefs import (INFOHASH_LENGTH, NTFY_UPDATE, NTFY_INSERT, NTFY_DELETE, NTFY_CREATE,
                                      NTFY_MODIFIED, NTFY_TRACKERINFO, NTFY_MYPREFERENCES, NTFY_VOTECAST, NTFY_TORRENTS,
@@ -33,6 +35,13 @@ VOTECAST_FLUSH_DB_INTERVAL = 15
 
 DEFAULT_ID_CACHE_SIZE = 1024 * 5
 
+SEARCH_PAGE_SIZE = 50
+REMOTE_SEARCH_LIMIT = 25
+
+# the number of similar terms per keyword, and swarmnames containing them, that are considered for search suggestions
+SUGGESTION_TERMS_PER_KEYWORD = 5
+SUGGESTION_CANDIDATES = 100
+
 
 class LimitedOrderedDict(OrderedDict):
 
@@ -75,6 +84,22 @@ class BasicDBHandler(TaskManager):
     def getAll(self, value_name, where=None, group_by=None, having=None, order_by=None, limit=None, offset=None, conj=u"AND", **kw):
         return self._db.getAll(self.table_name, value_name, where=where, group_by=group_by, having=having, order_by=order_by, limit=limit, offset=offset, conj=conj, **kw)
 
+    def getOneAsync(self, value_name, where=None, conj=u"AND", **kw):
+        """
+        Same as getOne, but the query runs on the DB worker thread instead of blocking the reactor.
+        :return: A Deferred that fires with the result.
+        """
+        return self._db.getOneAsync(self.table_name, value_name, where=where, conj=conj, **kw)
+
+    def getAllAsync(self, value_name, where=None, group_by=None, having=None, order_by=None, limit=None,
+                    offset=None, conj=u"AND", **kw):
+        """
+        Same as getAll, but the query runs on the DB worker thread instead of blocking the reactor.
+        :return: A Deferred that fires with the list of rows.
+        """
+        return self._db.getAllAsync(self.table_name, value_name, where=where, group_by=group_by, having=having,
+                                    order_by=order_by, limit=limit, offset=offset, conj=conj, **kw)
+
 
 class PeerDBHandler(BasicDBHandler):
 
@@ -222,6 +247,18 @@ class TorrentDBHandler(BasicDBHandler):
 
         self.infohash_id = LimitedOrderedDict(DEFAULT_ID_CACHE_SIZE)
 
+        self._db.register_function(u"search_rank", search_rank, 4)
+
+        # The suggestion and completion indexes hold the terms of all swarmnames in the FullTextIndex. They are loaded
+        # in the background and kept up to date by _indexTorrent and freeSpace, changes to the terms while they are
+        # being loaded are kept aside.
+        self._term_lock = threading.Lock()
+        self._suggestion_index = None
+        self._completion_index = None
+        self._term_indexes_loading = False
+        self._term_indexes_loaded = threading.Event()
+        self._pending_term_changes = []
+
     def initialize(self, *args, **kwargs):
         super(TorrentDBHandler, self).initialize(*args, **kwargs)
         self.category = self.session.lm.cat
@@ -230,6 +267,8 @@ class TorrentDBHandler(BasicDBHandler):
         self.channelcast_db = self.session.open_dbhandler(NTFY_CHANNELCAST)
         self._rtorrent_handler = self.session.lm.rtorrent_handler
 
+        self._load_term_indexes()
+
     def close(self):
         super(TorrentDBHandler, self).close()
         self.category = None
@@ -307,34 +346,11 @@ class TorrentDBHandler(BasicDBHandler):
 
     def addExternalTorrentNoDef(self, infohash, name, files, trackers, timestamp, extra_info={}):
         if not self.hasTorrent(infohash):
-            metainfo = {'info': {}, 'encoding': 'utf_8'}
-            metainfo['info']['name'] = name.encode('utf_8')
-            metainfo['info']['piece length'] = -1
-            metainfo['info']['pieces'] = ''
-
-            if len(files) > 1:
-                files_as_dict = []
-                for filename, file_length in files:
-                    filename = filename.encode('utf_8')
-                    files_as_dict.append({'path': [filename], 'length': file_length})
-                metainfo['info']['files'] = files_as_dict
-
-            elif len(files) == 1:
-                metainfo['info']['length'] = files[0][1]
-            else:
+            torrentdef = self._create_torrentdef_nodef(infohash, name, files, trackers, timestamp, extra_info)
+            if torrentdef is None:
                 return
 
-            if len(trackers) > 0:
-                metainfo['announce'] = trackers[0]
-            else:
-                metainfo['nodes'] = []
-
-            metainfo['creation date'] = timestamp
-
             try:
-                torrentdef = TorrentDef.load_from_dict(metainfo)
-                torrentdef.infohash = infohash
-
                 torrent_id = self._addTorrentToDB(torrentdef, extra_info)
                 if self._rtorrent_handler:
                     self._rtorrent_handler.notify_possible_torrent_infohash(infohash)
@@ -343,9 +359,131 @@ class TorrentDBHandler(BasicDBHandler):
                 sql_insert_files = "INSERT OR IGNORE INTO TorrentFiles (torrent_id, path, length) VALUES (?,?,?)"
                 self._db.executemany(sql_insert_files, insert_files)
             except:
-                self._logger.error("Could not create a TorrentDef instance %r %r %r %r %r %r", infohash, timestamp, name, files, trackers, extra_info)
+                self._logger.error("Could not add torrent %r %r %r %r %r %r",
+                                   infohash, timestamp, name, files, trackers, extra_info)
                 print_exc()
 
+    def _create_torrentdef_nodef(self, infohash, name, files, trackers, timestamp, extra_info={}):
+        metainfo = {'info': {}, 'encoding': 'utf_8'}
+        metainfo['info']['name'] = name.encode('utf_8')
+        metainfo['info']['piece length'] = -1
+        metainfo['info']['pieces'] = ''
+
+        if len(files) > 1:
+            files_as_dict = []
+            for filename, file_length in files:
+                filename = filename.encode('utf_8')
+                files_as_dict.append({'path': [filename], 'length': file_length})
+            metainfo['info']['files'] = files_as_dict
+
+        elif len(files) == 1:
+            metainfo['info']['length'] = files[0][1]
+        else:
+            return None
+
+        if len(trackers) > 0:
+            metainfo['announce'] = trackers[0]
+        else:
+            metainfo['nodes'] = []
+
+        metainfo['creation date'] = timestamp
+
+        try:
+            torrentdef = TorrentDef.load_from_dict(metainfo)
+            torrentdef.infohash = infohash
+            return torrentdef
+        except:
+            self._logger.error("Could not create a TorrentDef instance %r %r %r %r %r %r",
+                               infohash, timestamp, name, files, trackers, extra_info)
+            print_exc()
+
+    def addExternalTorrents(self, torrentdefs, extra_info={}):
+        """
+        Adds a batch of torrents to the database. Instead of a few statements per torrent, every table is written
+        with a single executemany inside one transaction.
+        :param torrentdefs: A list of finalized TorrentDefs, or of (torrentdef, extra_info) tuples.
+        :param extra_info: The extra info of the TorrentDefs that do not come with their own.
+        :return: A list with the infohashes of the torrents that have been added.
+        """
+        torrents = [(torrent, extra_info) if isinstance(torrent, TorrentDef) else torrent for torrent in torrentdefs]
+
+        collected = self._getCollectedInfohashes([torrentdef.get_infohash() for torrentdef, _ in torrents])
+        torrents = [torrent for torrent in torrents if torrent[0].get_infohash() not in collected]
+
+        added = self._addTorrentsToDB(torrents).keys()
+        for infohash in added:
+            self.notifier.notify(NTFY_TORRENTS, NTFY_INSERT, infohash)
+        return added
+
+    def addExternalTorrentsNoDef(self, torrents):
+        """
+        Adds a batch of torrents for which only the name, files and trackers are known, see addExternalTorrents.
+        :param torrents: A list of (infohash, name, files, trackers, timestamp, extra_info) tuples.
+        :return: A list with the infohashes of the torrents that have been added.
+        """
+        collected = self._getCollectedInfohashes([torrent[0] for torrent in torrents])
+
+        to_add = []
+        torrent_files = {}
+        for infohash, name, files, trackers, timestamp, extra_info in torrents:
+            if infohash in collected:
+                continue
+
+            torrentdef = self._create_torrentdef_nodef(infohash, name, files, trackers, timestamp, extra_info)
+            if torrentdef is not None:
+                to_add.append((torrentdef, extra_info))
+                torrent_files[infohash] = files
+
+        torrent_ids = self._addTorrentsToDB(to_add)
+
+        insert_files = [(torrent_id, unicode(path), length) for infohash, torrent_id in torrent_ids.iteritems()
+                        for path, length in torrent_files[infohash]]
+        if insert_files:
+            sql_insert_files = "INSERT OR IGNORE INTO TorrentFiles (torrent_id, path, length) VALUES (?,?,?)"
+            self._db.executemany(sql_insert_files, insert_files)
+
+        if self._rtorrent_handler:
+            for infohash in torrent_ids:
+                self._rtorrent_handler.notify_possible_torrent_infohash(infohash)
+        return torrent_ids.keys()
+
+    def _getCollectedInfohashes(self, infohashes):
+        """
+        Batch version of hasTorrent.
+        :return: The set of infohashes that have been collected.
+        """
+        collected = set(infohash for infohash in infohashes if infohash in self.existed_torrents)
+        to_select = [(bin2str(infohash),) for infohash in set(infohashes) - collected]
+        if to_select:
+            sql = u"SELECT infohash FROM CollectedTorrent WHERE infohash = ?"
+            for infohash, in list(self._db.executemany(sql, to_select)):
+                infohash = str2bin(infohash)
+                self.existed_torrents.add(infohash)
+                collected.add(infohash)
+        return collected
+
+    def _getTorrentIDSInBatch(self, infohashes):
+        """
+        Like getTorrentIDS, but selects the torrent_ids with an executemany, so the number of infohashes is not
+        limited by the maximum number of SQL variables.
+        :return: A dict mapping the infohashes in the database to their torrent_id.
+        """
+        to_return = {}
+        to_select = []
+        for infohash in set(infohashes):
+            if infohash in self.infohash_id:
+                to_return[infohash] = self.infohash_id[infohash]
+            else:
+                to_select.append((bin2str(infohash),))
+
+        if to_select:
+            sql = u"SELECT torrent_id, infohash FROM Torrent WHERE infohash = ?"
+            for torrent_id, infohash in list(self._db.executemany(sql, to_select)):
+                infohash = str2bin(infohash)
+                self.infohash_id[infohash] = torrent_id
+                to_return[infohash] = torrent_id
+        return to_return
+
     def addOrGetTorrentID(self, infohash):
         assert isinstance(infohash, str), "INFOHASH has invalid type: %s" % type(infohash)
         assert len(infohash) == INFOHASH_LENGTH, "INFOHASH has invalid length: %d" % len(infohash)
@@ -424,11 +562,133 @@ class TorrentDBHandler(BasicDBHandler):
         self._addTorrentTracker(torrent_id, torrentdef, extra_info)
         return torrent_id
 
+    def _addTorrentsToDB(self, torrents):
+        """
+        Batch version of _addTorrentToDB, which writes the Torrent, FullTextIndex, TrackerInfo and
+        TorrentTrackerMapping rows of all torrents in a single transaction.
+        :param torrents: A list of (torrentdef, extra_info) tuples, later duplicates of an infohash replace the
+        earlier ones.
+        :return: An OrderedDict mapping the infohashes to their torrent_id.
+        """
+        unique_torrents = OrderedDict()
+        for torrentdef, extra_info in torrents:
+            assert isinstance(torrentdef, TorrentDef), "TORRENTDEF has invalid type: %s" % type(torrentdef)
+            assert torrentdef.is_finalized(), "TORRENTDEF is not finalized"
+            unique_torrents[torrentdef.get_infohash()] = (torrentdef, extra_info)
+
+        if not unique_torrents:
+            return OrderedDict()
+
+        with self._db.transaction():
+            torrent_ids = self._getTorrentIDSInBatch(unique_torrents.keys())
+
+            # _get_database_dict only includes the seeders and leechers if they are known, so the rows are grouped
+            # by their columns
+            inserts = defaultdict(list)
+            updates = defaultdict(list)
+            for infohash, (torrentdef, extra_info) in unique_torrents.iteritems():
+                database_dict = self._get_database_dict(torrentdef, extra_info)
+                if infohash in torrent_ids:
+                    del database_dict["infohash"]
+                    columns = tuple(sorted(database_dict))
+                    updates[columns].append([database_dict[column] for column in columns] + [torrent_ids[infohash]])
+                else:
+                    columns = tuple(sorted(database_dict))
+                    inserts[columns].append([database_dict[column] for column in columns])
+
+            for columns, values in inserts.iteritems():
+                sql = u"INSERT INTO Torrent (%s) VALUES (%s)" % (u", ".join(columns), u", ".join(u"?" * len(columns)))
+                self._db.executemany(sql, values)
+
+            for columns, values in updates.iteritems():
+                sql = u"UPDATE Torrent SET %s WHERE torrent_id = ?" % u", ".join(u"%s = ?" % column
+                                                                                for column in columns)
+                self._db.executemany(sql, values)
+
+            if inserts:
+                torrent_ids.update(self._getTorrentIDSInBatch([infohash for infohash in unique_torrents
+                                                               if infohash not in torrent_ids]))
+
+            to_index = []
+            tracker_mappings = []
+            for infohash, (torrentdef, _) in unique_torrents.iteritems():
+                torrent_id = torrent_ids[infohash]
+
+                swarmname = torrentdef.get_name_as_unicode()
+                if not torrentdef.is_multifile_torrent():
+                    swarmname, _ = os.path.splitext(swarmname)
+                to_index.append((torrent_id, swarmname, torrentdef.get_files_as_unicode()))
+
+                tracker_mappings.append((torrent_id, infohash, list(self._getTrackerSet(torrentdef))))
+
+            self._indexTorrents(to_index)
+            self._addTorrentTrackerMappings(tracker_mappings)
+
+        return OrderedDict((infohash, torrent_ids[infohash]) for infohash in unique_torrents)
+
     def _indexTorrent(self, torrent_id, swarmname, files):
         existed = self._db.getOne('CollectedTorrent', 'infohash', torrent_id=torrent_id)
         if existed:
             return
 
+        values = self._getIndexValues(torrent_id, swarmname, files)
+        try:
+            old_swarmnames = self._getIndexedSwarmnames([torrent_id])
+            # INSERT OR REPLACE not working for fts3 table
+            self._db.execute_write(u"DELETE FROM FullTextIndex WHERE rowid = ?", (torrent_id,))
+            self._db.execute_write(
+                u"INSERT INTO FullTextIndex (rowid, swarmname, filenames, fileextensions) VALUES(?,?,?,?)", values)
+        except:
+            # this will fail if the fts3 module cannot be found
+            print_exc()
+        else:
+            self._reindex_terms(old_swarmnames.get(torrent_id), values[1])
+
+    def _indexTorrents(self, torrents):
+        """
+        Batch version of _indexTorrent.
+        :param torrents: A list of (torrent_id, swarmname, files) tuples.
+        """
+        sql = u"SELECT torrent_id FROM CollectedTorrent WHERE torrent_id = ?"
+        collected = set(torrent_id for torrent_id,
+                        in list(self._db.executemany(sql, [(torrent[0],) for torrent in torrents])))
+
+        values = [self._getIndexValues(*torrent) for torrent in torrents if torrent[0] not in collected]
+        if not values:
+            return
+
+        try:
+            old_swarmnames = self._getIndexedSwarmnames([value[0] for value in values])
+            self._db.executemany(u"DELETE FROM FullTextIndex WHERE rowid = ?", [(value[0],) for value in values])
+            self._db.executemany(
+                u"INSERT INTO FullTextIndex (rowid, swarmname, filenames, fileextensions) VALUES(?,?,?,?)", values)
+        except:
+            # this will fail if the fts3 module cannot be found
+            print_exc()
+        else:
+            for value in values:
+                self._reindex_terms(old_swarmnames.get(value[0]), value[1])
+
+    def _getIndexedSwarmnames(self, torrent_ids):
+        """
+        :return: A dict mapping the torrent_ids that are in the FullTextIndex to their indexed swarmname.
+        """
+        sql = u"SELECT rowid, swarmname FROM FullTextIndex WHERE rowid = ?"
+        return dict(list(self._db.executemany(sql, [(torrent_id,) for torrent_id in torrent_ids])))
+
+    def _reindex_terms(self, old_swarmname, new_swarmname):
+        """
+        Updates the term indexes for a FullTextIndex row of which the swarmname changed from old_swarmname (None if
+        the row is new) to new_swarmname, so re-indexing a torrent does not count its terms twice.
+        """
+        old_terms = set(old_swarmname.split()) if old_swarmname else set()
+        new_terms = set(new_swarmname.split())
+        if old_terms - new_terms:
+            self._update_indexed_terms(old_terms - new_terms, -1)
+        if new_terms - old_terms:
+            self._update_indexed_terms(new_terms - old_terms, 1)
+
+    def _getIndexValues(self, torrent_id, swarmname, files):
         # Niels: new method for indexing, replaces invertedindex
         # Making sure that swarmname does not include extension for single file torrents
         swarm_keywords = " ".join(split_into_keywords(swarmname))
@@ -449,20 +709,16 @@ class TorrentDBHandler(BasicDBHandler):
             filenames.sort(cmp=popSort, reverse=True)
             filenames = filenames[:1000]
 
-        values = (torrent_id, swarm_keywords, " ".join(filenames), " ".join(fileextensions))
-        try:
-            # INSERT OR REPLACE not working for fts3 table
-            self._db.execute_write(u"DELETE FROM FullTextIndex WHERE rowid = ?", (torrent_id,))
-            self._db.execute_write(
-                u"INSERT INTO FullTextIndex (rowid, swarmname, filenames, fileextensions) VALUES(?,?,?,?)", values)
-        except:
-            # this will fail if the fts3 module cannot be found
-            print_exc()
+        return torrent_id, swarm_keywords, " ".join(filenames), " ".join(fileextensions)
 
     # ------------------------------------------------------------
     # Adds the trackers of a given torrent into the database.
     # ------------------------------------------------------------
     def _addTorrentTracker(self, torrent_id, torrentdef, extra_info={}):
+        # add trackers in batch
+        self.addTorrentTrackerMappingInBatch(torrent_id, list(self._getTrackerSet(torrentdef)))
+
+    def _getTrackerSet(self, torrentdef):
         # Set add_all to True if you want to put all multi-trackers into db.
         # In the current version (4.2) only the main tracker is used.
 
@@ -492,8 +748,7 @@ class TorrentDBHandler(BasicDBHandler):
                     if tracker_url:
                         new_tracker_set.add(tracker_url)
 
-        # add trackers in batch
-        self.addTorrentTrackerMappingInBatch(torrent_id, list(new_tracker_set))
+        return new_tracker_set
 
     def updateTorrent(self, infohash, notify=True, **kw):  # watch the schema of database
         if 'seeder' in kw:
@@ -651,7 +906,46 @@ class TorrentDBHandler(BasicDBHandler):
             return
 
         infohash = self.getInfohash(torrent_id)
-        if infohash and self.session.has_collected_torrent(infohash):
+        if infohash:
+            self._addTrackersToCollectedTorrent(infohash, tracker_list)
+
+    def _addTorrentTrackerMappings(self, tracker_mappings):
+        """
+        Batch version of addTorrentTrackerMappingInBatch, the trackers of all torrents are looked up and added to
+        TrackerInfo only once.
+        :param tracker_mappings: A list of (torrent_id, infohash, tracker_list) tuples.
+        """
+        all_trackers = set()
+        for _, _, tracker_list in tracker_mappings:
+            all_trackers.update(tracker_list)
+        if not all_trackers:
+            return
+
+        sql = u"SELECT tracker FROM TrackerInfo WHERE tracker = ?"
+        found_trackers = set(tracker for tracker,
+                             in list(self._db.executemany(sql, [(tracker,) for tracker in all_trackers])))
+
+        # update tracker info
+        if self.session.lm.tracker_manager is not None:
+            for tracker in all_trackers - found_trackers:
+                self.session.lm.tracker_manager.add_tracker(tracker)
+
+        # update torrent-tracker mapping
+        sql = 'INSERT OR IGNORE INTO TorrentTrackerMapping(torrent_id, tracker_id)'\
+            + ' VALUES(?, (SELECT tracker_id FROM TrackerInfo WHERE tracker = ?))'
+        self._db.executemany(sql, [(torrent_id, tracker) for torrent_id, _, tracker_list in tracker_mappings
+                                   for tracker in tracker_list])
+
+        # add trackers into the torrent files that have been collected
+        if not self.session.get_torrent_store() or self.session.lm.torrent_store is None:
+            return
+
+        for _, infohash, tracker_list in tracker_mappings:
+            if tracker_list:
+                self._addTrackersToCollectedTorrent(infohash, tracker_list)
+
+    def _addTrackersToCollectedTorrent(self, infohash, tracker_list):
+        if self.session.has_collected_torrent(infohash):
             torrent_data = self.session.get_collected_torrent(infohash)
             tdef = TorrentDef.load_from_memory(torrent_data)
 
@@ -859,202 +1153,287 @@ class TorrentDBHandler(BasicDBHandler):
         # sql_insert =  "insert into Torrent (torrent_id, infohash, relevance) values (?,?,?)"
         # self._db.executemany(sql_insert, torrent_id_infohashes)
 
+        # torrents without a name are not searchable, so drop their terms from the FullTextIndex
+        parameters = u",".join(u"?" * len(tids))
+        sql_swarmnames = u"SELECT swarmname FROM FullTextIndex WHERE rowid IN (%s)" % parameters
+        for swarmname, in self._db.fetchall(sql_swarmnames, [torrent_id for torrent_id, in tids]):
+            self._update_indexed_terms(set(swarmname.split()), -1)
+        self._db.executemany(u"DELETE FROM FullTextIndex WHERE rowid = ?", tids)
+
         self._logger.info("Erased %d torrents", deleted)
         return deleted
 
-    def searchNames(self, kws, local=True, keys=None, doSort=True):
-        assert 'infohash' in keys
-        assert not doSort or ('num_seeders' in keys or 'T.num_seeders' in keys)
-
-        infohash_index = keys.index('infohash')
-        num_seeders_index = keys.index('num_seeders') if 'num_seeders' in keys else -1
-
-        if num_seeders_index == -1:
-            doSort = False
-
-        values = ", ".join(keys)
-        mainsql = "SELECT " + values + ", C.channel_id, Matchinfo(FullTextIndex) FROM"
-        if local:
-            mainsql += " Torrent T"
-        else:
-            mainsql += " CollectedTorrent T"
-
-        mainsql += """, FullTextIndex
-                    LEFT OUTER JOIN _ChannelTorrents C ON T.torrent_id = C.torrent_id
-                    WHERE t.name IS NOT NULL AND t.torrent_id = FullTextIndex.rowid AND C.deleted_at IS NULL AND FullTextIndex MATCH ?
-                    """
-
-        if not local:
-            mainsql += "AND T.secret is not 1 LIMIT 250"
-
-        query = " ".join(filter_keywords(kws))
-        not_negated = [kw for kw in filter_keywords(kws) if kw[0] != '-']
-
-        results = self._db.fetchall(mainsql, (query,))
-
-        channels = set()
-        channel_dict = {}
-        for result in results:
-            if result[-2]:
-                channels.add(result[-2])
+    def searchNames(self, kws, local=True, keys=None, doSort=True, limit=None, offset=None):
+        """
+        Searches the FullTextIndex for kws. Every result consists of the requested keys, followed by the channel_id,
+        a dict with the matching keywords per FullTextIndex column and the details of the best channel of the torrent.
 
-        if len(channels) > 0:
-            # results are tuples of (id, str(dispersy_cid), name, description,
-            # nr_torrents, nr_favorites, nr_spam, my_vote, modified, id ==
-            # self._channel_id)
-            for channel in self.channelcast_db.getChannels(channels):
-                if channel[1] != '-1':
-                    channel_dict[channel[0]] = channel
-
-        myChannelId = self.channelcast_db._channel_id or 0
-
-        result_dict = {}
-
-        # step 1, merge torrents keep one with best channel
-        for result in results:
-            channel_id = result[-2]
-            channel = channel_dict.get(channel_id, None)
-
-            infohash = result[infohash_index]
-            if channel:
-                # ignoring spam channels
-                if channel[7] < 0:
-                    continue
+        Results are ranked by search_rank in SQLite, so only the requested page is returned to Python. Remote
+        searches are limited to the best REMOTE_SEARCH_LIMIT results.
+        """
+        if not local and limit is None:
+            limit = REMOTE_SEARCH_LIMIT
+        results, _ = self.searchNamesPage(kws, keys, local=local, limit=limit, offset=offset, doSort=doSort)
+        return results
 
-                # see if we have a better channel in torrents_dict
-                if infohash in result_dict:
-                    old_channel = channel_dict.get(result_dict[infohash][-2], False)
-                    if old_channel:
+    def searchNamesAsync(self, kws, local=True, keys=None, doSort=True, limit=None, offset=None):
+        """
+        Same as searchNames, but the query runs on the DB worker thread instead of blocking the reactor.
+        :return: A Deferred that fires with the results.
+        """
+        if not local and limit is None:
+            limit = REMOTE_SEARCH_LIMIT
+        sql, args = self._get_search_names_sql(kws, keys, local, limit, offset, None, doSort)
+        return self._db.fetchall_async(sql, args).addCallback(
+            lambda rows: self._get_search_names_results(kws, keys, rows, limit)[0])
 
-                        # allways prefer my channel
-                        if old_channel[0] == myChannelId:
-                            continue
+    def searchNamesPage(self, kws, keys, local=True, limit=SEARCH_PAGE_SIZE, offset=None, after=None, doSort=True):
+        """
+        Returns a page of ranked search results for kws, see searchNames for the format of the results.
 
-                        # allways prefer channel with higher vote
-                        if channel[7] < old_channel[7]:
-                            continue
+        Pages can either be selected with offset or with after: the resumption cursor that the previous call returned.
+        The second value of the returned tuple is the cursor for the next page, or None if this was the last page.
+        Either way, every matching torrent is ranked to select a page, so deep pages are not cheaper with a cursor.
 
-                        votes = (channel[5] or 0) - (channel[6] or 0)
-                        oldvotes = (old_channel[5] or 0) - (old_channel[6] or 0)
-                        if votes < oldvotes:
-                            continue
+        The cursor is best-effort: it holds the rank of the last result, which depends on the number of seeders and
+        the channel votes. When these change between two calls, results may be skipped or returned twice.
 
-                result_dict[infohash] = result
+        The query runs on a read-only connection of the read pool in the calling thread, so it does not wait for the DB
+        worker. It sees the database as of the last commit, torrents that have been added since are found once the
+        next periodic commit is done. On the reactor thread, use searchNamesAsync instead.
+        """
+        sql, args = self._get_search_names_sql(kws, keys, local, limit, offset, after, doSort)
+        rows = self._db.fetchall(sql, args, read_only=True)
+        return self._get_search_names_results(kws, keys, rows, limit)
 
-            elif infohash not in result_dict:
-                result_dict[infohash] = result
+    def _get_search_names_sql(self, kws, keys, local, limit, offset, after, doSort):
+        assert 'infohash' in keys
+        assert after is None or limit is not None, "Paging with a cursor requires a limit"
 
+        query = " ".join(filter_keywords(kws))
+        my_channel_id = self.channelcast_db._channel_id if self.channelcast_db else None
+
+        # C is the entry of the torrent in its best channel: always prefer my channel, then channels with a higher
+        # vote of mine and then channels with more votes. Channels without a dispersy community do not count.
+        sql = u"SELECT " + u", ".join(keys) + u""", C.channel_id, Matchinfo(FullTextIndex),
+                CH.id, CH.dispersy_cid, CH.name, CH.description, CH.nr_torrents, CH.nr_favorite, CH.nr_spam,
+                IFNULL(V.vote, 0), CH.modified,
+                search_rank(Matchinfo(FullTextIndex), (SELECT IFNULL(MAX(torrent_id), 0) FROM Torrent),
+                            T.num_seeders, IFNULL(CH.nr_favorite, 0) - IFNULL(CH.nr_spam, 0)) AS rank,
+                T.torrent_id
+            FROM FullTextIndex
+            JOIN %s T ON T.torrent_id = FullTextIndex.rowid
+            LEFT JOIN _ChannelTorrents C ON C.id = (
+                SELECT CT.id FROM ChannelTorrents CT
+                LEFT JOIN Channels BC ON BC.id = CT.channel_id AND BC.dispersy_cid != -1 AND TRIM(BC.name) != ''
+                LEFT JOIN ChannelVotes BV ON BV.channel_id = BC.id AND BV.voter_id ISNULL
+                WHERE CT.torrent_id = T.torrent_id
+                ORDER BY BC.id IS NOT NULL DESC, CT.channel_id == ? DESC, IFNULL(BV.vote, 0) DESC,
+                         IFNULL(BC.nr_favorite, 0) - IFNULL(BC.nr_spam, 0) DESC
+                LIMIT 1)
+            LEFT JOIN Channels CH ON CH.id = C.channel_id AND CH.dispersy_cid != -1 AND TRIM(CH.name) != ''
+            LEFT JOIN ChannelVotes V ON V.channel_id = CH.id AND V.voter_id ISNULL
+            WHERE FullTextIndex MATCH ? AND T.name IS NOT NULL AND IFNULL(V.vote, 0) >= 0
+            """ % (u"Torrent" if local else u"CollectedTorrent")
+        args = [my_channel_id, query]
 
-        # step 2, fix all dict fields
-        dont_sort_list = []
-        results = [list(result) for result in result_dict.values()]
-        for i in xrange(len(results) - 1, -1, -1):
-            result = results[i]
+        if not local:
+            sql += u" AND T.secret IS NOT 1"
+        if after is not None:
+            sql += u" AND (rank < ? OR (rank == ? AND T.torrent_id < ?))"
+            args.extend([after[0], after[0], after[1]])
+        if doSort or limit is not None:
+            sql += u" ORDER BY rank DESC, T.torrent_id DESC"
+        if limit is not None:
+            sql += u" LIMIT %d" % limit
+        elif offset is not None:
+            # SQLite only accepts an OFFSET after a LIMIT, a negative LIMIT means no limit
+            sql += u" LIMIT -1"
+        if offset is not None:
+            sql += u" OFFSET %d" % offset
+        return sql, args
+
+    def _get_search_names_results(self, kws, keys, rows, limit):
+        infohash_index = keys.index('infohash')
+        not_negated = [kw for kw in filter_keywords(kws) if kw[0] != '-']
+        my_channel_id = self.channelcast_db._channel_id if self.channelcast_db else None
 
+        results = []
+        for row in rows:
+            result = list(row[:-11])
             result[infohash_index] = str2bin(result[infohash_index])
 
             matches = {'swarmname': set(), 'filenames': set(), 'fileextensions': set()}
-
-            # Matchinfo is documented at: http://www.sqlite.org/fts3.html#matchinfo
-            matchinfo = str(result[-1])
-            num_phrases, num_cols = unpack_from('II', matchinfo)
-            unpack_str = 'I' * (3 * num_cols * num_phrases)
-            matchinfo = unpack_from('II' + unpack_str, matchinfo)
-
-            swarmnames, filenames, fileextensions = [
-                [matchinfo[3 * (i + p * num_cols) + 2] for p in range(num_phrases)]
-                for i in range(num_cols)
-            ]
-
-            for i, keyword in enumerate(not_negated):
-                if swarmnames[i]:
+            phrases = unpack_matchinfo(row[-12])
+            for keyword, (swarmname, filenames, fileextensions) in zip(not_negated, phrases):
+                if swarmname[0]:
                     matches['swarmname'].add(keyword)
-                if filenames[i]:
+                if filenames[0]:
                     matches['filenames'].add(keyword)
-                if fileextensions[i]:
+                if fileextensions[0]:
                     matches['fileextensions'].add(keyword)
             result[-1] = matches
 
-            channel = channel_dict.get(result[-2], (result[-2], None, '', '', 0, 0, 0, 0, 0, False))
-            result.extend(channel)
+            channel_id, dispersy_cid, name, description, nr_torrents, nr_favorite, nr_spam, my_vote, modified = \
+                row[-11:-2]
+            if channel_id is not None:
+                result.extend((channel_id, str(dispersy_cid), name, description, nr_torrents, nr_favorite, nr_spam,
+                               my_vote, modified, channel_id == my_channel_id))
+            else:
+                result.extend((result[-2], None, '', '', 0, 0, 0, 0, 0, False))
+            results.append(result)
 
-            if doSort and result[num_seeders_index] <= 0:
-                dont_sort_list.append(result)
-                results.pop(i)
+        next_after = None
+        if limit is not None and len(rows) == limit:
+            next_after = (rows[-1][-2], rows[-1][-1])
+        return results, next_after
 
+    def getAutoCompleteTerms(self, keyword, max_terms):
+        """
+        Returns up to max_terms swarmname terms that start with keyword, most frequent first.
+        """
+        keyword = keyword.lower()
+        if not self._wait_for_term_indexes():
+            return []
 
-        if doSort:
-            def compare(a, b):
-                return cmp(a[num_seeders_index], b[num_seeders_index])
-            results.sort(compare, reverse=True)
-        results.extend(dont_sort_list)
+        with self._term_lock:
+            terms = self._completion_index.complete(keyword, max_terms + 1)
+        return [term for term in terms if term != keyword][:max_terms]
 
-        if not local:
-            results = results[:25]
+    def _load_term_indexes(self):
+        """
+        Loads the suggestion and completion indexes in the background: the terms are read from the FullTextIndex on
+        the DB worker and the indexes are built in the threadpool.
+        """
+        with self._term_lock:
+            if self._suggestion_index is not None or self._term_indexes_loading:
+                return
+            self._term_indexes_loading = True
+
+        def on_error(failure):
+            self._logger.error(u"Failed to load the search term indexes: %s", failure.getErrorMessage())
+            with self._term_lock:
+                self._term_indexes_loading = False
+                self._pending_term_changes = []
+            self._term_indexes_loaded.set()
+
+        # the temporary terms table only exists for the connection that created it, so both run on the DB worker
+        deferred = self._db.fetchall_async(self._get_terms_table_sql())
+        deferred.addCallback(lambda _: self._db.fetchall_async(self._get_terms_sql()))
+        deferred.addCallback(lambda rows: deferToThread(self._build_term_indexes, rows))
+        deferred.addErrback(on_error)
+        return deferred
+
+    def _wait_for_term_indexes(self):
+        """
+        Makes sure the term indexes are loaded. If the background load is running, this waits for it instead of
+        loading the terms a second time. The reactor thread cannot wait for the load, as it runs the load itself.
+        :return: True if the term indexes are available, False if they are still being loaded on the reactor thread or
+        failed to load.
+        """
+        with self._term_lock:
+            if self._suggestion_index is not None:
+                return True
+            loading = self._term_indexes_loading
 
-        return results
+        if not loading:
+            self._load_term_indexes_now()
+            return True
+        if isInIOThread():
+            return False
 
-    def getAutoCompleteTerms(self, keyword, max_terms, limit=100):
-        sql = "SELECT swarmname FROM FullTextIndex WHERE swarmname MATCH ? LIMIT ?"
-        result = self._db.fetchall(sql, (keyword + '*', limit))
+        self._term_indexes_loaded.wait()
+        return self._suggestion_index is not None
+
+    def _load_term_indexes_now(self):
+        self._db.execute(self._get_terms_table_sql())
+        self._build_term_indexes(self._db.fetchall(self._get_terms_sql()))
+
+    def _get_terms_table_sql(self):
+        # fts4aux exposes the term dictionary that SQLite maintains for the FullTextIndex, so it is persistent and
+        # always up to date without storing the terms a second time.
+        return u"CREATE VIRTUAL TABLE IF NOT EXISTS temp.FullTextIndexTerms USING fts4aux(main, FullTextIndex)"
+
+    def _get_terms_sql(self):
+        # column 0 of the FullTextIndex is the swarmname
+        return u"SELECT term, documents FROM temp.FullTextIndexTerms WHERE col = 0"
+
+    def _build_term_indexes(self, rows):
+        frequencies = dict(rows)
+        suggestion_index = TrigramIndex()
+        for term, frequency in frequencies.iteritems():
+            suggestion_index.add(term, frequency)
+        completion_index = CompletionIndex(frequencies)
+
+        with self._term_lock:
+            for terms, delta in self._pending_term_changes:
+                self._apply_term_changes(suggestion_index, completion_index, terms, delta)
+            self._pending_term_changes = []
+            self._term_indexes_loading = False
+            if self._suggestion_index is None:
+                self._suggestion_index = suggestion_index
+                self._completion_index = completion_index
+
+            self._logger.info(u"Loaded %d terms into the search term indexes", len(self._completion_index))
+        self._term_indexes_loaded.set()
+
+    def _update_indexed_terms(self, terms, delta):
+        """
+        Adds the terms of a swarmname to the term indexes (delta = 1) or removes them (delta = -1).
+        """
+        with self._term_lock:
+            if self._suggestion_index is not None:
+                self._apply_term_changes(self._suggestion_index, self._completion_index, terms, delta)
+            elif self._term_indexes_loading:
+                self._pending_term_changes.append((terms, delta))
+
+    @staticmethod
+    def _apply_term_changes(suggestion_index, completion_index, terms, delta):
+        for term in terms:
+            if delta > 0:
+                suggestion_index.add(term, delta)
+                completion_index.add(term, delta)
+            else:
+                suggestion_index.remove(term, -delta)
+                completion_index.remove(term, -delta)
 
-        all_terms = set()
-        for line, in result:
-            if len(all_terms) >= max_terms:
-                break
-            i1 = line.find(keyword)
-            i2 = line.find(' ', i1 + len(keyword))
-            all_terms.add(line[i1:i2] if i2 >= 0 else line[i1:])
+    def getSearchSuggestion(self, keywords, limit=1):
+        """
+        Returns up to limit swarmnames that are similar to keywords, as "did you mean" suggestions. The terms that are
+        within a few typos of every keyword are looked up in the suggestion index, and the swarmnames containing them
+        are ordered by how close their words are to the keywords.
+        """
+        match = [keyword.lower() for keyword in keywords if len(keyword) > 3]
+        if not match:
+            return []
 
-        if keyword in all_terms:
-            all_terms.remove(keyword)
-        if '' in all_terms:
-            all_terms.remove('')
+        if not self._wait_for_term_indexes():
+            return []
 
-        return list(all_terms)
+        # for every keyword, the similar terms and their distance to the keyword
+        similar_terms = []
+        with self._term_lock:
+            for keyword in match:
+                max_distance = get_max_edit_distance(keyword)
+                found = self._suggestion_index.find(keyword, max_distance, limit=SUGGESTION_TERMS_PER_KEYWORD)
+                similar_terms.append((dict((term, distance) for distance, term in found), max_distance + 1))
 
-    def getSearchSuggestion(self, keywords, limit=1):
-        match = [keyword.lower() for keyword in keywords if len(keyword) > 3]
+        terms = set(term for distances, _ in similar_terms for term in distances)
+        if not terms:
+            return []
 
-        def lev(a, b):
-            "Calculates the Levenshtein distance between a and b."
-            n, m = len(a), len(b)
-            if n > m:
-                # Make sure n <= m, to use O(min(n,m)) space
-                a, b = b, a
-                n, m = m, n
-
-            current = range(n + 1)
-            for i in range(1, m + 1):
-                previous, current = current, [i] + [0] * n
-                for j in range(1, n + 1):
-                    add, delete = previous[j] + 1, current[j - 1] + 1
-                    change = previous[j - 1]
-                    if a[j - 1] != b[i - 1]:
-                        change = change + 1
-                    current[j] = min(add, delete, change)
-
-            return current[n]
-
-        def levcollate(s1, s2):
-            l1 = sum(sorted([lev(a, b) for a in s1.split() for b in match])[:len(match)])
-            l2 = sum(sorted([lev(a, b) for a in s2.split() for b in match])[:len(match)])
-
-            # return -1 if s1<s2, +1 if s1>s2 else 0
-            if l1 < l2:
-                return -1
-            if l1 > l2:
-                return 1
-            return 0
+        sql = u"SELECT swarmname FROM FullTextIndex WHERE swarmname MATCH ? LIMIT ?"
+        candidates = [swarmname for swarmname, in self._db.fetchall(sql, (u" OR ".join(terms), SUGGESTION_CANDIDATES),
+                                                                    read_only=True)]
 
-        cursor = self._db.get_cursor()
-        connection = cursor.getconnection()
-        connection.createcollation("leven", levcollate)
+        def get_score(swarmname):
+            words = split_into_keywords(swarmname)
+            distance = sum(min([distances[word] for word in words if word in distances] or [no_match])
+                           for distances, no_match in similar_terms)
+            return distance, len(words)
 
-        sql = "SELECT swarmname FROM FullTextIndex WHERE swarmname MATCH ? ORDER By swarmname collate leven ASC LIMIT ?"
-        results = self._db.fetchall(sql, (' OR '.join(['*%s*' % m for m in match]), limit))
-        connection.createcollation("leven", None)
-        return [result[0] for result in results]
+        candidates.sort(key=get_score)
+        return candidates[:limit]
 
 
 class MyPreferenceDBHandler(BasicDBHandler):
@@ -1409,24 +1788,48 @@ ORDER BY CMD.time_stamp DESC LIMIT ?;
             self.notifier.notify(NTFY_CHANNELCAST, NTFY_MODIFIED, channel_id)
 
     def on_torrents_from_dispersy(self, torrentlist):
+        """
+        Adds a batch of channel torrents received by dispersy. The inserts run on the DB worker, so a large batch does
+        not block the reactor. The notifications are sent once the torrents have been added.
+        :return: A Deferred that fires when the torrents have been added.
+        """
+        def notify(result):
+            updated_channels, updated_channel_torrent_dict = result
+            for channel_id in updated_channels:
+                self.notifier.notify(NTFY_CHANNELCAST, NTFY_UPDATE, channel_id)
+
+            for channel_id, item in updated_channel_torrent_dict.items():
+                # inform the channel_manager about new channel torrents
+                self.notifier.notify(SIGNAL_CHANNEL_COMMUNITY, SIGNAL_ON_TORRENT_UPDATED, channel_id, item)
+
+        return self._db.defer_to_db_worker(self._add_torrents_from_dispersy, torrentlist).addCallback(notify)
+
+    def _add_torrents_from_dispersy(self, torrentlist):
+        """
+        Inserts the torrents of on_torrents_from_dispersy, this runs on the DB worker.
+        :return: A tuple with the updated channel ids and a dict mapping them to their new torrents.
+        """
         infohashes = [torrent[3] for torrent in torrentlist]
         torrent_ids, inserted = self.torrent_db.addOrGetTorrentIDSReturn(infohashes)
 
         insert_data = []
         updated_channels = {}
 
+        to_add = []
         for i, torrent in enumerate(torrentlist):
             channel_id, dispersy_id, peer_id, infohash, timestamp, name, files, trackers = torrent
             torrent_id = torrent_ids[i]
 
             # if new or not yet collected
             if infohash in inserted:
-                self.torrent_db.addExternalTorrentNoDef(
-                    infohash, name, files, trackers, timestamp, {'dispersy_id': dispersy_id})
+                to_add.append((infohash, name, files, trackers, timestamp, {'dispersy_id': dispersy_id}))
 
             insert_data.append((dispersy_id, torrent_id, channel_id, peer_id, name, timestamp))
             updated_channels[channel_id] = updated_channels.get(channel_id, 0) + 1
 
+        if to_add:
+            self.torrent_db.addExternalTorrentsNoDef(to_add)
+
         if len(insert_data) > 0:
             sql_insert_torrent = "INSERT INTO _ChannelTorrents (dispersy_id, torrent_id, channel_id, peer_id, name, time_stamp) VALUES (?,?,?,?,?,?)"
             self._db.executemany(sql_insert_torrent, insert_data)
@@ -1442,12 +1845,7 @@ ORDER BY CMD.time_stamp DESC LIMIT ?;
         update_channels = [(new_torrents, channel_id) for channel_id, new_torrents in updated_channels.iteritems()]
         self._db.executemany(sql_update_channel, update_channels)
 
-        for channel_id in updated_channels.keys():
-            self.notifier.notify(NTFY_CHANNELCAST, NTFY_UPDATE, channel_id)
-
-        for channel_id, item in updated_channel_torrent_dict.items():
-            # inform the channel_manager about new channel torrents
-            self.notifier.notify(SIGNAL_CHANNEL_COMMUNITY, SIGNAL_ON_TORRENT_UPDATED, channel_id, item)
+        return updated_channels.keys(), updated_channel_torrent_dict
 
     def on_remove_torrent_from_dispersy(self, channel_id, dispersy_id, redo):
         sql = "UPDATE _ChannelTorrents SET deleted_at = ? WHERE channel_id = ? and dispersy_id = ?"
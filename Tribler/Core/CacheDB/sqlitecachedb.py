@@ -2,12 +2,17 @@
 # see LICENSE.txt for license information
 import logging
 import os
+from Queue import Queue, Empty
 from base64 import encodestring, decodestring
-from threading import currentThread, RLock
+from contextlib import contextmanager
+from threading import currentThread, RLock, Lock
 
 import apsw
 from apsw import CantOpenError, SQLError
-from twisted.python.threadable import isInIOThread
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThreadPool, deferToThread
+from twisted.python.threadpool import ThreadPool
 
 from Tribler.dispersy.taskmanager import TaskManager
 from Tribler.dispersy.util import blocking_call_on_reactor_thread, call_on_reactor_thread
@@ -26,6 +31,10 @@ DB_FILE_RELATIVE_PATH = os.path.join(DB_DIR_NAME, DB_FILE_NAME)
 
 DEFAULT_BUSY_TIMEOUT = 10000
 
+DB_WORKER_NAME = u"SQLiteCacheDB"
+
+DEFAULT_READ_POOL_SIZE = 4
+
 TRHEADING_DEBUG = False
 
 forceDBThread = call_on_reactor_thread
@@ -44,9 +53,133 @@ def str2bin(str_data):
     return decodestring(str_data)
 
 
+class ReadConnectionPool(object):
+    """
+    A bounded pool of read-only connections to a database in WAL mode. In WAL mode readers do not block the writer
+    (nor each other), so queries on these connections run concurrently with the main connection. Note that a read-only
+    connection only sees data that has been committed by the main connection, i.e. the database as of the last
+    periodic commit_now.
+    """
+
+    def __init__(self, db_path, size, busytimeout=DEFAULT_BUSY_TIMEOUT):
+        assert size > 0, u"Invalid pool size: %s" % size
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self._db_path = db_path
+        self._size = size
+        self._busytimeout = busytimeout
+
+        self._lock = Lock()
+        self._idle_connections = Queue()
+        self._num_connections = 0
+        self._closed = False
+
+        # SQL functions that have to be available on every connection, and the ones registered on each connection
+        self._functions = {}
+        self._connection_functions = {}
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def num_connections(self):
+        """The number of connections that have been opened so far, this never exceeds the size of the pool."""
+        return self._num_connections
+
+    def _open_connection(self):
+        connection = apsw.Connection(self._db_path, flags=apsw.SQLITE_OPEN_READONLY)
+        connection.setbusytimeout(self._busytimeout)
+        cursor = connection.cursor()
+        cursor.execute(u"PRAGMA query_only = ON;")
+        cursor.close()
+        return connection
+
+    def register_function(self, name, func, num_args):
+        """
+        Makes a scalar SQL function available on all connections in this pool. Connections get it the next time they
+        are acquired.
+        """
+        with self._lock:
+            self._functions[name] = (func, num_args)
+            self._connection_functions = {}
+
+    def _register_functions(self, connection):
+        with self._lock:
+            registered = self._connection_functions.setdefault(connection, set())
+            missing = [(name, func, num_args) for name, (func, num_args) in self._functions.iteritems()
+                       if name not in registered]
+            registered.update(name for name, _, _ in missing)
+
+        for name, func, num_args in missing:
+            connection.createscalarfunction(name, func, num_args)
+
+    def _acquire(self):
+        """
+        Takes an idle connection from the pool. New connections are opened lazily until the pool is full, after
+        which this blocks until another thread releases one.
+        """
+        with self._lock:
+            if self._closed:
+                raise CantOpenError(u"The read connection pool of %s is closed" % self._db_path)
+            try:
+                return self._idle_connections.get_nowait()
+            except Empty:
+                should_open = self._num_connections < self._size
+                if should_open:
+                    self._num_connections += 1
+
+        if not should_open:
+            return self._idle_connections.get()
+
+        try:
+            return self._open_connection()
+        except:
+            with self._lock:
+                self._num_connections -= 1
+            raise
+
+    def _release(self, connection):
+        with self._lock:
+            if not self._closed:
+                self._idle_connections.put(connection)
+                return
+            self._num_connections -= 1
+            self._connection_functions.pop(connection, None)
+        connection.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that lends a read-only connection to the calling thread.
+        """
+        connection = self._acquire()
+        try:
+            self._register_functions(connection)
+            yield connection
+        finally:
+            self._release(connection)
+
+    def close(self):
+        """
+        Closes all idle connections, connections that are still in use are closed when they are released.
+        """
+        with self._lock:
+            self._closed = True
+            while True:
+                try:
+                    connection = self._idle_connections.get_nowait()
+                except Empty:
+                    break
+                connection.close()
+                self._num_connections -= 1
+            self._connection_functions = {}
+
+
 class SQLiteCacheDB(TaskManager):
 
-    def __init__(self, db_path, db_script_path=None, busytimeout=DEFAULT_BUSY_TIMEOUT):
+    def __init__(self, db_path, db_script_path=None, busytimeout=DEFAULT_BUSY_TIMEOUT,
+                 read_pool_size=DEFAULT_READ_POOL_SIZE):
         super(SQLiteCacheDB, self).__init__()
 
         self._logger = logging.getLogger(self.__class__.__name__)
@@ -64,6 +197,16 @@ class SQLiteCacheDB(TaskManager):
         self._should_commit = False
         self._show_execute = False
 
+        # The DB worker is a single thread that owns the connection: every statement on it, reads and writes, runs on
+        # this thread in the order in which it was submitted. See _start_db_worker.
+        self._db_worker = None
+        self._db_worker_ident = None
+
+        self._read_pool_size = read_pool_size
+        self._read_pool = None
+
+        self._functions = {}
+
     @property
     def version(self):
         """The version of this database."""
@@ -86,12 +229,25 @@ class SQLiteCacheDB(TaskManager):
         # open a connection to the database
         self._open_connection()
 
+        self._start_db_worker()
+
+        # an in-memory database only exists for its own connection, so it cannot be shared with readers
+        if self._read_pool_size > 0 and self.sqlite_db_path != u":memory:":
+            self._read_pool = ReadConnectionPool(self.sqlite_db_path, self._read_pool_size, self._busytimeout)
+            for name, (func, num_args) in self._functions.iteritems():
+                self._read_pool.register_function(name, func, num_args)
+
     @blocking_call_on_reactor_thread
     def close(self):
         """
-        Cancels all pending tasks and closes all cursors. Then, it closes the connection.
+        Cancels all pending tasks, waits for the DB worker to finish and closes all cursors. Then, it closes the
+        connection.
         """
         self.cancel_all_pending_tasks()
+        self._stop_db_worker()
+        if self._read_pool is not None:
+            self._read_pool.close()
+            self._read_pool = None
         with self._cursor_lock:
             for cursor in self._cursor_table.itervalues():
                 cursor.close()
@@ -188,6 +344,74 @@ class SQLiteCacheDB(TaskManager):
         else:
             self._version = 1
 
+    def _start_db_worker(self):
+        """
+        Starts the DB worker, the single writer of the database. From now on all statements on the connection run on
+        this thread: the synchronous API waits for the worker, while the Deferred-returning API and defer_to_db_worker
+        only queue their work, so the reactor does not wait for them.
+        """
+        self._db_worker = ThreadPool(minthreads=1, maxthreads=1, name=DB_WORKER_NAME)
+        self._db_worker.start()
+        self._db_worker_ident = self._blocking_call_on_db_worker(lambda: currentThread().ident)
+
+    def _stop_db_worker(self):
+        """
+        Stops the DB worker, this blocks until all the work it has queued has been done.
+        """
+        if self._db_worker is not None:
+            self._db_worker.stop()
+            self._db_worker = None
+            self._db_worker_ident = None
+
+    def _is_on_db_worker(self):
+        """
+        :return: True if the calling thread may use the connection directly, i.e. it is the DB worker or the DB worker
+        is not running.
+        """
+        return self._db_worker is None or currentThread().ident == self._db_worker_ident
+
+    def _blocking_call_on_db_worker(self, func, *args, **kwargs):
+        """
+        Runs func on the DB worker and waits for its result. On the DB worker itself, func is called directly.
+        """
+        if self._is_on_db_worker():
+            return func(*args, **kwargs)
+
+        results = Queue(1)
+        self._db_worker.callInThreadWithCallback(lambda success, result: results.put((success, result)),
+                                                 func, *args, **kwargs)
+        success, result = results.get()
+        if not success:
+            result.raiseException()
+        return result
+
+    def _defer_to_db_worker(self, func, *args, **kwargs):
+        """
+        Runs func on the DB worker thread.
+        :return: A Deferred that fires with the result of func once it has been executed.
+        """
+        assert self._db_worker is not None, u"The DB worker is not running"
+        return deferToThreadPool(reactor, self._db_worker, func, *args, **kwargs)
+
+    def defer_to_db_worker(self, func, *args, **kwargs):
+        """
+        Runs func on the DB worker thread, after the work that has been queued before it. func may use the
+        synchronous API (e.g. execute, fetchall or a DB handler), which then runs without waiting on any thread.
+        :return: A Deferred that fires with the result of func once it has been executed.
+        """
+        return self._defer_to_db_worker(func, *args, **kwargs)
+
+    def register_function(self, name, func, num_args):
+        """
+        Registers a Python function as a scalar SQL function on the main connection and on the read-only connections.
+        Note that the function may be called from any thread that runs queries.
+        """
+        self._functions[name] = (func, num_args)
+        if self._connection is not None:
+            self._blocking_call_on_db_worker(self._connection.createscalarfunction, name, func, num_args)
+        if self._read_pool is not None:
+            self._read_pool.register_function(name, func, num_args)
+
     def get_cursor(self):
         thread_name = currentThread().getName()
 
@@ -196,7 +420,6 @@ class SQLiteCacheDB(TaskManager):
                 self._cursor_table[thread_name] = self._connection.cursor()
             return self._cursor_table[thread_name]
 
-    @blocking_call_on_reactor_thread
     def initial_begin(self):
         try:
             self._logger.info(u"Beginning the first transaction...")
@@ -207,19 +430,29 @@ class SQLiteCacheDB(TaskManager):
             raise
         self._should_commit = False
 
-    @blocking_call_on_reactor_thread
     def write_version(self, version):
         assert isinstance(version, int), u"Invalid version type: %s is not int" % type(version)
         assert version <= LATEST_DB_VERSION, u"Invalid version value: %s > the latest %s" % (version, LATEST_DB_VERSION)
 
         sql = u"UPDATE MyInfo SET value = ? WHERE entry == 'version'"
         self.execute_write(sql, (version,))
-        self.commit_now()
+        self._blocking_call_on_db_worker(self._commit_now)
         self._version = version
 
-    @call_on_reactor_thread
     def commit_now(self, vacuum=False, exiting=False):
-        if self._should_commit and isInIOThread():
+        """
+        Commits the pending writes and begins a new transaction. When called from another thread than the DB worker,
+        the commit is queued on the DB worker after the statements that were submitted before it.
+        :return: A Deferred that fires once the commit is done.
+        """
+        if self._is_on_db_worker():
+            return succeed(self._commit_now(vacuum, exiting))
+
+        # _commit_now logs its errors, and the periodic callers are not interested in them
+        return self._defer_to_db_worker(self._commit_now, vacuum, exiting).addErrback(lambda _: None)
+
+    def _commit_now(self, vacuum=False, exiting=False):
+        if self._should_commit:
             try:
                 self._logger.info(u"Start committing...")
                 self.execute(u"COMMIT;")
@@ -258,9 +491,14 @@ class SQLiteCacheDB(TaskManager):
 
     # --------- generic functions -------------
 
-    @blocking_call_on_reactor_thread
     def execute(self, sql, args=None):
-        cur = self.get_cursor()
+        if self._is_on_db_worker():
+            return self._execute(sql, args)
+        # the cursor is used by all work on the DB worker, so the rows are read before the worker continues
+        return iter(self._blocking_call_on_db_worker(lambda: list(self._execute(sql, args) or [])))
+
+    def _execute(self, sql, args=None, cursor=None):
+        cur = cursor or self.get_cursor()
 
         if self._show_execute:
             thread_name = currentThread().getName()
@@ -283,8 +521,12 @@ class SQLiteCacheDB(TaskManager):
 
             raise msg
 
-    @blocking_call_on_reactor_thread
     def executemany(self, sql, args=None):
+        if self._is_on_db_worker():
+            return self._executemany(sql, args)
+        return iter(self._blocking_call_on_db_worker(lambda: list(self._executemany(sql, args) or [])))
+
+    def _executemany(self, sql, args=None):
         self._should_commit = True
 
         cur = self.get_cursor()
@@ -314,6 +556,23 @@ class SQLiteCacheDB(TaskManager):
 
         self.execute(sql, args)
 
+    @contextmanager
+    def transaction(self, name=u"batch"):
+        """
+        Groups the statements executed in the with-block into a single savepoint, which is rolled back if the block
+        raises. This works both inside the long running transaction started by initial_begin and outside of it. Use it
+        on the DB worker (see defer_to_db_worker), elsewhere work queued by other threads may end up in the savepoint.
+        """
+        self.execute_write(u"SAVEPOINT %s" % name)
+        try:
+            yield
+        except:
+            self.execute(u"ROLLBACK TO %s" % name)
+            self.execute(u"RELEASE %s" % name)
+            raise
+        else:
+            self.execute(u"RELEASE %s" % name)
+
     def insert_or_ignore(self, table_name, **argv):
         if len(argv) == 1:
             sql = u'INSERT OR IGNORE INTO %s (%s) VALUES (?);' % (table_name, argv.keys()[0])
@@ -377,9 +636,29 @@ class SQLiteCacheDB(TaskManager):
         result = self.fetchone(num_rec_sql)
         return result
 
-    @blocking_call_on_reactor_thread
-    def fetchone(self, sql, args=None):
-        find = self.execute_read(sql, args)
+    def fetchone(self, sql, args=None, read_only=False):
+        """
+        :param read_only: If True and a read connection pool is available, the query runs on a read-only connection
+        in the calling thread, so it does not wait for the DB worker. It sees the database as of the last commit, not
+        the writes that are still pending. Note that the calling thread still waits for the query, so the reactor
+        should use fetchone_async instead.
+        """
+        if read_only and self._read_pool is not None:
+            return self._fetch_read_only(self._fetchone, sql, args)
+        return self._blocking_call_on_db_worker(self._fetchone, sql, args)
+
+    def fetchone_async(self, sql, args=None, read_only=False):
+        """
+        Same as fetchone, but runs on the DB worker, where it sees the pending writes as well, or on a pooled
+        read-only connection in the reactor threadpool if read_only is True.
+        :return: A Deferred that fires with the result of fetchone.
+        """
+        if read_only and self._read_pool is not None:
+            return deferToThread(self._fetch_read_only, self._fetchone, sql, args)
+        return self._defer_to_db_worker(self._fetchone, sql, args)
+
+    def _fetchone(self, sql, args=None, cursor=None):
+        find = self._execute(sql, args, cursor)
         if not find:
             return
         else:
@@ -396,18 +675,59 @@ class SQLiteCacheDB(TaskManager):
         else:
             return find[0]
 
-    @blocking_call_on_reactor_thread
-    def fetchall(self, sql, args=None):
-        res = self.execute_read(sql, args)
+    def fetchall(self, sql, args=None, read_only=False):
+        """
+        :param read_only: If True and a read connection pool is available, the query runs on a read-only connection
+        in the calling thread, so it does not wait for the DB worker. It sees the database as of the last commit, not
+        the writes that are still pending. Note that the calling thread still waits for the query, so the reactor
+        should use fetchall_async instead.
+        """
+        if read_only and self._read_pool is not None:
+            return self._fetch_read_only(self._fetchall, sql, args)
+        return self._blocking_call_on_db_worker(self._fetchall, sql, args)
+
+    def fetchall_async(self, sql, args=None, read_only=False):
+        """
+        Same as fetchall, but runs on the DB worker, where it sees the pending writes as well, or on a pooled
+        read-only connection in the reactor threadpool if read_only is True.
+        :return: A Deferred that fires with the list of resulting rows.
+        """
+        if read_only and self._read_pool is not None:
+            return deferToThread(self._fetch_read_only, self._fetchall, sql, args)
+        return self._defer_to_db_worker(self._fetchall, sql, args)
+
+    def _fetchall(self, sql, args=None, cursor=None):
+        res = self._execute(sql, args, cursor)
         if res is not None:
             find = list(res)
             return find
         else:
             return []  # should it return None?
 
+    def _fetch_read_only(self, fetch_func, sql, args=None):
+        """
+        Runs fetch_func (either _fetchone or _fetchall) on a connection borrowed from the read pool.
+        """
+        with self._read_pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                return fetch_func(sql, args, cursor)
+            finally:
+                cursor.close()
+
     def getOne(self, table_name, value_name, where=None, conj=u"AND", **kw):
         """ value_name could be a string, a tuple of strings, or '*'
         """
+        sql, arg = self._build_get_one_sql(table_name, value_name, where=where, conj=conj, **kw)
+        return self.fetchone(sql, arg)
+
+    def getOneAsync(self, table_name, value_name, where=None, conj=u"AND", **kw):
+        """ Same as getOne, but returns a Deferred that fires with the result.
+        """
+        sql, arg = self._build_get_one_sql(table_name, value_name, where=where, conj=conj, **kw)
+        return self.fetchone_async(sql, arg)
+
+    def _build_get_one_sql(self, table_name, value_name, where=None, conj=u"AND", **kw):
         if isinstance(value_name, tuple):
             value_names = u",".join(value_name)
         elif isinstance(value_name, list):
@@ -445,8 +765,7 @@ class SQLiteCacheDB(TaskManager):
         else:
             arg = None
 
-        # print >> sys.stderr, 'SQL: %s %s' % (sql, arg)
-        return self.fetchone(sql, arg)
+        return sql, arg
 
     def getAll(self, table_name, value_name, where=None, group_by=None, having=None, order_by=None, limit=None,
                offset=None, conj=u"AND", **kw):
@@ -454,6 +773,29 @@ class SQLiteCacheDB(TaskManager):
             order by is represented as order_by
             group by is represented as group_by
         """
+        sql, arg = self._build_get_all_sql(table_name, value_name, where=where, group_by=group_by, having=having,
+                                           order_by=order_by, limit=limit, offset=offset, conj=conj, **kw)
+        try:
+            return self.fetchall(sql, arg) or []
+        except Exception as msg:
+            self._logger.exception(u"Wrong getAll sql statement: %s", sql)
+            raise Exception(msg)
+
+    def getAllAsync(self, table_name, value_name, where=None, group_by=None, having=None, order_by=None, limit=None,
+                    offset=None, conj=u"AND", **kw):
+        """ Same as getAll, but returns a Deferred that fires with the list of rows.
+        """
+        sql, arg = self._build_get_all_sql(table_name, value_name, where=where, group_by=group_by, having=having,
+                                           order_by=order_by, limit=limit, offset=offset, conj=conj, **kw)
+
+        def on_error(failure):
+            self._logger.error(u"Wrong getAll sql statement: %s", sql)
+            return failure
+
+        return self.fetchall_async(sql, arg).addErrback(on_error)
+
+    def _build_get_all_sql(self, table_name, value_name, where=None, group_by=None, having=None, order_by=None,
+                           limit=None, offset=None, conj=u"AND", **kw):
         if isinstance(value_name, tuple):
             value_names = u",".join(value_name)
         elif isinstance(value_name, list):
@@ -504,8 +846,4 @@ class SQLiteCacheDB(TaskManager):
         if offset is not None:
             sql += u' OFFSET %d' % offset
 
-        try:
-            return self.fetchall(sql, arg) or []
-        except Exception as msg:
-            self._logger.exception(u"Wrong getAll sql statement: %s", sql)
-            raise Exception(msg)
+        return sql, arg
@@ -145,6 +145,16 @@ class LibtorrentDownloadImpl(DownloadConfigInterface):
 
         self.correctedinfoname = u""
 
+        # the handlers of the alerts that are used by process_alert, all other alerts update the statistics
+        self.alert_handlers = {'tracker_reply_alert': self.on_tracker_reply_alert,
+                               'tracker_error_alert': self.on_tracker_error_alert,
+                               'tracker_warning_alert': self.on_tracker_warning_alert,
+                               'metadata_received_alert': self.on_metadata_received_alert,
+                               'file_renamed_alert': self.on_file_renamed_alert,
+                               'performance_alert': self.on_performance_alert,
+                               'torrent_checked_alert': self.on_torrent_checked_alert,
+                               'torrent_finished_alert': self.on_torrent_finished_alert}
+
     def __str__(self):
         return "LibtorrentDownloadImpl <name: '%s' hops: %d>" % (self.correctedinfoname, self.get_hops())
 
@@ -439,11 +449,9 @@ class LibtorrentDownloadImpl(DownloadConfigInterface):
         if alert.category() in [lt.alert.category_t.error_notification, lt.alert.category_t.performance_warning]:
             self._logger.debug("LibtorrentDownloadImpl: alert %s with message %s", alert_type, alert)
 
-        alert_types = ('tracker_reply_alert', 'tracker_error_alert', 'tracker_warning_alert', 'metadata_received_alert',
-                       'file_renamed_alert', 'performance_alert', 'torrent_checked_alert', 'torrent_finished_alert')
-
-        if alert_type in alert_types:
-            getattr(self, 'on_' + alert_type)(alert)
+        handler = self.alert_handlers.get(alert_type)
+        if handler:
+            handler(alert)
         else:
             self.update_lt_stats()
 
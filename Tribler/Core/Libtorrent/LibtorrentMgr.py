@@ -7,7 +7,7 @@ import threading
 import os
 import time
 from binascii import hexlify
-from copy import deepcopy
+from collections import OrderedDict
 from shutil import rmtree
 
 from twisted.internet import reactor
@@ -28,8 +28,25 @@ from Tribler.dispersy.util import blocking_call_on_reactor_thread, call_on_react
 
 LTSTATE_FILENAME = "lt.state"
 METAINFO_CACHE_PERIOD = 5 * 60
+METAINFO_CACHE_MAX_SIZE = 16 * 1024 * 1024
 DHT_CHECK_RETRIES = 1
 
+# the alert categories used by LibtorrentDownloadImpl.process_alert, the stats alerts update the download statistics
+# and the error and performance alerts are logged
+ALERT_MASK = (lt.alert.category_t.stats_notification |
+              lt.alert.category_t.error_notification |
+              lt.alert.category_t.status_notification |
+              lt.alert.category_t.storage_notification |
+              lt.alert.category_t.performance_warning |
+              lt.alert.category_t.tracker_notification)
+
+# the alerts are polled faster when libtorrent posts at least ALERT_POLL_BUSY_THRESHOLD alerts between two polls, and
+# slower when it posts none
+ALERT_POLL_INTERVAL = 1.0
+ALERT_POLL_INTERVAL_MIN = 0.25
+ALERT_POLL_INTERVAL_MAX = 4.0
+ALERT_POLL_BUSY_THRESHOLD = 250
+
 
 class LibtorrentMgr(TaskManager):
 
@@ -51,10 +68,12 @@ class LibtorrentMgr(TaskManager):
 
         self.dht_ready = False
 
+        self.alert_poll_interval = ALERT_POLL_INTERVAL
+
         self.metadata_tmpdir = None
         self.metainfo_requests = {}
         self.metainfo_lock = threading.RLock()
-        self.metainfo_cache = {}
+        self.metainfo_cache = MetainfoCache()
 
     @blocking_call_on_reactor_thread
     def initialize(self):
@@ -131,12 +150,7 @@ class LibtorrentMgr(TaskManager):
             ltsession.add_extension(lt.create_smart_ban_plugin)
 
         ltsession.set_settings(settings)
-        ltsession.set_alert_mask(lt.alert.category_t.stats_notification |
-                                 lt.alert.category_t.error_notification |
-                                 lt.alert.category_t.status_notification |
-                                 lt.alert.category_t.storage_notification |
-                                 lt.alert.category_t.performance_warning |
-                                 lt.alert.category_t.tracker_notification)
+        ltsession.set_alert_mask(ALERT_MASK)
 
         # Load proxy settings
         if hops == 0:
@@ -309,13 +323,12 @@ class LibtorrentMgr(TaskManager):
             self._logger.warning("port mapping method not exposed in libtorrent")
 
     def process_alert(self, alert):
-        alert_type = str(type(alert)).split("'")[1].split(".")[-1]
         handle = getattr(alert, 'handle', None)
         if handle:
             if handle.is_valid():
                 infohash = str(handle.info_hash())
                 if infohash in self.torrents:
-                    self.torrents[infohash][0].process_alert(alert, alert_type)
+                    self.torrents[infohash][0].process_alert(alert, type(alert).__name__)
                 elif infohash in self.metainfo_requests:
                     if isinstance(alert, lt.metadata_received_alert):
                         self.got_metainfo(infohash)
@@ -343,7 +356,7 @@ class LibtorrentMgr(TaskManager):
 
             cache_result = self._get_cached_metainfo(infohash)
             if cache_result:
-                self.trsession.lm.threadpool.call_in_thread(0, callback, deepcopy(cache_result))
+                self.trsession.lm.threadpool.call_in_thread(0, callback, cache_result)
 
             elif infohash not in self.metainfo_requests:
                 # Flags = 4 (upload mode), should prevent libtorrent from creating files
@@ -423,13 +436,18 @@ class LibtorrentMgr(TaskManager):
 
                         self._add_cached_metainfo(infohash, metainfo)
 
+                        # every callback gets its own copy, decoded from the bencoded metainfo
+                        encoded_metainfo = encode_metainfo(metainfo)
                         for callback in callbacks:
-                            self.trsession.lm.threadpool.call_in_thread(0, callback, deepcopy(metainfo))
+                            self.trsession.lm.threadpool.call_in_thread(0, callback,
+                                                                        decode_metainfo(*encoded_metainfo))
 
-                        # let's not print the hashes of the pieces
-                        debuginfo = deepcopy(metainfo)
-                        del debuginfo['info']['pieces']
-                        self._logger.debug('got_metainfo result %s', debuginfo)
+                        if self._logger.isEnabledFor(logging.DEBUG):
+                            # let's not print the hashes of the pieces
+                            debuginfo = dict(metainfo)
+                            debuginfo['info'] = dict(metainfo['info'])
+                            del debuginfo['info']['pieces']
+                            self._logger.debug('got_metainfo result %s', debuginfo)
 
                     elif timeout_callbacks and timeout:
                         for callback in timeout_callbacks:
@@ -441,28 +459,39 @@ class LibtorrentMgr(TaskManager):
                         self.notifier.notify(NTFY_TORRENTS, NTFY_MAGNET_CLOSE, infohash_bin)
 
     def _get_cached_metainfo(self, infohash):
-        if infohash in self.metainfo_cache:
-            return self.metainfo_cache[infohash]['meta_info']
+        return self.metainfo_cache.get(infohash)
 
     def _add_cached_metainfo(self, infohash, metainfo):
-        self.metainfo_cache[infohash] = {'time': time.time(),
-                                         'meta_info': metainfo}
+        self.metainfo_cache.put(infohash, metainfo)
 
     def _task_cleanup_metainfo_cache(self):
-        oldest_time = time.time() - METAINFO_CACHE_PERIOD
-
-        for info_hash, values in self.metainfo_cache.items():
-            last_time, metainfo = values
-            if last_time < oldest_time:
-                del self.metainfo_cache[info_hash]
+        with self.metainfo_lock:
+            self.metainfo_cache.remove_expired()
 
     def _task_process_alerts(self):
+        num_alerts = 0
         for ltsession in self.ltsessions.itervalues():
             if ltsession:
-                for alert in ltsession.pop_alerts():
+                alerts = ltsession.pop_alerts()
+                num_alerts += len(alerts)
+                for alert in alerts:
                     self.process_alert(alert)
 
-        self.register_task(u'process_alerts', reactor.callLater(1, self._task_process_alerts))
+        self.alert_poll_interval = self._get_alert_poll_interval(num_alerts)
+        self.register_task(u'process_alerts', reactor.callLater(self.alert_poll_interval, self._task_process_alerts))
+
+    def _get_alert_poll_interval(self, num_alerts):
+        """
+        Halves the poll interval when libtorrent is busy and doubles it when it is idle, otherwise the interval moves
+        back to ALERT_POLL_INTERVAL.
+        """
+        if num_alerts >= ALERT_POLL_BUSY_THRESHOLD:
+            return max(ALERT_POLL_INTERVAL_MIN, self.alert_poll_interval / 2)
+        if num_alerts == 0:
+            return min(ALERT_POLL_INTERVAL_MAX, self.alert_poll_interval * 2)
+        if self.alert_poll_interval < ALERT_POLL_INTERVAL:
+            return min(ALERT_POLL_INTERVAL, self.alert_poll_interval * 2)
+        return max(ALERT_POLL_INTERVAL, self.alert_poll_interval / 2)
 
     def _task_check_reachability(self):
         if self.get_session() and self.get_session().status().has_incoming_connections:
@@ -590,6 +619,104 @@ class LibtorrentMgr(TaskManager):
 
         return result
 
+
+def encode_metainfo(metainfo):
+    """
+    Bencodes metainfo. The initial peers are (ip, port) tuples, which bencoding would turn into lists, so they are
+    kept aside.
+    :return: A tuple with the bencoded metainfo and the initial peers, or None if there are none.
+    """
+    peers = metainfo.get("initial peers")
+    if peers is not None:
+        metainfo = dict(metainfo)
+        del metainfo["initial peers"]
+    return lt.bencode(metainfo), peers
+
+
+def decode_metainfo(encoded_metainfo, peers):
+    """
+    Decodes the result of encode_metainfo into a new metainfo dictionary.
+    """
+    metainfo = lt.bdecode(encoded_metainfo)
+    if peers is not None:
+        metainfo["initial peers"] = list(peers)
+    return metainfo
+
+
+class MetainfoCache(object):
+    """
+    A LRU cache for the metainfo retrieved through the DHT. The metainfo is stored bencoded and decoded on every hit,
+    so callers get their own copy. Entries expire max_age seconds after they have been added and the least recently
+    used entries are evicted once the bencoded metainfo takes up more than max_size bytes.
+    """
+
+    def __init__(self, max_size=METAINFO_CACHE_MAX_SIZE, max_age=METAINFO_CACHE_PERIOD):
+        self.max_size = max_size
+        self.max_age = max_age
+
+        self._entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, infohash):
+        return infohash in self._entries
+
+    def get(self, infohash):
+        """
+        :return: The decoded metainfo of infohash, or None if it is not cached or has expired.
+        """
+        entry = self._entries.pop(infohash, None)
+        if entry is not None and entry[0] < time.time() - self.max_age:
+            self._remove_entry(entry)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries[infohash] = entry
+        self.hits += 1
+        return decode_metainfo(entry[1], entry[2])
+
+    def put(self, infohash, metainfo):
+        encoded_metainfo, peers = encode_metainfo(metainfo)
+
+        old_entry = self._entries.pop(infohash, None)
+        if old_entry is not None:
+            self.size -= len(old_entry[1])
+
+        if len(encoded_metainfo) > self.max_size:
+            return
+
+        self._entries[infohash] = (time.time(), encoded_metainfo, peers)
+        self.size += len(encoded_metainfo)
+
+        while self.size > self.max_size:
+            _, entry = self._entries.popitem(last=False)
+            self._remove_entry(entry)
+
+    def remove_expired(self):
+        oldest_time = time.time() - self.max_age
+        for infohash, entry in self._entries.items():
+            if entry[0] < oldest_time:
+                del self._entries[infohash]
+                self._remove_entry(entry)
+
+    def get_stats(self):
+        return {'entries': len(self._entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def _remove_entry(self, entry):
+        self.size -= len(entry[1])
+        self.evictions += 1
+
+
 def encode_atp(atp):
     for k, v in atp.iteritems():
         if isinstance(v, unicode):
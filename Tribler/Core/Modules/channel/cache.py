@@ -7,39 +7,65 @@ import os
 class SimpleCache(object):
     """
     This is a cache for recording the keys that we have seen before.
+
+    The keys are stored one JSON string per line, so saving only appends the keys that were added since the last save.
+    Cache files in the old format, a single JSON list, are still loaded and are rewritten on the next save.
     """
     def __init__(self, file_path):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._file_path = file_path
 
-        self._cache_list = list()
-        self._initial_cache_size = 0
+        self._cache_set = set()
+        self._unsaved_keys = []
+        self._rewrite = False
 
     def add(self, key):
         if not self.has(key):
-            self._cache_list.append(key)
+            self._cache_set.add(key)
+            self._unsaved_keys.append(key)
 
     def has(self, key):
-        return key in self._cache_list
+        return key in self._cache_set
 
     def load(self):
+        self._cache_set = set()
+        self._unsaved_keys = []
+        self._rewrite = False
+
         if os.path.exists(self._file_path):
             try:
                 with codecs.open(self._file_path, 'rb', encoding='utf-8') as f:
-                    self._cache_list = json.load(f)
+                    content = f.read()
+
+                if content.lstrip().startswith(u'['):
+                    self._cache_set = set(json.loads(content))
+                    self._rewrite = True
+                else:
+                    self._load_lines(content.splitlines())
             except Exception as e:
                 self._logger.error(u"Failed to load cache file %s: %s", self._file_path, repr(e))
-        else:
-            self._cache_list = list()
-        self._initial_cache_size = len(self._cache_list)
+
+    def _load_lines(self, lines):
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                self._cache_set.add(json.loads(line))
+            except ValueError:
+                # e.g. the last line was truncated when Tribler was killed while saving. The next keys would be
+                # appended to that line, so the whole file is written again on the next save.
+                self._logger.warning(u"Skipping invalid line in cache file %s: %s", self._file_path, repr(line))
+                self._rewrite = True
 
     def save(self):
-        if self._initial_cache_size == len(self._cache_list):
+        if not self._unsaved_keys and not self._rewrite:
             return
         try:
-            with codecs.open(self._file_path, 'wb', encoding='utf-8') as f:
-                json.dump(self._cache_list, f)
-                self._initial_cache_size = len(self._cache_list)
+            keys = self._cache_set if self._rewrite else self._unsaved_keys
+            with codecs.open(self._file_path, 'wb' if self._rewrite else 'ab', encoding='utf-8') as f:
+                f.write(u''.join(json.dumps(key) + u'\n' for key in keys))
+            self._unsaved_keys = []
+            self._rewrite = False
         except Exception as e:
             self._logger.error(u"Failed to save cache file %s: %s", self._file_path, repr(e))
             return
@@ -9,6 +9,8 @@ import re
 import feedparser
 
 from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.threads import deferToThread
 from twisted.web.client import getPage
 
 from Tribler.dispersy.taskmanager import TaskManager
@@ -20,6 +22,9 @@ from Tribler.Core.TorrentDef import TorrentDef
 from Tribler.Core.Modules.channel.cache import SimpleCache
 
 DEFAULT_CHECK_INTERVAL = 1800  # half an hour
+MAX_CONCURRENT_DOWNLOADS = 4  # torrent and thumbnail downloads running at the same time
+TORRENT_BATCH_SIZE = 50  # create the channel torrents once this many torrents have been downloaded
+TORRENT_BATCH_DELAY = 5  # or when this many seconds have passed since the first one
 
 
 class ChannelRssParser(TaskManager):
@@ -38,6 +43,16 @@ class ChannelRssParser(TaskManager):
 
         self._pending_metadata_requests = {}
 
+        # the feed is only downloaded again when it has changed (conditional GET)
+        self._feed_etag = None
+        self._feed_modified = None
+
+        self._download_semaphore = DeferredSemaphore(MAX_CONCURRENT_DOWNLOADS)
+        self._pending_torrent_urls = set()
+        self._pending_torrents = []
+        # torrent URL -> RSS item of the torrents that failed to download, they are retried on the next scrape
+        self._failed_rss_items = {}
+
         self._to_stop = False
 
     @blocking_call_on_reactor_thread
@@ -84,27 +99,76 @@ class ChannelRssParser(TaskManager):
         self.session = None
 
     def _task_scrape(self):
+        # downloading and parsing the feed blocks, so it is done on a thread
         rss_parser = RSSFeedParser()
 
-        for rss_item in rss_parser.parse(self.rss_url, self._url_cache):
-            if self._to_stop:
-                return
+        def fetch_and_parse():
+            feed = rss_parser.fetch(self.rss_url, etag=self._feed_etag, modified=self._feed_modified)
+            return feed, list(rss_parser.parse_feed(feed))
 
-            torrent_deferred = getPage(rss_item[u'torrent_url'].encode('utf-8'))
-            torrent_deferred.addCallback(lambda t, r=rss_item: self.on_got_torrent(t, rss_item=r))
+        scrape_deferred = deferToThread(fetch_and_parse)
+        scrape_deferred.addCallback(self.on_got_feed)
+        scrape_deferred.addErrback(lambda failure: self._logger.error(u"Failed to scrape %s: %s",
+                                                                      self.rss_url, failure.getErrorMessage()))
+        scrape_deferred.addBoth(lambda _: self._schedule_scrape())
 
+    def _schedule_scrape(self):
         if not self._to_stop:
             # schedule the next scraping task
             self._logger.info(u"Finish scraping %s, schedule task after %s", self.rss_url, self.check_interval)
             self.register_task(u'rss_scrape',
                                reactor.callLater(self.check_interval, self._task_scrape))
 
-    def on_got_torrent(self, torrent_data, rss_item=None):
+    def on_got_feed(self, result):
         if self._to_stop:
             return
 
+        feed, rss_items = result
+
+        if feed.get(u'status') == 304:
+            # the feed has not changed, only the torrents that failed before have to be downloaded
+            self._logger.debug(u"RSS feed %s has not changed", self.rss_url)
+            rss_items = self._failed_rss_items.values()
+        else:
+            self._feed_etag = feed.get(u'etag')
+            self._feed_modified = feed.get(u'modified')
+        self._failed_rss_items = {}
+
+        for rss_item in rss_items:
+            # ignore the ones that we have seen before or that are being downloaded
+            torrent_url = rss_item[u'torrent_url']
+            if self._url_cache.has(torrent_url) or torrent_url in self._pending_torrent_urls:
+                continue
+            self._pending_torrent_urls.add(torrent_url)
+
+            torrent_deferred = self._download_semaphore.run(self._download, torrent_url)
+            torrent_deferred.addCallbacks(lambda t, r=rss_item: self.on_got_torrent(t, rss_item=r),
+                                          lambda f, r=rss_item: self.on_torrent_failed(f, rss_item=r))
+
+    def _download(self, url):
+        if self._to_stop:
+            return None
+        return getPage(url.encode('utf-8'))
+
+    def on_torrent_failed(self, failure, rss_item=None):
+        # the torrent is not added to the URL cache, so it is tried again on the next scrape
+        self._pending_torrent_urls.discard(rss_item[u'torrent_url'])
+        self._failed_rss_items[rss_item[u'torrent_url']] = rss_item
+        self._logger.warning(u"Failed to download torrent %s: %s", rss_item[u'torrent_url'],
+                             failure.getErrorMessage())
+
+    def on_got_torrent(self, torrent_data, rss_item=None):
+        if self._to_stop or torrent_data is None:
+            return
+
         # save torrent
-        tdef = TorrentDef.load_from_memory(torrent_data)
+        try:
+            tdef = TorrentDef.load_from_memory(torrent_data)
+        except ValueError as e:
+            self._pending_torrent_urls.discard(rss_item[u'torrent_url'])
+            self._failed_rss_items[rss_item[u'torrent_url']] = rss_item
+            self._logger.warning(u"Invalid torrent %s: %s", rss_item[u'torrent_url'], e)
+            return
         self.session.lm.rtorrent_handler.save_torrent(tdef)
 
         # add metadata pending request
@@ -115,14 +179,32 @@ class ChannelRssParser(TaskManager):
             if info_hash not in self._pending_metadata_requests:
                 self._pending_metadata_requests[info_hash] = rss_item
 
-        # create channel torrent
-        self.channel_community._disp_create_torrent_from_torrentdef(tdef, long(time.time()))
+        # the channel torrents are created in batches
+        self._pending_torrents.append((tdef, rss_item))
+        if len(self._pending_torrents) >= TORRENT_BATCH_SIZE:
+            self.create_channel_torrents()
+        elif not self.is_pending_task_active(u'rss_create_torrents'):
+            self.register_task(u'rss_create_torrents',
+                               reactor.callLater(TORRENT_BATCH_DELAY, self.create_channel_torrents))
+
+    def create_channel_torrents(self):
+        self.cancel_pending_task(u'rss_create_torrents')
+        if self._to_stop or not self._pending_torrents:
+            return
+
+        pending_torrents, self._pending_torrents = self._pending_torrents, []
+
+        # create channel torrents
+        self.channel_community._disp_create_torrents_from_torrentdefs([tdef for tdef, _ in pending_torrents],
+                                                                      long(time.time()))
 
         # update URL cache
-        self._url_cache.add(rss_item[u'torrent_url'])
+        for _, rss_item in pending_torrents:
+            self._url_cache.add(rss_item[u'torrent_url'])
+            self._pending_torrent_urls.discard(rss_item[u'torrent_url'])
         self._url_cache.save()
 
-        self._logger.info(u"Channel torrent %s created", tdef.get_name_as_unicode())
+        self._logger.info(u"%d channel torrents created from %s", len(pending_torrents), self.rss_url)
 
     def on_channel_torrent_created(self, subject, events, object_id, data_list):
         if self._to_stop:
@@ -134,10 +216,16 @@ class ChannelRssParser(TaskManager):
                 rss_item[u'info_hash'] = data[u'info_hash']
                 rss_item[u'channel_torrent_id'] = data[u'channel_torrent_id']
 
-                metadata_deferred = getPage(rss_item[u'thumbnail_url'].encode('utf-8'))
-                metadata_deferred.addCallback(lambda md, r=rss_item: self.on_got_metadata(md, rss_item=r))
+                metadata_deferred = self._download_semaphore.run(self._download, rss_item[u'thumbnail_url'])
+                metadata_deferred.addCallbacks(lambda md, r=rss_item: self.on_got_metadata(md, rss_item=r),
+                                               lambda f, r=rss_item: self._logger.warning(
+                                                   u"Failed to download thumbnail %s: %s", r[u'thumbnail_url'],
+                                                   f.getErrorMessage()))
 
     def on_got_metadata(self, metadata_data, rss_item=None):
+        if self._to_stop or metadata_data is None:
+            return
+
         # save metadata
         thumb_hash = hashlib.sha1(metadata_data).digest()
         self.session.lm.rtorrent_handler.save_metadata(thumb_hash, metadata_data)
@@ -195,15 +283,25 @@ class RSSFeedParser(object):
 
         return parsed_html_content
 
+    def fetch(self, url, etag=None, modified=None):
+        """Downloads a RSS feed. If etag or modified are given, the feed is only
+        downloaded if it has changed, otherwise the status of the result is 304.
+        This method blocks.
+        """
+        return feedparser.parse(url, etag=etag, modified=modified)
+
     def parse(self, url, cache):
         """Parses a RSS feed. This methods supports RSS 2.0 and Media RSS.
         """
-        feed = feedparser.parse(url)
+        return self.parse_feed(self.fetch(url), cache)
 
+    def parse_feed(self, feed, cache=None):
+        """Parses the items of a downloaded RSS feed, skipping the ones in cache.
+        """
         for item in feed.entries:
             # ignore the ones that we have seen before
             link = item.get(u'link', None)
-            if link is None or cache.has(link):
+            if link is None or (cache is not None and cache.has(link)):
                 continue
 
             title = self._html2plaintext(item[u'title']).strip()
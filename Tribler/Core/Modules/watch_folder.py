@@ -1,17 +1,44 @@
-import hashlib
+import codecs
+import json
 import logging
 import os
+import time
+from binascii import hexlify, unhexlify
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore, DeferredList, succeed
 from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python.filepath import FilePath
 from Tribler.Core.TorrentDef import TorrentDef
 from Tribler.Core.Utilities.utilities import fix_torrent
 from Tribler.Core.simpledefs import NTFY_WATCH_CORRUPT_FOLDER, NTFY_INSERT
 from Tribler.dispersy.taskmanager import TaskManager
 
+try:
+    from twisted.internet import inotify
+except ImportError:
+    # inotify is only available on Linux, elsewhere we only poll the watch folder
+    inotify = None
+
 
 WATCH_FOLDER_CHECK_INTERVAL = 10
+# When inotify reports the changes, the watch folder is only scanned to catch changes that it missed.
+WATCH_FOLDER_RESCAN_INTERVAL = 300
+# Delay between an inotify event and checking the watch folder, so a burst of new files is handled in one check.
+WATCH_FOLDER_EVENT_DELAY = 1
+# Maximum number of torrent files that are parsed at the same time.
+MAX_CONCURRENT_PARSES = 4
+
+WATCH_FOLDER_INDEX_FILE = u"watch_folder_index.json"
 
 
 class WatchFolder(TaskManager):
+    """
+    Starts a download for every torrent file in the watch folder.
+
+    The size, modification time and infohash of every torrent file are kept in an index in the state directory, so
+    only new or changed torrent files are parsed. Parsing is done on a thread.
+    """
 
     def __init__(self, session):
         super(WatchFolder, self).__init__()
@@ -19,32 +46,176 @@ class WatchFolder(TaskManager):
         self._logger = logging.getLogger(self.__class__.__name__)
         self.session = session
 
+        self._index_path = os.path.join(self.session.get_state_dir(), WATCH_FOLDER_INDEX_FILE)
+        # path -> (size, modification time, infohash)
+        self._index = {}
+        self._index_changed = False
+        self._parse_semaphore = DeferredSemaphore(MAX_CONCURRENT_PARSES)
+        self._notifier = None
+        # The watch folder path that inotify was started for
+        self._notifier_path = None
+        self._last_check = 0
+        self._checking = False
+        self._check_again = False
+        self._to_stop = False
+
     def start(self):
-        self.register_task("check watch folder", LoopingCall(self.check_watch_folder))\
+        self.load_index()
+        self._start_notifier()
+        self._last_check = time.time()
+
+        self.register_task("check watch folder", LoopingCall(self._on_check_interval))\
             .start(WATCH_FOLDER_CHECK_INTERVAL, now=False)
 
     def stop(self):
+        self._to_stop = True
         self.cancel_all_pending_tasks()
+        self._stop_notifier()
+        self.save_index()
 
-    def check_watch_folder(self):
-        if not os.path.isdir(self.session.get_watch_folder_path()):
+    def _on_check_interval(self):
+        """
+        Check the watch folder, unless inotify is watching it and it has been scanned less than
+        WATCH_FOLDER_RESCAN_INTERVAL seconds ago. When the watch folder path has changed, inotify is started for the
+        new path first.
+        """
+        if self.session.get_watch_folder_path() != self._notifier_path:
+            self._stop_notifier()
+            self._start_notifier()
+        elif self._notifier is not None and time.time() - self._last_check < WATCH_FOLDER_RESCAN_INTERVAL:
+            return succeed(None)
+        return self.check_watch_folder()
+
+    def load_index(self):
+        self._index = {}
+        if os.path.exists(self._index_path):
+            try:
+                with codecs.open(self._index_path, 'rb', encoding='utf-8') as f:
+                    for path, (size, mtime, infohash) in json.load(f).iteritems():
+                        self._index[path] = (size, mtime, unhexlify(infohash))
+            except Exception as e:
+                self._logger.error("Watch folder - failed to load index %s: %s", self._index_path, repr(e))
+
+    def save_index(self):
+        self._index_changed = False
+        try:
+            with codecs.open(self._index_path, 'wb', encoding='utf-8') as f:
+                json.dump(dict((path, (size, mtime, hexlify(infohash)))
+                               for path, (size, mtime, infohash) in self._index.iteritems()), f)
+        except Exception as e:
+            self._logger.error("Watch folder - failed to save index %s: %s", self._index_path, repr(e))
+
+    def _start_notifier(self):
+        """
+        Start watching the watch folder with inotify.
+        :return: True if inotify is watching the watch folder, otherwise False.
+        """
+        watch_folder_path = self._notifier_path = self.session.get_watch_folder_path()
+        if inotify is None or not watch_folder_path or not os.path.isdir(watch_folder_path):
+            return False
+
+        try:
+            self._notifier = inotify.INotify()
+            self._notifier.startReading()
+            self._notifier.watch(FilePath(watch_folder_path), mask=inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO,
+                                 autoAdd=True, recursive=True, callbacks=[self._on_watch_folder_changed])
+        except Exception as e:
+            self._logger.warning("Watch folder - could not use inotify, polling instead: %s", repr(e))
+            self._stop_notifier()
+            return False
+        return True
+
+    def _stop_notifier(self):
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+    def _on_watch_folder_changed(self, _, file_path, mask):
+        if not file_path.basename().endswith(".torrent") or \
+                self.is_pending_task_active("check watch folder changes"):
             return
+        self.register_task("check watch folder changes",
+                           reactor.callLater(WATCH_FOLDER_EVENT_DELAY, self.check_watch_folder))
+
+    def check_watch_folder(self):
+        """
+        Start the downloads of the torrent files that are new or have changed since the last check.
+        :return: A deferred that fires when all new torrent files have been handled.
+        """
+        if self._checking:
+            self._check_again = True
+            return succeed(None)
 
-        for root, _, files in os.walk(self.session.get_watch_folder_path()):
+        watch_folder_path = self.session.get_watch_folder_path()
+        if not watch_folder_path or not os.path.isdir(watch_folder_path):
+            return succeed(None)
+
+        self._checking = True
+        self._last_check = time.time()
+        deferreds = []
+        index = {}
+        for root, _, files in os.walk(watch_folder_path):
             for name in files:
                 if not name.endswith(u".torrent"):
                     continue
 
-                torrent_data = fix_torrent(os.path.join(root, name))
-                if not torrent_data:  # torrent appears to be corrupt
-                    os.rename(os.path.join(root, name), os.path.join(root, name + ".corrupt"))
-                    self._logger.warning("Watch folder - corrupt torrent file %s", name)
-                    self.session.notifier.notify(NTFY_WATCH_CORRUPT_FOLDER, NTFY_INSERT, None, name)
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
                     continue
 
-                tdef = TorrentDef.load_from_memory(torrent_data)
-                infohash = tdef.get_infohash()
+                entry = self._index.get(path)
+                if entry and entry[:2] == (stat.st_size, stat.st_mtime):
+                    index[path] = entry
+                    if self.session.has_download(entry[2]):
+                        continue
+
+                deferreds.append(self._parse_semaphore.run(deferToThread, self._load_torrent, path)
+                                 .addCallback(self._on_torrent_loaded, path, name, stat)
+                                 .addErrback(self._on_torrent_failed, name))
+        # Forget the torrent files that have been removed
+        self._index_changed |= len(index) < len(self._index)
+        self._index = index
+
+        return DeferredList(deferreds).addBoth(self._on_watch_folder_checked)
+
+    @staticmethod
+    def _load_torrent(path):
+        torrent_data = fix_torrent(path)
+        if not torrent_data:  # torrent appears to be corrupt
+            return None
+        return TorrentDef.load_from_memory(torrent_data)
+
+    def _on_torrent_loaded(self, tdef, path, name, stat):
+        if self._to_stop:
+            return
+
+        if tdef is None:
+            os.rename(path, path + ".corrupt")
+            self._logger.warning("Watch folder - corrupt torrent file %s", name)
+            self.session.notifier.notify(NTFY_WATCH_CORRUPT_FOLDER, NTFY_INSERT, None, name)
+            return
+
+        infohash = tdef.get_infohash()
+        self._index[path] = (stat.st_size, stat.st_mtime, infohash)
+        self._index_changed = True
+
+        if not self.session.has_download(infohash):
+            self._logger.info("Starting download from torrent file %s", name)
+            self.session.lm.ltmgr.start_download(tdef=tdef)
+
+    def _on_torrent_failed(self, failure, name):
+        self._logger.warning("Watch folder - failed to load torrent file %s: %s", name, failure.getErrorMessage())
+
+    def _on_watch_folder_checked(self, _):
+        self._checking = False
+        if self._to_stop:
+            return
 
-                if not self.session.has_download(infohash):
-                    self._logger.info("Starting download from torrent file %s", name)
-                    self.session.lm.ltmgr.start_download(tdef=tdef)
+        if self._index_changed:
+            self.save_index()
+        if self._check_again:
+            self._check_again = False
+            if not self.is_pending_task_active("check watch folder changes"):
+                self.register_task("check watch folder changes", reactor.callLater(0, self.check_watch_folder))
@@ -1,11 +1,22 @@
 # Written by Jelle Roozenburg, Arno Bakker
 # see LICENSE.txt for license information
 
+import math
 import re
+from bisect import bisect_left, insort
+from collections import defaultdict
+from heapq import nlargest
+from struct import unpack_from
 
 RE_KEYWORD_SPLIT = re.compile(r"[\W_]", re.UNICODE)
 DIALOG_STOPWORDS = {'an', 'and', 'by', 'for', 'from', 'of', 'the', 'to', 'with'}
 
+# Weights of the FullTextIndex columns (swarmname, filenames, fileextensions) when ranking search results
+FTS_COLUMN_WEIGHTS = (1.0, 0.5, 0.1)
+BM25_K1 = 1.2
+SEEDERS_WEIGHT = 0.5
+CHANNEL_VOTES_WEIGHT = 0.25
+
 
 def split_into_keywords(string, to_filter_stopwords=False):
     """
@@ -25,3 +36,201 @@ def split_into_keywords(string, to_filter_stopwords=False):
 
 def filter_keywords(keywords):
     return [kw for kw in keywords if len(kw) > 0 and kw not in DIALOG_STOPWORDS]
+
+
+def unpack_matchinfo(matchinfo):
+    """
+    Unpacks the default output of the FTS3 Matchinfo function, see http://www.sqlite.org/fts3.html#matchinfo
+
+    Returns a list that contains, for every phrase, a list with for every column a tuple of
+    (hits in this row, hits in all rows, number of rows with hits).
+    """
+    matchinfo = str(matchinfo)
+    num_phrases, num_cols = unpack_from('II', matchinfo)
+    values = unpack_from('I' * (3 * num_cols * num_phrases), matchinfo, 8)
+    return [[values[3 * (col + phrase * num_cols):3 * (col + phrase * num_cols) + 3] for col in xrange(num_cols)]
+            for phrase in xrange(num_phrases)]
+
+
+def search_rank(matchinfo, num_docs, num_seeders, channel_votes):
+    """
+    Scores a FullTextIndex match. The text relevance is a BM25-style score computed from the Matchinfo blob (without
+    length normalisation, as FTS3 does not provide document lengths), to which the popularity of the swarm and of
+    the channel it is in are added.
+
+    This function is registered as the search_rank SQL function, so it has to accept NULL values for all but the
+    first argument.
+    """
+    num_docs = num_docs or 0
+    score = 0.0
+    for phrase in unpack_matchinfo(matchinfo):
+        for col, (hits, _, docs_with_hits) in enumerate(phrase):
+            if not hits or col >= len(FTS_COLUMN_WEIGHTS):
+                continue
+            idf = math.log(1.0 + (max(num_docs - docs_with_hits, 0) + 0.5) / (docs_with_hits + 0.5))
+            score += FTS_COLUMN_WEIGHTS[col] * idf * hits * (BM25_K1 + 1) / (hits + BM25_K1)
+
+    score += SEEDERS_WEIGHT * math.log1p(max(num_seeders or 0, 0))
+    score += CHANNEL_VOTES_WEIGHT * math.log1p(max(channel_votes or 0, 0))
+    return score
+
+
+def levenshtein(a, b):
+    """
+    Calculates the Levenshtein distance between a and b.
+    """
+    n, m = len(a), len(b)
+    if n > m:
+        # Make sure n <= m, to use O(min(n,m)) space
+        a, b = b, a
+        n, m = m, n
+
+    current = range(n + 1)
+    for i in xrange(1, m + 1):
+        previous, current = current, [i] + [0] * n
+        for j in xrange(1, n + 1):
+            add, delete = previous[j] + 1, current[j - 1] + 1
+            change = previous[j - 1]
+            if a[j - 1] != b[i - 1]:
+                change += 1
+            current[j] = min(add, delete, change)
+
+    return current[n]
+
+
+def get_trigrams(term):
+    """
+    Returns the set of trigrams of a term, padded so that its start and end form trigrams as well.
+    """
+    padded = u"$$%s$" % term
+    return set(padded[i:i + 3] for i in xrange(len(padded) - 2))
+
+
+def get_max_edit_distance(word):
+    """
+    Returns the number of typos we allow when looking for terms that are similar to word.
+    """
+    return min(2, (len(word) + 1) // 4)
+
+
+class TrigramIndex(object):
+    """
+    An index of terms by their trigrams, used to find the terms that are within a small edit distance of a word.
+
+    Every edit changes at most three trigrams of a word, so a term within distance d of a word shares at least
+    len(trigrams) - 3 * d trigrams with it. Counting shared trigrams over the posting lists narrows the candidates down
+    to a handful of terms, for which the Levenshtein distance is then computed.
+    """
+
+    def __init__(self):
+        self._trigrams = defaultdict(set)
+        self._frequencies = {}
+
+    def __len__(self):
+        return len(self._frequencies)
+
+    def __contains__(self, term):
+        return term in self._frequencies
+
+    def get_frequency(self, term):
+        return self._frequencies.get(term, 0)
+
+    def add(self, term, frequency=1):
+        """
+        Adds a term to the index, or increases its frequency if it already is in the index.
+        """
+        if term in self._frequencies:
+            self._frequencies[term] += frequency
+            return
+
+        self._frequencies[term] = frequency
+        for trigram in get_trigrams(term):
+            self._trigrams[trigram].add(term)
+
+    def remove(self, term, frequency=1):
+        """
+        Decreases the frequency of a term, the term is removed from the index once its frequency drops to zero.
+        """
+        if term not in self._frequencies:
+            return
+
+        self._frequencies[term] -= frequency
+        if self._frequencies[term] <= 0:
+            del self._frequencies[term]
+            for trigram in get_trigrams(term):
+                self._trigrams[trigram].discard(term)
+                if not self._trigrams[trigram]:
+                    del self._trigrams[trigram]
+
+    def find(self, word, max_distance, limit=None):
+        """
+        Returns a list of (distance, term) tuples for the terms within max_distance of word, closest and most frequent
+        terms first.
+        """
+        word_trigrams = get_trigrams(word)
+        min_shared = max(1, len(word_trigrams) - 3 * max_distance)
+
+        shared = defaultdict(int)
+        for trigram in word_trigrams:
+            for term in self._trigrams.get(trigram, ()):
+                shared[term] += 1
+
+        results = []
+        for term, nr_shared in shared.iteritems():
+            if nr_shared >= min_shared and abs(len(term) - len(word)) <= max_distance:
+                distance = levenshtein(word, term)
+                if distance <= max_distance:
+                    results.append((distance, -self._frequencies[term], term))
+
+        results.sort()
+        return [(distance, term) for distance, _, term in results[:limit]]
+
+
+class CompletionIndex(object):
+    """
+    A sorted array of terms and their frequencies, used for autocompletion. The terms that start with a prefix are
+    adjacent in the array, so they are found with two binary searches, after which the most frequent ones are picked.
+    """
+
+    def __init__(self, frequencies=None):
+        self._frequencies = dict(frequencies or {})
+        self._terms = sorted(self._frequencies)
+
+    def __len__(self):
+        return len(self._terms)
+
+    def __contains__(self, term):
+        return term in self._frequencies
+
+    def get_frequency(self, term):
+        return self._frequencies.get(term, 0)
+
+    def add(self, term, frequency=1):
+        """
+        Adds a term to the index, or increases its frequency if it already is in the index.
+        """
+        if term in self._frequencies:
+            self._frequencies[term] += frequency
+        else:
+            self._frequencies[term] = frequency
+            insort(self._terms, term)
+
+    def remove(self, term, frequency=1):
+        """
+        Decreases the frequency of a term, the term is removed from the index once its frequency drops to zero.
+        """
+        if term not in self._frequencies:
+            return
+
+        self._frequencies[term] -= frequency
+        if self._frequencies[term] <= 0:
+            del self._frequencies[term]
+            del self._terms[bisect_left(self._terms, term)]
+
+    def complete(self, prefix, max_terms):
+        """
+        Returns the max_terms most frequent terms that start with prefix.
+        """
+        start = bisect_left(self._terms, prefix)
+        end = bisect_left(self._terms, prefix + u"\uffff", start)
+        return nlargest(max_terms, self._terms[start:end], key=self._frequencies.get)
@@ -34,8 +34,8 @@
 
 # Code:
 from collections import MutableMapping
-from itertools import chain
 import os
+import zlib
 
 
 def get_write_batch_leveldb(self, _):
@@ -64,6 +64,12 @@ from Tribler.dispersy.taskmanager import TaskManager
 
 
 WRITEBACK_PERIOD = 120
+# the pending values are also written back once they take up more than this many bytes
+WRITEBACK_MAX_PENDING_SIZE = 8 * 1024 * 1024
+
+# compressed values start with this marker, which can not start a bencoded torrent
+COMPRESSION_MARKER = "\x00zlib\x00"
+COMPRESSION_LEVEL = 6
 
 # TODO(emilon): Make sure the caching makes an actual difference in IO and kill
 # it if it doesn't as it complicates the code.
@@ -74,11 +80,15 @@ class LevelDbStore(MutableMapping, TaskManager):
     _leveldb = LevelDB
     _writebatch = get_write_batch
 
-    def __init__(self, store_dir):
+    def __init__(self, store_dir, compress=False):
         super(LevelDbStore, self).__init__()
 
         self._store_dir = store_dir
+        self._compress = compress
         self._pending_torrents = {}
+        self._pending_size = 0
+        # the number of keys in the store, counted when it is needed for the first time
+        self._count = None
         # This is done to work around LevelDB's inability to deal with non-ascii
         # paths on windows.
         self._db = self._leveldb(os.path.relpath(store_dir, os.getcwdu()))
@@ -91,28 +101,37 @@ class LevelDbStore(MutableMapping, TaskManager):
         try:
             return self._pending_torrents[key]
         except KeyError:
-            return self._db.Get(key)
+            return self._decode(self._db.Get(key))
 
     def __setitem__(self, key, value):
+        if self._count is not None and key not in self:
+            self._count += 1
+
+        old_value = self._pending_torrents.get(key)
+        if old_value is not None:
+            self._pending_size -= len(old_value)
         self._pending_torrents[key] = value
-        # self._db.Put(key, value)
+        self._pending_size += len(value)
+
+        if self._pending_size > WRITEBACK_MAX_PENDING_SIZE:
+            self.flush()
 
     def __delitem__(self, key):
+        if self._count is not None and key in self:
+            self._count -= 1
+
         if key in self._pending_torrents:
-            self._pending_torrents.pop(key)
+            self._pending_size -= len(self._pending_torrents.pop(key))
         self._db.Delete(key)
 
     def __iter__(self):
-        for k in self._pending_torrents.iterkeys():
-            yield k
-        for k, _ in self._db.RangeIter():
-            yield k
+        return self._merge_pending(self._db.RangeIter(include_value=False), False)
 
     def __contains__(self, key):
         if key in self._pending_torrents:
             return True
         try:
-            self.__getitem__(key)
+            self._db.Get(key)
             return True
         except KeyError:
             pass
@@ -120,31 +139,38 @@ class LevelDbStore(MutableMapping, TaskManager):
         return False
 
     def __len__(self):
-        return len(self._pending_torrents) + len(list(self.keys()))
+        if self._count is None:
+            self._count = sum(1 for _ in self)
+        return self._count
 
     def keys(self):
-        return [k for k, _ in self._db.RangeIter()]
+        return list(self)
 
     def iteritems(self):
-        return chain(self._pending_torrents, self._db.RangeIter())
+        """
+        Iterates over the items in key order, without loading the whole store in memory.
+        """
+        return self._merge_pending(self.rangescan(), True)
 
     def put(self, k, v):
         self.__setitem__(k, v)
 
     def rangescan(self, start=None, end=None):
         if start is None and end is None:
-            return self._db.RangeIter()
+            items = self._db.RangeIter()
         elif end is None:
-            return self._db.RangeIter(key_from=start)
+            items = self._db.RangeIter(key_from=start)
         else:
-            return self._db.RangeIter(key_from=start, key_to=end)
+            items = self._db.RangeIter(key_from=start, key_to=end)
+        return ((k, self._decode(v)) for k, v in items)
 
     def flush(self):
         if self._pending_torrents:
             write_batch = self._writebatch(self._db)
             for k, v in self._pending_torrents.iteritems():
-                write_batch.Put(k, v)
+                write_batch.Put(k, self._encode(v))
             self._pending_torrents.clear()
+            self._pending_size = 0
             return self._db.Write(write_batch)
 
     def close(self):
@@ -152,6 +178,42 @@ class LevelDbStore(MutableMapping, TaskManager):
         self.flush()
         self._db = None
 
+    def _merge_pending(self, stored, include_value):
+        """
+        Merges the pending items with the (sorted) keys or items from the database, pending values take precedence.
+        """
+        pending = iter(sorted(self._pending_torrents.items()))
+        next_pending = next(pending, None)
+
+        for stored_entry in stored:
+            key = stored_entry[0] if include_value else stored_entry
+            while next_pending is not None and next_pending[0] < key:
+                yield next_pending if include_value else next_pending[0]
+                next_pending = next(pending, None)
+
+            if next_pending is not None and next_pending[0] == key:
+                yield next_pending if include_value else key
+                next_pending = next(pending, None)
+            else:
+                yield stored_entry
+
+        while next_pending is not None:
+            yield next_pending if include_value else next_pending[0]
+            next_pending = next(pending, None)
+
+    def _encode(self, value):
+        if self._compress:
+            compressed_value = COMPRESSION_MARKER + zlib.compress(value, COMPRESSION_LEVEL)
+            if len(compressed_value) < len(value):
+                return compressed_value
+        return value
+
+    @staticmethod
+    def _decode(value):
+        if value.startswith(COMPRESSION_MARKER):
+            return zlib.decompress(value[len(COMPRESSION_MARKER):])
+        return value
+
 
 #
 # torrentstore.py ends here
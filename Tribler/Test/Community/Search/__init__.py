@@ -0,0 +1,3 @@
+"""
+This package contains various unit tests to test the search community
+"""
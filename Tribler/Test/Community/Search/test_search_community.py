@@ -0,0 +1,159 @@
+from twisted.internet.defer import Deferred, succeed
+
+from Tribler.Test.test_as_server import AbstractServer
+from Tribler.community.search.community import (SearchCommunity, SEARCH_BURST, SEARCH_QUEUE_SIZE,
+                                                TASTE_PREFERENCES_LIMIT)
+from Tribler.dispersy.bloomfilter import BloomFilter
+from Tribler.dispersy.dispersy import Dispersy
+from Tribler.dispersy.endpoint import ManualEnpoint
+from Tribler.dispersy.member import DummyMember
+from Tribler.dispersy.util import blocking_call_on_reactor_thread
+
+
+class MockTorrentDB(object):
+
+    def __init__(self):
+        self.searches = []
+        # if set, searches wait for this Deferred instead of finishing immediately
+        self.deferred = None
+
+    def searchNamesAsync(self, keywords, local=True, keys=None):
+        self.searches.append(keywords)
+        channel_details = [None, "c" * 20] + [None] * 8
+        results = [tuple(["a" * 20, u"name", 1024, 1, u"other", 0, None, 5] + channel_details)]
+        if self.deferred is not None:
+            return self.deferred.addCallback(lambda _: results)
+        return succeed(results)
+
+
+class MockMyPreferenceDB(object):
+
+    def __init__(self, infohashes):
+        self.infohashes = infohashes
+        self.calls = 0
+
+    def getMyPrefListInfohash(self, limit=None):
+        self.calls += 1
+        return self.infohashes[:limit]
+
+
+class MockPayload(object):
+
+    def __init__(self, identifier, keywords):
+        self.identifier = identifier
+        self.keywords = keywords
+
+
+class MockCandidate(object):
+
+    def __init__(self, sock_addr):
+        self.sock_addr = sock_addr
+
+
+class MockMessage(object):
+
+    def __init__(self, identifier, keywords, sock_addr):
+        self.payload = MockPayload(identifier, keywords)
+        self.candidate = MockCandidate(sock_addr)
+
+
+class TestSearchCommunity(AbstractServer):
+
+    @blocking_call_on_reactor_thread
+    def setUp(self, annotate=True):
+        super(TestSearchCommunity, self).setUp(annotate=annotate)
+
+        self.dispersy = Dispersy(ManualEnpoint(0), self.getStateDir())
+        self.dispersy._database.open()
+        master_member = DummyMember(self.dispersy, 1, "a" * 20)
+        member = self.dispersy.get_new_member(u"curve25519")
+        self.search_community = SearchCommunity(self.dispersy, master_member, member)
+        self.search_community._torrent_db = MockTorrentDB()
+        # most recent first, like MyPreferenceDBHandler.getMyPrefListInfohash
+        self.search_community._mypref_db = MockMyPreferenceDB(["%020d" % i for i in xrange(10, 0, -1)])
+
+        self.responses = []
+        self.search_community._create_search_response = \
+            lambda identifier, results, candidate: self.responses.append((identifier, results, candidate))
+
+    def test_search_cache(self):
+        """
+        Searches for the same keywords should be answered from the cache, regardless of order, case and stopwords.
+        """
+        self.search_community.on_search([MockMessage(1, [u"ubuntu", u"iso"], ("1.1.1.1", 1)),
+                                         MockMessage(2, [u"ISO", u"the", u"ubuntu"], ("1.1.1.2", 1)),
+                                         MockMessage(3, [u"debian"], ("1.1.1.3", 1))])
+
+        self.assertEqual(len(self.search_community._torrent_db.searches), 2)
+        self.assertEqual([identifier for identifier, _, _ in self.responses], [1, 2, 3])
+        self.assertEqual(self.responses[0][1],
+                         [("a" * 20, u"name", 1024L, 1, [u"other"], 0L, 0, 5, "c" * 20)])
+        self.assertIs(self.responses[0][1], self.responses[1][1])
+
+    def test_search_pending(self):
+        """
+        Searches for keywords that are already being searched for should wait for that search.
+        """
+        self.search_community._torrent_db.deferred = Deferred()
+        self.search_community.on_search([MockMessage(1, [u"ubuntu"], ("1.1.1.1", 1)),
+                                         MockMessage(2, [u"Ubuntu"], ("1.1.1.2", 1))])
+        self.assertEqual(self.responses, [])
+
+        self.search_community._torrent_db.deferred.callback(None)
+        self.assertEqual(len(self.search_community._torrent_db.searches), 1)
+        self.assertEqual([identifier for identifier, _, _ in self.responses], [1, 2])
+        self.assertFalse(self.search_community._pending_searches)
+
+    def test_search_rate_limit(self):
+        """
+        Searches of a candidate beyond its burst should be queued, keeping only the last ones.
+        """
+        sock_addr = ("1.1.1.1", 1)
+        num_searches = SEARCH_BURST + SEARCH_QUEUE_SIZE + 3
+        self.search_community.on_search([MockMessage(identifier, [u"ubuntu"], sock_addr)
+                                         for identifier in xrange(num_searches)])
+        self.assertEqual(len(self.responses), SEARCH_BURST)
+
+        # other candidates are not affected
+        self.search_community.on_search([MockMessage(num_searches, [u"ubuntu"], ("1.1.1.2", 1))])
+        self.assertEqual(self.responses[-1][0], num_searches)
+
+        self.search_community._search_tokens[sock_addr][0] = SEARCH_QUEUE_SIZE
+        self.search_community.process_search_queue()
+        self.assertEqual([identifier for identifier, _, _ in self.responses[SEARCH_BURST + 1:]],
+                         range(num_searches - SEARCH_QUEUE_SIZE, num_searches))
+        self.assertFalse(self.search_community._search_queue)
+
+    @blocking_call_on_reactor_thread
+    def test_my_preferences(self):
+        """
+        The preferences should be loaded once and then be kept up to date by the notifier.
+        """
+        self.assertEqual(self.search_community.get_my_preferences(), ["%020d" % i for i in xrange(1, 11)])
+        version = self.search_community._my_preferences_version
+
+        self.search_community.on_my_preference_added(None, None, "%020d" % 5)
+        self.assertEqual(self.search_community._my_preferences_version, version)
+
+        self.search_community.on_my_preference_added(None, None, "%020d" % 11)
+        self.assertEqual(self.search_community.get_my_preferences()[-1], "%020d" % 11)
+        self.assertEqual(self.search_community._my_preferences_version, version + 1)
+        self.assertEqual(self.search_community._mypref_db.calls, 1)
+
+        for i in xrange(12, TASTE_PREFERENCES_LIMIT + 20):
+            self.search_community.on_my_preference_added(None, None, "%020d" % i)
+        my_preferences = self.search_community.get_my_preferences()
+        self.assertEqual(len(my_preferences), TASTE_PREFERENCES_LIMIT)
+        self.assertEqual(my_preferences[-1], "%020d" % (TASTE_PREFERENCES_LIMIT + 19))
+
+    def test_taste_overlap(self):
+        my_preferences = self.search_community.get_my_preferences()
+        taste_bloom_filter = BloomFilter(0.005, 10, prefix=' ')
+        taste_bloom_filter.add_keys(my_preferences[:4])
+        received = BloomFilter(taste_bloom_filter.bytes, taste_bloom_filter.functions, prefix=' ')
+
+        self.assertEqual(self.search_community._get_taste_overlap(received, my_preferences), 4)
+        self.assertEqual(self.search_community._get_taste_overlap(received, my_preferences[:2]), 4)
+
+        self.search_community._my_preferences_version += 1
+        self.assertEqual(self.search_community._get_taste_overlap(received, my_preferences[:2]), 2)
@@ -2,6 +2,7 @@ from Tribler.Test.test_as_server import AbstractServer
 from Tribler.community.tunnel.Socks5.server import Socks5Server
 from Tribler.community.tunnel.conversion import TunnelConversion
 from Tribler.community.tunnel.hidden_community import HiddenTunnelCommunity
+from Tribler.community.tunnel.tunnel_community import TunnelSettings
 from Tribler.dispersy.dispersy import Dispersy
 from Tribler.dispersy.endpoint import ManualEnpoint
 from Tribler.dispersy.member import DummyMember
@@ -22,6 +23,7 @@ class AbstractTestTunnelCommunity(AbstractServer):
         self.member = self.dispersy.get_new_member(u"curve25519")
         self.tunnel_community = HiddenTunnelCommunity(self.dispersy, self.master_member, self.member)
         self.tunnel_community._request_cache = RequestCache()
+        self.tunnel_community.settings = TunnelSettings()
         self.tunnel_community.socks_server = Socks5Server(self, 1234)
         self.tunnel_community._initialize_meta_messages()
         self.tunnel_community.add_conversion(TunnelConversion(self.tunnel_community))
@@ -0,0 +1,306 @@
+"""
+Benchmarks of the tunnel data path. A number of tunnel communities run in this process and hand their packets to each
+other through a loopback endpoint, so throughput and latency can be measured without a Dispersy network. The circuits
+are set up with session keys directly instead of through create/extend messages.
+
+The benchmarks only run when TRIBLER_BENCHMARK is set, otherwise a few packets are tunneled as a smoke test.
+"""
+import cProfile
+import os
+import pstats
+import random
+import time
+from StringIO import StringIO
+from collections import deque
+from unittest import skipUnless
+
+from twisted.internet.defer import Deferred
+
+from Tribler.Core.Utilities.twisted_thread import deferred
+from Tribler.Test.test_as_server import AbstractServer
+from Tribler.community.tunnel import CIRCUIT_TYPE_DATA, CIRCUIT_TYPE_RENDEZVOUS, CIRCUIT_TYPE_RP, EXIT_NODE, ORIGINATOR
+from Tribler.community.tunnel.conversion import TunnelConversion
+from Tribler.community.tunnel.hidden_community import HiddenTunnelCommunity
+from Tribler.community.tunnel.routing import Circuit, Hop, RelayRoute
+from Tribler.community.tunnel.tunnel_community import TunnelExitSocket, TunnelSettings
+from Tribler.dispersy.dispersy import Dispersy
+from Tribler.dispersy.endpoint import ManualEnpoint
+from Tribler.dispersy.member import DummyMember
+from Tribler.dispersy.requestcache import RequestCache
+from Tribler.dispersy.util import blocking_call_on_reactor_thread
+
+PAYLOAD_SIZE = 1024
+NUM_PACKETS = 5000
+SMOKE_NUM_PACKETS = 50
+DESTINATION = ("127.0.0.1", 9999)
+
+
+class LoopbackEndpoint(ManualEnpoint):
+
+    """
+    Endpoint that passes the data packets it sends to the node listening on the destination address.
+    """
+
+    def __init__(self, network):
+        super(LoopbackEndpoint, self).__init__(0)
+        self.network = network
+        self.node = None
+
+    def send(self, candidates, packets, prefix=None):
+        for candidate in candidates:
+            self.node.on_sent(len(packets))
+            destination = self.network.nodes[candidate.sock_addr]
+            for packet in packets:
+                destination.on_received(self.node.address, packet)
+        return True
+
+
+class TunnelNode(object):
+
+    """
+    A tunnel community together with the timestamps of the data packets it has received but not yet forwarded. As
+    every node forwards the packets of a circuit in order, the time a packet spent in a node is known when it leaves.
+    """
+
+    def __init__(self, network, index, state_dir):
+        self.address = ("127.0.0.1", 10000 + index)
+        self.endpoint = LoopbackEndpoint(network)
+        self.endpoint.node = self
+
+        self.dispersy = Dispersy(self.endpoint, state_dir)
+        self.dispersy._database.open()
+        master_member = DummyMember(self.dispersy, 1, "a" * 20)
+        member = self.dispersy.get_new_member(u"curve25519")
+
+        self.community = HiddenTunnelCommunity(self.dispersy, master_member, member)
+        self.community._request_cache = RequestCache()
+        self.community.settings = TunnelSettings()
+        self.community.socks_server = self
+        self.community._initialize_meta_messages()
+        self.community.add_conversion(TunnelConversion(self.community))
+        self.community.exit_data = self.on_exit_data
+
+        self.received = deque()
+        self.latencies = []
+        self.delivered = 0
+        self.on_delivered = None
+
+    def on_received(self, sock_addr, packet):
+        self.received.append(time.time())
+        self.community.on_data(sock_addr, packet)
+
+    def on_sent(self, num_packets):
+        now = time.time()
+        for _ in xrange(min(num_packets, len(self.received))):
+            self.latencies.append(now - self.received.popleft())
+
+    def on_exit_data(self, circuit_id, sock_addr, destination, data):
+        self.on_sent(1)
+        self.delivered += 1
+        if self.on_delivered:
+            self.on_delivered()
+
+    def on_incoming_from_tunnel(self, community, circuit, origin, data, force=False):
+        self.on_exit_data(circuit.circuit_id, None, origin, data)
+
+    def circuit_dead(self, circuit):
+        return set()
+
+
+class TunnelNetwork(object):
+
+    def __init__(self, num_nodes, get_state_dir):
+        self.nodes = {}
+        self.node_list = []
+        for index in xrange(num_nodes):
+            node = TunnelNode(self, index, get_state_dir(index + 1))
+            self.nodes[node.address] = node
+            self.node_list.append(node)
+
+    @staticmethod
+    def generate_circuit_id():
+        return long(random.getrandbits(31) + 1)
+
+    def build_circuit(self, originator, hops, ctype=CIRCUIT_TYPE_DATA):
+        """
+        Builds a circuit from originator over hops, the last of which is not configured yet.
+        :return: A (circuit, circuit id at the last hop, session keys of the last hop, node before the last hop) tuple.
+        """
+        crypto = originator.community.crypto
+        circuit_id = self.generate_circuit_id()
+        circuit = Circuit(circuit_id, goal_hops=len(hops), first_hop=hops[0].address,
+                          proxy=originator.community, ctype=ctype)
+
+        previous, previous_circuit_id = originator, circuit_id
+        for index, node in enumerate(hops):
+            session_keys = crypto.generate_session_keys(os.urandom(32))
+            hop = Hop()
+            hop.session_keys = list(session_keys)
+            circuit.add_hop(hop)
+
+            if index == len(hops) - 1:
+                break
+
+            next_circuit_id = self.generate_circuit_id()
+            community = node.community
+            community.relay_session_keys[previous_circuit_id] = community.relay_session_keys[next_circuit_id] = \
+                list(session_keys)
+            community.directions[previous_circuit_id] = EXIT_NODE
+            community.directions[next_circuit_id] = ORIGINATOR
+            community.relay_from_to[previous_circuit_id] = RelayRoute(next_circuit_id, hops[index + 1].address)
+            community.relay_from_to[next_circuit_id] = RelayRoute(previous_circuit_id, previous.address)
+            previous, previous_circuit_id = node, next_circuit_id
+
+        originator.community.circuits[circuit_id] = circuit
+        return circuit, previous_circuit_id, session_keys, previous
+
+    def build_exit_circuit(self, originator, hops):
+        circuit, circuit_id, session_keys, previous = self.build_circuit(originator, hops)
+        exit_node = hops[-1].community
+        exit_node.relay_session_keys[circuit_id] = list(session_keys)
+        exit_node.directions[circuit_id] = EXIT_NODE
+        exit_node.exit_sockets[circuit_id] = TunnelExitSocket(circuit_id, exit_node, previous.address)
+        return circuit
+
+    def build_rendezvous_circuit(self, downloader, downloader_hops, seeder, seeder_hops):
+        """
+        Joins a circuit of the downloader with a circuit of the seeder at the last hop of both, which should be the
+        same rendezvous node.
+        """
+        rendezvous = downloader_hops[-1]
+        assert seeder_hops[-1] is rendezvous
+
+        circuit, downloader_circuit_id, downloader_keys, downloader_previous = \
+            self.build_circuit(downloader, downloader_hops, CIRCUIT_TYPE_RENDEZVOUS)
+        seeder_circuit, seeder_circuit_id, seeder_keys, seeder_previous = \
+            self.build_circuit(seeder, seeder_hops, CIRCUIT_TYPE_RP)
+
+        hs_session_keys = rendezvous.community.crypto.generate_session_keys(os.urandom(32))
+        circuit.hs_session_keys = list(hs_session_keys)
+        seeder_circuit.hs_session_keys = list(hs_session_keys)
+
+        community = rendezvous.community
+        community.relay_session_keys[downloader_circuit_id] = list(downloader_keys)
+        community.relay_session_keys[seeder_circuit_id] = list(seeder_keys)
+        community.directions[downloader_circuit_id] = community.directions[seeder_circuit_id] = EXIT_NODE
+        community.relay_from_to[downloader_circuit_id] = RelayRoute(seeder_circuit_id, seeder_previous.address,
+                                                                    rendezvous_relay=True)
+        community.relay_from_to[seeder_circuit_id] = RelayRoute(downloader_circuit_id, downloader_previous.address,
+                                                                rendezvous_relay=True)
+        return circuit
+
+    def reset(self):
+        for node in self.node_list:
+            node.received.clear()
+            node.latencies = []
+            node.delivered = 0
+            node.on_delivered = None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))] if values else 0.0
+
+
+benchmark = skipUnless(os.environ.get('TRIBLER_BENCHMARK'), "benchmark, set TRIBLER_BENCHMARK to run it")
+
+
+class TestTunnelPerformance(AbstractServer):
+
+    @blocking_call_on_reactor_thread
+    def setUp(self, annotate=True):
+        super(TestTunnelPerformance, self).setUp(annotate=annotate)
+        self.network = TunnelNetwork(7, self.getStateDir)
+        self.profiler = None
+
+    def run_benchmark(self, name, circuit, path, num_packets=NUM_PACKETS):
+        """
+        Tunnels num_packets packets over circuit and reports the throughput and the time spent in every node of path.
+        :return: A Deferred that fires when all packets have been delivered at the last node of path.
+        """
+        self.network.reset()
+        originator, sink = path[0], path[-1]
+        finished = Deferred()
+        payload = os.urandom(PAYLOAD_SIZE)
+
+        def on_delivered():
+            if sink.delivered == num_packets:
+                finished.callback(time.time() - start)
+
+        def on_finished(duration):
+            if self.profiler:
+                self.profiler.disable()
+
+            self._logger.info("%s: %d packets of %d bytes in %.2f seconds, %.1f MB/s, %.0f packets/s", name,
+                              num_packets, PAYLOAD_SIZE, duration, num_packets * PAYLOAD_SIZE / duration / 1024 / 1024,
+                              num_packets / duration)
+            for index, node in enumerate(path):
+                self._logger.info("%s: node %d latency p50 %.2f ms, p90 %.2f ms, p99 %.2f ms", name, index,
+                                  percentile(node.latencies, 0.5) * 1000, percentile(node.latencies, 0.9) * 1000,
+                                  percentile(node.latencies, 0.99) * 1000)
+
+            if self.profiler:
+                output = StringIO()
+                pstats.Stats(self.profiler, stream=output).sort_stats("cumulative").print_stats(30)
+                self._logger.info("%s: profile\n%s", name, output.getvalue())
+
+            self.assertEqual(sink.delivered, num_packets)
+
+        sink.on_delivered = on_delivered
+        finished.addCallback(on_finished)
+
+        if self.profiler:
+            self.profiler.enable()
+        start = time.time()
+        for _ in xrange(num_packets):
+            originator.received.append(time.time())
+            circuit.tunnel_data(DESTINATION, payload)
+        return finished
+
+    def run_exit_benchmark(self, num_hops, num_packets=NUM_PACKETS):
+        nodes = self.network.node_list
+        hops = nodes[1:num_hops + 1]
+        circuit = self.network.build_exit_circuit(nodes[0], hops)
+        return self.run_benchmark("%d hops" % num_hops, circuit, [nodes[0]] + hops, num_packets)
+
+    @deferred(timeout=10)
+    def test_smoke_3_hops(self):
+        """
+        Tunnels a few packets over 3 hops, so the benchmark setup is exercised without TRIBLER_BENCHMARK.
+        """
+        exit_node = self.network.node_list[3]
+
+        def check_latencies(_):
+            self.assertEqual(len(exit_node.latencies), SMOKE_NUM_PACKETS)
+
+        return self.run_exit_benchmark(3, SMOKE_NUM_PACKETS).addCallback(check_latencies)
+
+    @benchmark
+    @deferred(timeout=60)
+    def test_exit_1_hop(self):
+        return self.run_exit_benchmark(1)
+
+    @benchmark
+    @deferred(timeout=60)
+    def test_exit_2_hops(self):
+        return self.run_exit_benchmark(2)
+
+    @benchmark
+    @deferred(timeout=60)
+    def test_exit_3_hops(self):
+        return self.run_exit_benchmark(3)
+
+    @benchmark
+    @deferred(timeout=60)
+    def test_rendezvous(self):
+        nodes = self.network.node_list
+        downloader, seeder, rendezvous = nodes[0], nodes[1], nodes[2]
+        downloader_hops, seeder_hops = [nodes[3], rendezvous], [nodes[4], rendezvous]
+        circuit = self.network.build_rendezvous_circuit(downloader, downloader_hops, seeder, seeder_hops)
+        return self.run_benchmark("rendezvous", circuit, [downloader, nodes[3], rendezvous, nodes[4], seeder])
+
+    @benchmark
+    @deferred(timeout=120)
+    def test_profile_3_hops(self):
+        self.profiler = cProfile.Profile()
+        return self.run_exit_benchmark(3)
@@ -1,6 +1,12 @@
+import os
+import socket
 import time
+from struct import pack
+
 from Tribler.Test.Community.Tunnel.test_tunnel_base import AbstractTestTunnelCommunity
-from Tribler.community.tunnel.routing import Circuit, RelayRoute
+from Tribler.community.tunnel import CIRCUIT_MAX_QUEUE_SIZE, EXIT_NODE, EXIT_NODE_SALT, ORIGINATOR, ORIGINATOR_SALT
+from Tribler.community.tunnel.conversion import TunnelConversion
+from Tribler.community.tunnel.routing import Circuit, Hop, RelayRoute
 from Tribler.community.tunnel.tunnel_community import TunnelExitSocket, CircuitRequestCache, PingRequestCache
 from Tribler.dispersy.candidate import Candidate
 from Tribler.dispersy.message import DropMessage
@@ -84,3 +90,255 @@ class TestTunnelCommunity(AbstractTestTunnelCommunity):
         self.tunnel_community.relay_from_to[42] = RelayRoute(42, sock_addr)
         for i in self.tunnel_community.check_destroy([msg1]):
             self.assertIsInstance(i, type(msg1))
+
+    def _setup_relay_keys(self, circuit_id, direction):
+        keys = self.tunnel_community.crypto.generate_session_keys(os.urandom(64))
+        self.tunnel_community.relay_session_keys[circuit_id] = keys
+        self.tunnel_community.directions[circuit_id] = direction
+        return keys
+
+    @blocking_call_on_reactor_thread
+    def test_crypto_relay(self):
+        keys = self._setup_relay_keys(42, EXIT_NODE)
+        packet = pack('!I', 42) + self.tunnel_community.crypto.encrypt_str("content", keys[EXIT_NODE],
+                                                                           keys[EXIT_NODE_SALT], 1)
+        header = TunnelConversion.swap_circuit_id(packet[:4], u"data", 42, 43)
+        self.assertEqual(self.tunnel_community.crypto_relay(42, packet, 4, header), pack('!I', 43) + "content")
+
+        keys = self._setup_relay_keys(44, ORIGINATOR)
+        relayed = self.tunnel_community.crypto_relay(44, pack('!I', 44) + "content", 4, pack('!I', 45))
+        self.assertEqual(relayed[:4], pack('!I', 45))
+        self.assertEqual(self.tunnel_community.crypto.decrypt_str(relayed, keys[ORIGINATOR], keys[ORIGINATOR_SALT],
+                                                                  offset=4), "content")
+
+    @blocking_call_on_reactor_thread
+    def test_relay_benchmark(self):
+        keys = self._setup_relay_keys(42, EXIT_NODE)
+        num_packets = 2000
+        packets = [pack('!I', 42) + self.tunnel_community.crypto.encrypt_str(os.urandom(1400), keys[EXIT_NODE],
+                                                                             keys[EXIT_NODE_SALT], i + 1)
+                   for i in xrange(num_packets)]
+
+        sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in xrange(3)]
+        sender, relay, receiver = sockets
+        try:
+            for sock in sockets:
+                sock.bind(("127.0.0.1", 0))
+                sock.settimeout(5)
+
+            num_bytes = 0
+            start = time.time()
+            for packet in packets:
+                sender.sendto(packet, relay.getsockname())
+                data = relay.recv(65536)
+                header = TunnelConversion.swap_circuit_id(data[:4], u"data", 42, 43)
+                relay.sendto(self.tunnel_community.crypto_relay(42, data, 4, header), receiver.getsockname())
+                num_bytes += len(receiver.recv(65536))
+            duration = time.time() - start
+        finally:
+            for sock in sockets:
+                sock.close()
+
+        self.assertEqual(num_bytes, num_packets * 1404)
+        self._logger.info("Relayed %d packets in %.2f seconds (%.0f packets/second, %.1f MB/s)",
+                          num_packets, duration, num_packets / duration, num_bytes / duration / 1024 / 1024)
+
+    @blocking_call_on_reactor_thread
+    def test_aggregate_traffic(self):
+        relay = RelayRoute(42, ("127.0.0.1", 1234))
+        self.tunnel_community.relay_from_to[42] = relay
+
+        self.tunnel_community.increase_bytes_sent(relay, 100)
+        self.tunnel_community.increase_bytes_received(relay, 50)
+        self.assertEqual((relay.bytes_up, relay.bytes_down), (100, 50))
+        self.assertEqual(self.tunnel_community.stats['bytes_relay_up'], 0)
+
+        self.tunnel_community.aggregate_traffic()
+        self.assertEqual(self.tunnel_community.stats['bytes_relay_up'], 100)
+        self.assertEqual(self.tunnel_community.stats['bytes_relay_down'], 50)
+
+        self.tunnel_community.increase_bytes_sent(relay, 10)
+        self.tunnel_community.remove_relay(42)
+        self.assertEqual(self.tunnel_community.stats['bytes_relay_up'], 110)
+        self.assertEqual(relay.bytes_up, 110)
+
+    @blocking_call_on_reactor_thread
+    def test_data_batch(self):
+        keys = self._setup_relay_keys(42, EXIT_NODE)
+        self.tunnel_community.relay_from_to[42] = RelayRoute(43, ("127.0.0.1", 1234))
+        packets = [(("127.0.0.1", 4321), pack('!I', 42) +
+                    self.tunnel_community.crypto.encrypt_str("content %d" % i, keys[EXIT_NODE],
+                                                             keys[EXIT_NODE_SALT], i + 1))
+                   for i in xrange(10)]
+
+        self.tunnel_community.on_data_batch(packets)
+
+        relay = self.tunnel_community.relay_from_to[42]
+        candidate, queued = self.tunnel_community.egress_queue[("127.0.0.1", 1234)]
+        self.assertEqual(queued, [(pack('!I', 43) + "content %d" % i, relay) for i in xrange(10)])
+        # the bytes are counted once the packets have actually been sent
+        self.assertEqual(relay.bytes_up, 0)
+
+        sent = []
+        self.dispersy.endpoint.send = lambda candidates, packets, prefix=None: sent.extend(packets) or True
+        self.tunnel_community.flush_egress()
+        self.assertEqual(sent, [packet for packet, _ in queued])
+        self.assertEqual(relay.bytes_up, sum(len(packet) for packet in sent))
+
+    @blocking_call_on_reactor_thread
+    def test_data_batch_corrupt(self):
+        """
+        A corrupt packet should not stop the other packets of the batch from being relayed.
+        """
+        keys = self._setup_relay_keys(42, EXIT_NODE)
+        self.tunnel_community.relay_from_to[42] = RelayRoute(43, ("127.0.0.1", 1234))
+        packets = [pack('!I', 42) + self.tunnel_community.crypto.encrypt_str("content %d" % i, keys[EXIT_NODE],
+                                                                             keys[EXIT_NODE_SALT], i + 1)
+                   for i in xrange(3)]
+        packets[1] = packets[1][:-1] + chr(ord(packets[1][-1]) ^ 1)
+
+        self.assertFalse(self.tunnel_community.relay_packets(42, u"data", packets))
+        _, queued = self.tunnel_community.egress_queue[("127.0.0.1", 1234)]
+        self.assertEqual([packet for packet, _ in queued], [pack('!I', 43) + "content 0", pack('!I', 43) + "content 2"])
+
+    def _setup_circuit(self, circuit_id):
+        hop = Hop()
+        hop.session_keys = self.tunnel_community.crypto.generate_session_keys(os.urandom(64))
+        circuit = Circuit(circuit_id, goal_hops=1, first_hop=("127.0.0.1", 1234), proxy=self.tunnel_community)
+        circuit.add_hop(hop)
+        self.tunnel_community.circuits[circuit_id] = circuit
+        return circuit, hop.session_keys
+
+    @blocking_call_on_reactor_thread
+    def test_send_data_batch(self):
+        circuit, keys = self._setup_circuit(42L)
+        self.tunnel_community.send_data_batch([Candidate(circuit.first_hop, False)], 42L,
+                                              [(("127.0.0.2", 80), ("0.0.0.0", 0), "data %d" % i) for i in xrange(3)],
+                                              sent_by=circuit)
+
+        _, queued = self.tunnel_community.egress_queue[circuit.first_hop]
+        for i, (packet, sent_by) in enumerate(queued):
+            self.assertIs(sent_by, circuit)
+            decrypted = self.tunnel_community.crypto.decrypt_str(packet, keys[EXIT_NODE], keys[EXIT_NODE_SALT],
+                                                                 offset=4, prefix=packet[:4])
+            self.assertEqual(TunnelConversion.decode_data(decrypted)[3], "data %d" % i)
+
+    @blocking_call_on_reactor_thread
+    def test_data_packets_own_circuit(self):
+        circuit, keys = self._setup_circuit(42L)
+        packets = [(circuit.first_hop, pack('!I', 42) +
+                    self.tunnel_community.crypto.encrypt_str("content %d" % i, keys[ORIGINATOR],
+                                                             keys[ORIGINATOR_SALT], i + 1))
+                   for i in xrange(3)]
+        decrypted = []
+        self.tunnel_community.on_decrypted_data = lambda sock_addr, packet: decrypted.append(packet)
+
+        self.tunnel_community.on_data_batch(packets)
+        self.assertEqual(decrypted, [pack('!I', 42) + "content %d" % i for i in xrange(3)])
+
+    @blocking_call_on_reactor_thread
+    def test_circuit_flow_control(self):
+        circuit = Circuit(42L, first_hop=("127.0.0.1", 1234), proxy=self.tunnel_community)
+        circuit.update_rtt(1000.0)
+        circuit.send_tokens = 0
+
+        for _ in xrange(CIRCUIT_MAX_QUEUE_SIZE):
+            self.assertTrue(circuit.queue_data(("127.0.0.1", 4321), "data"))
+        self.assertFalse(circuit.queue_data(("127.0.0.1", 4321), "data"))
+        self.assertEqual(circuit.dropped_packets, 1)
+
+        circuit.send_tokens = 10
+        circuit.flush_queue()
+        self.assertEqual(len(circuit.send_queue), CIRCUIT_MAX_QUEUE_SIZE - 10)
+
+    @blocking_call_on_reactor_thread
+    def test_circuit_flow_control_uncongested(self):
+        """
+        The send window of a circuit that is not congested should grow until it no longer limits the data rate.
+        """
+        circuit = Circuit(42L, first_hop=("127.0.0.1", 1234), proxy=self.tunnel_community)
+        circuit.update_rtt(0.1)
+        circuit.tunnel_data = lambda destination, payload: True
+        self.tunnel_community.send_data_batch = lambda *args, **kwargs: None
+
+        # offer 5000 packets per second for 2 seconds, flushing the queue every 50 ms
+        for _ in xrange(40):
+            circuit.last_refill -= 0.05
+            circuit.flush_queue()
+            for _ in xrange(250):
+                circuit.queue_data(("127.0.0.1", 4321), "data")
+
+        self.assertEqual(circuit.dropped_packets, 0)
+        self.assertGreater(circuit.send_rate, 5000)
+
+    @blocking_call_on_reactor_thread
+    def test_circuit_flow_control_congested(self):
+        circuit = Circuit(42L, first_hop=("127.0.0.1", 1234), proxy=self.tunnel_community)
+        circuit.update_rtt(0.1)
+        send_window = circuit.send_window
+
+        circuit.update_rtt(0.5)
+        self.assertEqual(circuit.send_window, send_window / 2)
+        circuit.send_tokens = 0
+        circuit.queue_data(("127.0.0.1", 4321), "data")
+        self.assertEqual(circuit.send_window, send_window / 2)
+
+    @blocking_call_on_reactor_thread
+    def test_select_least_loaded(self):
+        busy, idle = Circuit(42L), Circuit(43L)
+        self.tunnel_community.circuits[42] = busy
+        self.tunnel_community.circuits[43] = idle
+        busy.send_queue.extend([(("127.0.0.1", 4321), "data")] * 10)
+
+        for _ in xrange(4):
+            self.assertEqual(self.tunnel_community.selection_strategy.select(None, 0), idle)
+
+        busy.send_queue.clear()
+        self.assertEqual(set(self.tunnel_community.selection_strategy.select(None, 0) for _ in xrange(2)),
+                         set([busy, idle]))
+
+    @blocking_call_on_reactor_thread
+    def test_update_circuit_pool(self):
+        settings = self.tunnel_community.settings
+        self.tunnel_community.circuits_needed[1] = settings.max_circuits
+
+        self.tunnel_community.circuit_demand[1] = time.time() - 1
+        self.tunnel_community.update_circuit_pool()
+        self.assertEqual(self.tunnel_community.circuits_needed[1], settings.min_circuits)
+
+        self.tunnel_community.circuit_demand[1] = time.time() - settings.circuit_demand_time - 1
+        self.tunnel_community.update_circuit_pool()
+        self.assertEqual(self.tunnel_community.circuits_needed[1], 0)
+        self.assertNotIn(1, self.tunnel_community.circuit_demand)
+
+    @blocking_call_on_reactor_thread
+    def test_update_circuit_pool_active_download(self):
+        settings = self.tunnel_community.settings
+        settings.min_circuits = 0
+        self.tunnel_community.get_active_downloads_per_hops = lambda: {1: 1}
+
+        self.tunnel_community.update_circuit_pool()
+        self.assertEqual(self.tunnel_community.circuits_needed[1], settings.max_circuits)
+
+        self.tunnel_community.get_active_downloads_per_hops = lambda: {}
+        self.tunnel_community.update_circuit_pool()
+        self.assertEqual(self.tunnel_community.circuits_needed[1], 0)
+        self.assertIn(1, self.tunnel_community.circuit_demand)
+
+    @blocking_call_on_reactor_thread
+    def test_remove_surplus_circuits(self):
+        old, new = Circuit(42L, first_hop=("127.0.0.1", 1234)), Circuit(43L, first_hop=("127.0.0.1", 1235))
+        old.creation_time -= self.tunnel_community.settings.max_time / 2
+        self.tunnel_community.circuits[42] = old
+        self.tunnel_community.circuits[43] = new
+        self.assertLess(self.tunnel_community.get_circuit_score(old), self.tunnel_community.get_circuit_score(new))
+
+        self.tunnel_community.circuits_needed[0] = 1
+        self.tunnel_community.update_circuit_pool()
+        self.assertEqual(self.tunnel_community.circuits.values(), [new])
+
+    def test_circuit_expiring(self):
+        circuit = Circuit(42L)
+        self.assertFalse(self.tunnel_community.is_circuit_expiring(circuit))
+        circuit.creation_time -= self.tunnel_community.settings.max_time
+        self.assertTrue(self.tunnel_community.is_circuit_expiring(circuit))
@@ -0,0 +1,100 @@
+import os
+import struct
+from threading import Thread
+from time import time
+
+from Tribler.Test.test_as_server import AbstractServer
+from Tribler.community.tunnel.crypto.cryptowrapper import Cipher, algorithms, modes, default_backend
+from Tribler.community.tunnel.crypto import tunnelcrypto
+from Tribler.community.tunnel.crypto.tunnelcrypto import TunnelCrypto
+
+
+class TestTunnelCrypto(AbstractServer):
+
+    def setUp(self, annotate=True):
+        super(TestTunnelCrypto, self).setUp(annotate=annotate)
+        self.crypto = TunnelCrypto()
+        self.key = os.urandom(16)
+        self.salt = os.urandom(4)
+
+    def test_encrypt_decrypt(self):
+        for salt_explicit in [1, 12345678]:
+            encrypted = self.crypto.encrypt_str("content", self.key, self.salt, salt_explicit)
+            self.assertEqual(self.crypto.decrypt_str(encrypted, self.key, self.salt), "content")
+
+    def test_encrypt_compatible(self):
+        """
+        The cached ciphers should produce the same packets as a cipher that is set up for every packet.
+        """
+        for salt_explicit in [1, 12345678]:
+            encryptor = Cipher(algorithms.AES(self.key),
+                               modes.GCM(initialization_vector=self.salt + str(salt_explicit)),
+                               backend=default_backend()).encryptor()
+            ciphertext = encryptor.update("content") + encryptor.finalize()
+            expected = struct.pack('!q16s', salt_explicit, encryptor.tag) + ciphertext
+
+            self.assertEqual(self.crypto.encrypt_str("content", self.key, self.salt, salt_explicit), expected)
+
+    def test_offset_prefix(self):
+        encrypted = self.crypto.encrypt_str("headercontent", self.key, self.salt, 1, offset=6, prefix="HEADER")
+        self.assertEqual(encrypted, "HEADER" + self.crypto.encrypt_str("content", self.key, self.salt, 1))
+        self.assertEqual(self.crypto.decrypt_str(encrypted, self.key, self.salt, offset=6, prefix="header"),
+                         "headercontent")
+
+    def test_cipher_cache_threads(self):
+        """
+        The cipher cache should stay consistent when the crypto workers and the reactor use it at the same time.
+        """
+        old_cache_size = tunnelcrypto.CIPHER_CACHE_SIZE
+        tunnelcrypto.CIPHER_CACHE_SIZE = 4
+        keys = [os.urandom(16) for _ in xrange(8)]
+        errors = []
+
+        def hammer(index):
+            try:
+                for i in xrange(500):
+                    key = keys[(index + i) % len(keys)]
+                    encrypted = self.crypto.encrypt_str("content", key, self.salt, i + 1)
+                    self.assertEqual(self.crypto.decrypt_str(encrypted, key, self.salt), "content")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=hammer, args=(index,)) for index in xrange(8)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            tunnelcrypto.CIPHER_CACHE_SIZE = old_cache_size
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(self.crypto._ciphers), 4)
+
+    def test_batch(self):
+        contents = ["content %d" % i for i in xrange(10)]
+        salt_explicits = range(1, 11)
+        encrypted = self.crypto.encrypt_str_batch(contents, self.key, self.salt, salt_explicits)
+
+        self.assertEqual(encrypted, [self.crypto.encrypt_str(content, self.key, self.salt, salt_explicit)
+                                     for content, salt_explicit in zip(contents, salt_explicits)])
+        self.assertEqual(self.crypto.decrypt_str_batch(encrypted, self.key, self.salt), contents)
+
+    def test_batch_benchmark(self):
+        num_packets = 2000
+        contents = [os.urandom(1400) for _ in xrange(num_packets)]
+        hop_keys = [(os.urandom(16), os.urandom(4)) for _ in xrange(3)]
+
+        for num_hops in [1, 2, 3]:
+            start = time()
+            encrypted = contents
+            for key, salt in reversed(hop_keys[:num_hops]):
+                encrypted = self.crypto.encrypt_str_batch(encrypted, key, salt, xrange(1, num_packets + 1))
+            decrypted = encrypted
+            for key, salt in hop_keys[:num_hops]:
+                decrypted = self.crypto.decrypt_str_batch(decrypted, key, salt)
+            duration = time() - start
+
+            self.assertEqual(decrypted, contents)
+            self._logger.info("%d hops: encrypted and decrypted %d packets in %.2f seconds (%.0f packets/second)",
+                              num_hops, num_packets, duration, num_packets / duration)
@@ -0,0 +1,88 @@
+import os
+from functools import partial
+from multiprocessing import cpu_count
+from threading import Event, Lock
+from time import time
+
+from Tribler.Test.test_as_server import AbstractServer
+from Tribler.community.tunnel.crypto.tunnelcrypto import TunnelCrypto
+from Tribler.community.tunnel.crypto.workerpool import CryptoWorkerPool
+
+
+def call_directly(func, *args):
+    func(*args)
+
+
+class TestCryptoWorkerPool(AbstractServer):
+
+    def setUp(self, annotate=True):
+        super(TestCryptoWorkerPool, self).setUp(annotate=annotate)
+        self.pool = None
+
+    def tearDown(self, annotate=True):
+        if self.pool:
+            self.pool.shutdown()
+        super(TestCryptoWorkerPool, self).tearDown(annotate=annotate)
+
+    def test_order_per_key(self):
+        self.pool = CryptoWorkerPool(4, call_in_thread=call_directly)
+        results = {key: [] for key in xrange(8)}
+        lock = Lock()
+
+        def on_result(key, value):
+            with lock:
+                results[key].append(value)
+
+        for i in xrange(100):
+            for key in results:
+                self.pool.submit(key, lambda i=i: i, lambda value, key=key: on_result(key, value))
+        self.pool.shutdown()
+
+        for key in results:
+            self.assertEqual(results[key], range(100))
+
+    def test_errback(self):
+        self.pool = CryptoWorkerPool(1, call_in_thread=call_directly)
+        errors = []
+
+        def fail():
+            raise ValueError()
+
+        self.pool.submit(1, fail, lambda _: None, errors.append)
+        self.pool.shutdown()
+
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ValueError)
+
+    def test_benchmark(self):
+        crypto = TunnelCrypto()
+        num_circuits = 16
+        num_packets = 500
+        keys = [(os.urandom(16), os.urandom(4)) for _ in xrange(num_circuits)]
+        content = os.urandom(1400)
+
+        for num_workers in sorted({1, max(2, cpu_count())}):
+            self.pool = CryptoWorkerPool(num_workers, call_in_thread=call_directly)
+            done = Event()
+            counter = [num_circuits * num_packets]
+            lock = Lock()
+
+            def on_result(_):
+                with lock:
+                    counter[0] -= 1
+                    if counter[0] == 0:
+                        done.set()
+
+            start = time()
+            for salt_explicit in xrange(1, num_packets + 1):
+                for circuit_id, (key, salt) in enumerate(keys):
+                    self.pool.submit(circuit_id, partial(crypto.encrypt_str, content, key, salt, salt_explicit),
+                                     on_result)
+            done.wait(60)
+            duration = time() - start
+            self.pool.shutdown()
+
+            self.assertTrue(done.is_set())
+            self._logger.info("%d workers: encrypted %d packets in %.2f seconds (%.0f packets/second)",
+                              num_workers, num_circuits * num_packets, duration, num_circuits * num_packets / duration)
+        self.pool = None
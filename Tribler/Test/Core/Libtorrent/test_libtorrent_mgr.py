@@ -3,7 +3,11 @@ import os
 import shutil
 
 from Tribler.Core.CacheDB.Notifier import Notifier
-from Tribler.Core.Libtorrent.LibtorrentMgr import LibtorrentMgr
+from Tribler.Core.TorrentDef import TorrentDef
+from Tribler.Core.Libtorrent.LibtorrentMgr import (LibtorrentMgr, MetainfoCache, ALERT_POLL_INTERVAL,
+                                                   ALERT_POLL_INTERVAL_MIN, ALERT_POLL_INTERVAL_MAX,
+                                                   ALERT_POLL_BUSY_THRESHOLD)
+from Tribler.Test.Core.base_test import TriblerCoreTest
 from Tribler.Test.test_as_server import AbstractServer
 
 
@@ -72,3 +76,69 @@ class TestLibtorrentMgr(AbstractServer):
         self.ltmgr.initialize()
         ltsession = self.ltmgr.get_session(0)
         self.assertTrue(ltsession)
+
+    def test_alert_poll_interval(self):
+        self.ltmgr.initialize()
+        self.ltmgr.alert_poll_interval = ALERT_POLL_INTERVAL
+        self.assertEqual(self.ltmgr._get_alert_poll_interval(ALERT_POLL_BUSY_THRESHOLD), ALERT_POLL_INTERVAL / 2)
+        self.assertEqual(self.ltmgr._get_alert_poll_interval(0), ALERT_POLL_INTERVAL * 2)
+        self.assertEqual(self.ltmgr._get_alert_poll_interval(1), ALERT_POLL_INTERVAL)
+
+        self.ltmgr.alert_poll_interval = ALERT_POLL_INTERVAL_MIN
+        self.assertEqual(self.ltmgr._get_alert_poll_interval(ALERT_POLL_BUSY_THRESHOLD), ALERT_POLL_INTERVAL_MIN)
+        self.ltmgr.alert_poll_interval = ALERT_POLL_INTERVAL_MAX
+        self.assertEqual(self.ltmgr._get_alert_poll_interval(0), ALERT_POLL_INTERVAL_MAX)
+        self.assertEqual(self.ltmgr._get_alert_poll_interval(1), ALERT_POLL_INTERVAL_MAX / 2)
+
+
+class TestMetainfoCache(TriblerCoreTest):
+
+    def test_get_copy(self):
+        cache = MetainfoCache()
+        cache.put('a', {'info': {'name': 'test'}})
+        metainfo = cache.get('a')
+        self.assertEqual(metainfo, {'info': {'name': 'test'}})
+
+        metainfo['info']['name'] = 'changed'
+        self.assertEqual(cache.get('a'), {'info': {'name': 'test'}})
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_get_initial_peers(self):
+        """
+        The initial peers should still be (ip, port) tuples, as TorrentDef requires, after a round trip through the
+        cache.
+        """
+        cache = MetainfoCache()
+        info = {'name': 'test', 'piece length': 16384, 'pieces': '\x00' * 20, 'length': 1024}
+        cache.put('a', {'info': info, 'nodes': [], 'initial peers': [('127.0.0.1', 1234)]})
+        metainfo = cache.get('a')
+        self.assertEqual(metainfo['initial peers'], [('127.0.0.1', 1234)])
+
+        tdef = TorrentDef.load_from_dict(metainfo)
+        self.assertEqual(tdef.get_initial_peers(), [('127.0.0.1', 1234)])
+
+    def test_evict_size(self):
+        cache = MetainfoCache(max_size=100)
+        cache.put('a', {'info': 'a' * 30})
+        cache.put('b', {'info': 'b' * 30})
+        cache.get('a')
+        cache.put('c', {'info': 'c' * 30})
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertLessEqual(cache.size, 100)
+        self.assertEqual(cache.evictions, 1)
+
+        cache.put('d', {'info': 'd' * 200})
+        self.assertNotIn('d', cache)
+
+    def test_evict_age(self):
+        cache = MetainfoCache(max_age=-1)
+        cache.put('a', {'info': 'a'})
+        cache.put('b', {'info': 'b'})
+        self.assertIsNone(cache.get('a'))
+        cache.remove_expired()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(cache.get_stats()['evictions'], 2)
@@ -43,7 +43,7 @@ class TestMyChannelEndpoints(AbstractApiTest):
         return self.channel_db_handler.getMyChannelId()
 
     def insert_torrents_into_my_channel(self, torrent_list):
-        self.channel_db_handler.on_torrents_from_dispersy(torrent_list)
+        return self.channel_db_handler.on_torrents_from_dispersy(torrent_list)
 
     @deferred(timeout=10)
     def test_my_channel_overview_endpoint_no_my_channel(self):
@@ -83,9 +83,10 @@ class TestMyChannelEndpoints(AbstractApiTest):
         self.should_check_equality = False
         my_channel_id = self.create_my_channel("my channel", "this is a short description")
         torrent_list = [[my_channel_id, 1, 1, ('a' * 40).decode('hex'), 1460000000, "ubuntu-torrent.iso", [], []]]
-        self.insert_torrents_into_my_channel(torrent_list)
 
-        return self.do_request('mychannel/torrents', expected_code=200).addCallback(self.verify_torrents_json)
+        return self.insert_torrents_into_my_channel(torrent_list)\
+            .addCallback(lambda _: self.do_request('mychannel/torrents', expected_code=200))\
+            .addCallback(self.verify_torrents_json)
 
     @deferred(timeout=10)
     def test_rss_feeds_endpoint_no_my_channel(self):
@@ -0,0 +1,208 @@
+import codecs
+import json
+import os
+
+from twisted.internet.defer import Deferred
+
+from Tribler.Core.Modules.channel.cache import SimpleCache
+from Tribler.Core.Modules.channel.channel_rss import (RSSFeedParser, ChannelRssParser, MAX_CONCURRENT_DOWNLOADS,
+                                                      TORRENT_BATCH_SIZE)
+from Tribler.Test.Core.base_test import TriblerCoreTest
+from Tribler.Test.test_as_server import TESTS_DATA_DIR
+from Tribler.Test.test_libtorrent_download import TORRENT_FILE
+
+
+class MockRemoteTorrentHandler(object):
+
+    def __init__(self):
+        self.saved_torrents = []
+
+    def save_torrent(self, tdef):
+        self.saved_torrents.append(tdef)
+
+
+class MockLaunchManyCore(object):
+
+    def __init__(self):
+        self.rtorrent_handler = MockRemoteTorrentHandler()
+
+
+class MockSession(object):
+
+    def __init__(self):
+        self.lm = MockLaunchManyCore()
+
+
+class MockChannelCommunity(object):
+
+    def __init__(self):
+        self.created_batches = []
+
+    def _disp_create_torrents_from_torrentdefs(self, torrentdefs, timestamp):
+        self.created_batches.append(torrentdefs)
+
+
+class TestSimpleCache(TriblerCoreTest):
+
+    def setUp(self, annotate=True):
+        super(TestSimpleCache, self).setUp(annotate=annotate)
+        self.file_path = os.path.join(self.session_base_dir, u"cache.txt")
+
+    def test_save_load(self):
+        cache = SimpleCache(self.file_path)
+        cache.load()
+        cache.add(u"http://localhost/1.torrent")
+        cache.add(u"http://localhost/1.torrent")
+        cache.save()
+        cache.add(u"http://localhost/\u00e9.torrent")
+        cache.save()
+
+        with codecs.open(self.file_path, 'rb', encoding='utf-8') as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+
+        cache = SimpleCache(self.file_path)
+        cache.load()
+        self.assertTrue(cache.has(u"http://localhost/1.torrent"))
+        self.assertTrue(cache.has(u"http://localhost/\u00e9.torrent"))
+        self.assertFalse(cache.has(u"http://localhost/2.torrent"))
+
+    def test_load_json_list(self):
+        """
+        Cache files written as a single JSON list should be loaded and converted on the next save.
+        """
+        with codecs.open(self.file_path, 'wb', encoding='utf-8') as f:
+            json.dump([u"http://localhost/1.torrent", u"http://localhost/2.torrent"], f)
+
+        cache = SimpleCache(self.file_path)
+        cache.load()
+        self.assertTrue(cache.has(u"http://localhost/2.torrent"))
+        cache.add(u"http://localhost/3.torrent")
+        cache.save()
+
+        cache = SimpleCache(self.file_path)
+        cache.load()
+        for index in xrange(1, 4):
+            self.assertTrue(cache.has(u"http://localhost/%d.torrent" % index))
+
+    def test_load_truncated_line(self):
+        """
+        A line that cannot be parsed should be skipped and dropped from the file on the next save.
+        """
+        with codecs.open(self.file_path, 'wb', encoding='utf-8') as f:
+            f.write(u'"http://localhost/1.torrent"\n"http://localhost/2.tor')
+
+        cache = SimpleCache(self.file_path)
+        cache.load()
+        self.assertTrue(cache.has(u"http://localhost/1.torrent"))
+        cache.add(u"http://localhost/3.torrent")
+        cache.save()
+
+        cache = SimpleCache(self.file_path)
+        cache.load()
+        self.assertTrue(cache.has(u"http://localhost/1.torrent"))
+        self.assertTrue(cache.has(u"http://localhost/3.torrent"))
+        with codecs.open(self.file_path, 'rb', encoding='utf-8') as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+
+
+class TestChannelRssParser(TriblerCoreTest):
+
+    def setUp(self, annotate=True):
+        super(TestChannelRssParser, self).setUp(annotate=annotate)
+        self.channel_community = MockChannelCommunity()
+        self.rss_parser = ChannelRssParser(MockSession(), self.channel_community, u"http://localhost/rss.xml")
+        self.rss_parser._url_cache = SimpleCache(os.path.join(self.session_base_dir, u"cache.txt"))
+
+        # url -> deferred of every download that has been started
+        self.downloads = []
+        self.rss_parser._download = self.download
+
+    def tearDown(self, annotate=True):
+        self.rss_parser.cancel_all_pending_tasks()
+        super(TestChannelRssParser, self).tearDown(annotate=annotate)
+
+    def download(self, url):
+        download_deferred = Deferred()
+        self.downloads.append((url, download_deferred))
+        return download_deferred
+
+    @staticmethod
+    def create_rss_items(count):
+        return [{u'title': u"torrent %d" % index, u'description': u"", u'thumbnail_list': [],
+                 u'torrent_url': u"http://localhost/%d.torrent" % index} for index in xrange(count)]
+
+    def test_conditional_get(self):
+        """
+        The ETag and modification time of the feed should be kept, and an unchanged feed should not be processed.
+        """
+        self.rss_parser.on_got_feed(({u'status': 200, u'etag': u"etag", u'modified': u"modified"},
+                                     self.create_rss_items(2)))
+        self.assertEqual((self.rss_parser._feed_etag, self.rss_parser._feed_modified), (u"etag", u"modified"))
+        self.assertEqual(len(self.downloads), 2)
+
+        self.rss_parser.on_got_feed(({u'status': 304}, []))
+        self.assertEqual((self.rss_parser._feed_etag, self.rss_parser._feed_modified), (u"etag", u"modified"))
+        self.assertEqual(len(self.downloads), 2)
+
+    def test_download_semaphore(self):
+        """
+        No more than MAX_CONCURRENT_DOWNLOADS torrents should be downloaded at the same time.
+        """
+        self.rss_parser.on_got_feed(({u'status': 200}, self.create_rss_items(MAX_CONCURRENT_DOWNLOADS + 2)))
+        self.assertEqual(len(self.downloads), MAX_CONCURRENT_DOWNLOADS)
+
+        self.downloads[0][1].errback(Exception("connection refused"))
+        self.assertEqual(len(self.downloads), MAX_CONCURRENT_DOWNLOADS + 1)
+
+    def test_retry_failed_torrents(self):
+        """
+        Torrents that failed to download should be retried on the next scrape, also when the feed has not changed.
+        """
+        self.rss_parser.on_got_feed(({u'status': 200, u'etag': u"etag"}, self.create_rss_items(2)))
+        self.downloads[0][1].errback(Exception("404 Not Found"))
+
+        self.rss_parser.on_got_feed(({u'status': 304}, []))
+        self.assertEqual([url for url, _ in self.downloads], [u"http://localhost/0.torrent",
+                                                              u"http://localhost/1.torrent",
+                                                              u"http://localhost/0.torrent"])
+
+        # a torrent that failed again is retried once more, but only once per scrape
+        self.downloads[2][1].errback(Exception("404 Not Found"))
+        self.rss_parser.on_got_feed(({u'status': 304}, []))
+        self.rss_parser.on_got_feed(({u'status': 304}, []))
+        self.assertEqual(len(self.downloads), 4)
+
+    def test_create_torrents_in_batches(self):
+        """
+        The channel torrents should be created in batches of TORRENT_BATCH_SIZE torrents.
+        """
+        with open(TORRENT_FILE, 'rb') as torrent_file:
+            torrent_data = torrent_file.read()
+
+        rss_items = self.create_rss_items(TORRENT_BATCH_SIZE)
+        for rss_item in rss_items[:-1]:
+            self.rss_parser.on_got_torrent(torrent_data, rss_item=rss_item)
+        self.assertEqual(self.channel_community.created_batches, [])
+        self.assertTrue(self.rss_parser.is_pending_task_active(u'rss_create_torrents'))
+
+        self.rss_parser.on_got_torrent(torrent_data, rss_item=rss_items[-1])
+        self.assertEqual([len(batch) for batch in self.channel_community.created_batches], [TORRENT_BATCH_SIZE])
+        self.assertFalse(self.rss_parser.is_pending_task_active(u'rss_create_torrents'))
+        for rss_item in rss_items:
+            self.assertTrue(self.rss_parser._url_cache.has(rss_item[u'torrent_url']))
+
+
+class TestRSSFeedParser(TriblerCoreTest):
+
+    def test_parse_feed(self):
+        parser = RSSFeedParser()
+        feed = parser.fetch(os.path.join(TESTS_DATA_DIR, 'test_rss.xml'))
+
+        items = list(parser.parse_feed(feed))
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0][u'torrent_url'], u"http://localhost:RANDOMPORT/ubuntu.torrent")
+        self.assertEqual(items[0][u'thumbnail_list'], [u"http://localhost:RANDOMPORT/ubuntu-logo14.png"])
+
+        cache = SimpleCache(os.path.join(self.session_base_dir, u"cache.txt"))
+        cache.add(items[0][u'torrent_url'])
+        self.assertEqual(list(parser.parse_feed(feed, cache)), [])
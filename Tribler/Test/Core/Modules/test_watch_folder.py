@@ -1,5 +1,7 @@
 import os
 import shutil
+from Tribler.Core.Modules.watch_folder import WatchFolder
+from Tribler.Core.Utilities.twisted_thread import deferred
 from Tribler.Test.test_as_server import TestAsServer, TESTS_DATA_DIR
 from Tribler.Test.test_libtorrent_download import TORRENT_FILE
 
@@ -16,24 +18,69 @@ class TestWatchFolder(TestAsServer):
 
         self.config.set_watch_folder_path(self.watch_dir)
 
+    def check_downloads(self, amount):
+        def on_checked(_):
+            self.assertEqual(len(self.session.get_downloads()), amount)
+        return self.session.lm.watch_folder.check_watch_folder().addCallback(on_checked)
+
+    @deferred(timeout=10)
     def test_watchfolder_no_files(self):
-        self.session.lm.watch_folder.check_watch_folder()
-        self.assertEqual(len(self.session.get_downloads()), 0)
+        return self.check_downloads(0)
 
+    @deferred(timeout=10)
     def test_watchfolder_no_torrent_file(self):
         shutil.copyfile(TORRENT_FILE, os.path.join(self.watch_dir, "test.txt"))
-        self.session.lm.watch_folder.check_watch_folder()
-        self.assertEqual(len(self.session.get_downloads()), 0)
+        return self.check_downloads(0)
 
+    @deferred(timeout=10)
     def test_watchfolder_invalid_dir(self):
         shutil.copyfile(TORRENT_FILE, os.path.join(self.watch_dir, "test.txt"))
         self.session.set_watch_folder_path(os.path.join(self.watch_dir, "test.txt"))
-        self.session.lm.watch_folder.check_watch_folder()
-        self.assertEqual(len(self.session.get_downloads()), 0)
+        return self.check_downloads(0)
 
+    @deferred(timeout=10)
     def test_watchfolder_torrent_file_one_corrupt(self):
         shutil.copyfile(TORRENT_FILE, os.path.join(self.watch_dir, "test.torrent"))
         shutil.copyfile(os.path.join(TESTS_DATA_DIR, 'test_rss.xml'), os.path.join(self.watch_dir, "test2.torrent"))
-        self.session.lm.watch_folder.check_watch_folder()
-        self.assertEqual(len(self.session.get_downloads()), 1)
-        self.assertTrue(os.path.isfile(os.path.join(self.watch_dir, "test2.torrent.corrupt")))
+
+        def on_checked(_):
+            self.assertTrue(os.path.isfile(os.path.join(self.watch_dir, "test2.torrent.corrupt")))
+        return self.check_downloads(1).addCallback(on_checked)
+
+    @deferred(timeout=10)
+    def test_watchfolder_unchanged_torrent_file(self):
+        """
+        Torrent files that have not changed since the last check should not be parsed again, also after a restart.
+        """
+        shutil.copyfile(TORRENT_FILE, os.path.join(self.watch_dir, "test.torrent"))
+        watch_folder = self.session.lm.watch_folder
+        loaded = []
+
+        def on_first_check(_):
+            watch_folder._load_torrent = loaded.append
+            return watch_folder.check_watch_folder()
+
+        def on_second_check(_):
+            self.assertEqual(loaded, [])
+
+            restarted_watch_folder = WatchFolder(self.session)
+            restarted_watch_folder.load_index()
+            self.assertEqual(restarted_watch_folder._index.keys(), [os.path.join(self.watch_dir, u"test.torrent")])
+
+        return self.check_downloads(1).addCallback(on_first_check).addCallback(on_second_check)
+
+    @deferred(timeout=10)
+    def test_watchfolder_path_changed(self):
+        """
+        When the watch folder path changes, the new path should be watched and checked right away.
+        """
+        new_watch_dir = os.path.join(self.session_base_dir, 'watch2')
+        os.mkdir(new_watch_dir)
+        shutil.copyfile(TORRENT_FILE, os.path.join(new_watch_dir, "test.torrent"))
+        self.session.set_watch_folder_path(new_watch_dir)
+        watch_folder = self.session.lm.watch_folder
+
+        def on_checked(_):
+            self.assertEqual(watch_folder._notifier_path, new_watch_dir)
+            self.assertEqual(len(self.session.get_downloads()), 1)
+        return watch_folder._on_check_interval().addCallback(on_checked)
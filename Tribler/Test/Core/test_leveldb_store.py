@@ -40,7 +40,8 @@ from tempfile import mkdtemp
 
 from twisted.internet.task import Clock
 
-from Tribler.Core.leveldbstore import LevelDbStore, WRITEBACK_PERIOD, get_write_batch_plyvel, get_write_batch_leveldb
+from Tribler.Core.leveldbstore import (LevelDbStore, WRITEBACK_PERIOD, WRITEBACK_MAX_PENDING_SIZE,
+                                       get_write_batch_plyvel, get_write_batch_leveldb)
 from Tribler.Test.test_as_server import BaseTestCase
 
 
@@ -80,9 +81,9 @@ class AbstractTestLevelDBStore(BaseTestCase):
         rmtree(self.store_dir)
         self.store = None
 
-    def openStore(self, store_dir):
+    def openStore(self, store_dir, compress=False):
         self.store_dir = store_dir
-        self.store = self._storetype(self.store_dir)
+        self.store = self._storetype(self.store_dir, compress=compress)
 
     def test_storeIsPersistent(self):
         self.store.put(K, V)
@@ -131,13 +132,58 @@ class AbstractTestLevelDBStore(BaseTestCase):
     def test_iter_one_element(self):
         self.store[K] = V
         iteritems = self.store.iteritems()
-        self.assertEqual(iteritems.next(), K)
+        self.assertEqual(iteritems.next(), (K, V))
 
     def test_iter(self):
         self.store[K] = V
         for key in iter(self.store):
             self.assertTrue(key)
 
+    def test_cache_flushed_when_full(self):
+        self.store[K] = "x" * WRITEBACK_MAX_PENDING_SIZE
+        self.assertEqual(1, len(self.store._pending_torrents))
+        self.store[K + "2"] = V
+        self.assertEqual(0, len(self.store._pending_torrents))
+        self.assertEqual(self.store[K + "2"], V)
+
+    def test_len_maintained(self):
+        self.store["a"] = V
+        self.store.flush()
+        self.assertEqual(1, len(self.store))
+        self.store["a"] = V
+        self.store["b"] = V
+        self.assertEqual(2, len(self.store))
+        del self.store["a"]
+        self.assertEqual(1, len(self.store))
+        self.store.flush()
+
+        store_dir = self.store._store_dir
+        self.store.close()
+        self.openStore(store_dir)
+        self.assertEqual(1, len(self.store))
+
+    def test_iteritems_ordered(self):
+        self.store["b"] = "1"
+        self.store["d"] = "2"
+        self.store.flush()
+        self.store["a"] = "3"
+        self.store["d"] = "4"
+        self.store["e"] = "5"
+        self.assertEqual(list(self.store.iteritems()), [("a", "3"), ("b", "1"), ("d", "4"), ("e", "5")])
+        self.assertEqual(list(self.store), ["a", "b", "d", "e"])
+
+    def test_compression(self):
+        store_dir = self.store._store_dir
+        self.store.close()
+        self.openStore(store_dir, compress=True)
+
+        value = "d4:infod4:name" + "a" * 1000 + "ee"
+        self.store[K] = value
+        self.store.flush()
+        self.assertLess(len(self.store._db.Get(K)), len(value))
+        self.assertEqual(self.store[K], value)
+        self.assertEqual(list(self.store.iteritems()), [(K, value)])
+
 
 class TestLevelDBStore(AbstractTestLevelDBStore):
     __test__ = True
@@ -0,0 +1,107 @@
+import os
+from hashlib import sha1, sha256
+from multiprocessing import cpu_count
+from threading import Event
+from time import time
+from unittest import skipUnless
+
+from Tribler.Core.APIImplementation.maketorrent import makeinfo, MERKLE_BLOCK_SIZE
+from Tribler.Test.Core.base_test import TriblerCoreTest
+
+
+class TriblerCoreTestMakeTorrent(TriblerCoreTest):
+
+    # Includes empty files and files that are smaller than a piece, so pieces span several files
+    FILE_SIZES = [0, 1, 5000, 2 ** 15, 100000, 3 * 1024 * 1024 + 17, 0, 2 ** 15 + 1]
+
+    def setUp(self, annotate=True):
+        super(TriblerCoreTestMakeTorrent, self).setUp(annotate=annotate)
+        self.content_dir = os.path.join(self.session_base_dir, u"content")
+        os.mkdir(self.content_dir)
+
+    def create_files(self, sizes):
+        contents = []
+        for index, size in enumerate(sizes):
+            content = os.urandom(size)
+            with open(os.path.join(self.content_dir, u"file%03d" % index), "wb") as f:
+                f.write(content)
+            contents.append(content)
+        return contents
+
+    def get_input(self, piece_length=0):
+        return {'encoding': 'utf-8', 'files': [{'inpath': self.content_dir, 'outpath': u"content"}],
+                'piece length': piece_length, 'name': u"content"}
+
+    @staticmethod
+    def hash_sequential(data, piece_length):
+        return ''.join(sha1(data[offset:offset + piece_length]).digest()
+                       for offset in xrange(0, len(data), piece_length))
+
+    def test_pieces(self):
+        """
+        The pieces hashed by the workers should be the same as when hashing all data sequentially.
+        """
+        data = ''.join(self.create_files(self.FILE_SIZES))
+        for piece_length in [2 ** 15, 2 ** 20, 2 ** 25]:
+            for num_workers in [1, 4]:
+                info, _ = makeinfo(self.get_input(piece_length), None, None, num_workers=num_workers)
+                self.assertEqual(info['pieces'], self.hash_sequential(data, piece_length))
+                self.assertEqual([f['length'] for f in info['files']], self.FILE_SIZES)
+
+    def test_progress(self):
+        self.create_files(self.FILE_SIZES)
+        progress = []
+        makeinfo(self.get_input(), None, progress.append, num_workers=2)
+        self.assertTrue(progress)
+        self.assertEqual(progress[-1], 1.0)
+        self.assertEqual(progress, sorted(progress))
+
+    def test_progress_merkle(self):
+        """
+        The progress should run from 0 to 1 once over both the pieces and the merkle roots.
+        """
+        self.create_files(self.FILE_SIZES)
+        progress = []
+        makeinfo(self.get_input(), None, progress.append, merkle=True)
+        self.assertIn(0.5, progress)
+        self.assertEqual(progress.count(1.0), 1)
+        self.assertEqual(progress[-1], 1.0)
+        self.assertEqual(progress, sorted(progress))
+
+    def test_abort(self):
+        self.create_files(self.FILE_SIZES)
+        abort = Event()
+        abort.set()
+        self.assertEqual(makeinfo(self.get_input(), abort, None, num_workers=2), (None, None))
+
+    def test_merkle(self):
+        contents = self.create_files([0, 100, MERKLE_BLOCK_SIZE, 3 * MERKLE_BLOCK_SIZE + 1])
+        info, _ = makeinfo(self.get_input(), None, None, merkle=True)
+
+        self.assertNotIn('pieces root', info['files'][0])
+        self.assertEqual(info['files'][1]['pieces root'], sha256(contents[1]).digest())
+        self.assertEqual(info['files'][2]['pieces root'], sha256(contents[2]).digest())
+
+        leaves = [sha256(contents[3][offset:offset + MERKLE_BLOCK_SIZE]).digest()
+                  for offset in xrange(0, len(contents[3]), MERKLE_BLOCK_SIZE)]
+        leaves.extend(['\0' * 32] * (4 - len(leaves)))
+        root = sha256(sha256(leaves[0] + leaves[1]).digest() + sha256(leaves[2] + leaves[3]).digest()).digest()
+        self.assertEqual(info['files'][3]['pieces root'], root)
+
+    @skipUnless(os.environ.get('TRIBLER_BENCHMARK'), "writes and hashes 138 MB, set TRIBLER_BENCHMARK to run it")
+    def test_benchmark(self):
+        """
+        Hash a synthetic tree of a few large and many small files.
+        """
+        sizes = [32 * 1024 * 1024 + 1] * 4 + [100 * 1024 + 3] * 100
+        self.create_files(sizes)
+        total_size = float(sum(sizes)) / 1024 / 1024
+
+        for num_workers in sorted({1, max(2, cpu_count())}):
+            start = time()
+            info, _ = makeinfo(self.get_input(), None, None, num_workers=num_workers)
+            duration = time() - start
+
+            self.assertTrue(info['pieces'])
+            self._logger.info("%d workers: hashed %.0f MB in %.2f seconds (%.1f MB/s)",
+                              num_workers, total_size, duration, total_size / duration)
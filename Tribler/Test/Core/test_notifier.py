@@ -71,3 +71,30 @@ class TriblerCoreTestNotifier(TriblerCoreTest):
         notifier.notify(NTFY_TORRENTS, NTFY_STARTED, None)
         notifier.remove_observers()
         self.assertEqual(len(notifier.observertimers), 0)
+
+    def test_notifier_cache_coalesce(self):
+        notifier = Notifier(False)
+        notifier.add_observer(self.cache_callback_func, NTFY_TORRENTS, [NTFY_STARTED], cache=0.1)
+        for _ in xrange(3):
+            notifier.notify(NTFY_TORRENTS, NTFY_STARTED, None)
+        self.wait_for_callback()
+        self.assertEqual(notifier.events_coalesced, 2)
+        self.assertEqual(notifier.events_emitted, 3)
+        self.assertEqual(notifier.events_delivered, 3)
+
+    def test_notifier_counts_events(self):
+        notifier = Notifier(False)
+        notifier.add_observer(self.callback_func, NTFY_TORRENTS, [NTFY_STARTED])
+        notifier.add_observer(lambda *args: None, NTFY_TORRENTS, [NTFY_STARTED])
+        notifier.notify(NTFY_TORRENTS, NTFY_STARTED, None)
+        self.assertEqual(notifier.events_emitted, 1)
+        self.assertEqual(notifier.events_delivered, 2)
+
+    def test_notifier_cache_remove_observer(self):
+        notifier = Notifier(False)
+        notifier.add_observer(self.cache_callback_func, NTFY_TORRENTS, [NTFY_STARTED], cache=10)
+        notifier.notify(NTFY_TORRENTS, NTFY_STARTED, None)
+        notifier.remove_observer(self.cache_callback_func)
+        self.assertEqual(notifier.events_dropped, 1)
+        self.assertFalse(notifier.observer_index)
+        notifier.remove_observers()
@@ -1,4 +1,7 @@
-from Tribler.Core.Utilities.search_utils import split_into_keywords, filter_keywords
+from struct import pack
+
+from Tribler.Core.Utilities.search_utils import (split_into_keywords, filter_keywords, unpack_matchinfo, search_rank,
+                                                 levenshtein, TrigramIndex, CompletionIndex)
 from Tribler.Test.Core.base_test import TriblerCoreTest
 
 
@@ -17,3 +20,55 @@ class TriblerCoreTestSearchUtils(TriblerCoreTest):
         result = filter_keywords(["to", "be", "or", "not", "to", "be"])
         self.assertIsInstance(result, list)
         self.assertEqual(len(result), 4)
+
+    def test_unpack_matchinfo(self):
+        matchinfo = pack('II' + 'I' * 6, 1, 2, 1, 3, 2, 0, 1, 1)
+        self.assertEqual(unpack_matchinfo(matchinfo), [[(1, 3, 2), (0, 1, 1)]])
+
+    def test_search_rank(self):
+        rare_match = pack('II' + 'I' * 9, 1, 3, 1, 1, 1, 0, 0, 0, 0, 0, 0)
+        common_match = pack('II' + 'I' * 9, 1, 3, 1, 500, 500, 0, 0, 0, 0, 0, 0)
+        self.assertGreater(search_rank(rare_match, 1000, 0, 0), search_rank(common_match, 1000, 0, 0))
+        self.assertGreater(search_rank(rare_match, 1000, 10, 0), search_rank(rare_match, 1000, 0, 0))
+        self.assertGreater(search_rank(rare_match, 1000, 0, 10), search_rank(rare_match, 1000, None, None))
+
+    def test_levenshtein(self):
+        self.assertEqual(levenshtein("kitten", "sitting"), 3)
+        self.assertEqual(levenshtein("", "abc"), 3)
+        self.assertEqual(levenshtein("abc", "abc"), 0)
+
+    def test_trigram_index(self):
+        index = TrigramIndex()
+        for term in ["content", "contest", "context", "ubuntu", "linux"]:
+            index.add(term)
+        index.add("contest", 10)
+
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.get_frequency("contest"), 11)
+        self.assertEqual(index.find("contnt", 1), [(1, "content")])
+        self.assertEqual(index.find("contet", 1), [(1, "contest"), (1, "content"), (1, "context")])
+        self.assertEqual(index.find("contet", 1, limit=1), [(1, "contest")])
+        self.assertEqual(index.find("windows", 2), [])
+
+    def test_trigram_index_remove(self):
+        index = TrigramIndex()
+        index.add("content", 2)
+        index.remove("content")
+        self.assertEqual(index.find("content", 1), [(0, "content")])
+        index.remove("content")
+        self.assertEqual(index.find("content", 1), [])
+        self.assertNotIn("content", index)
+
+    def test_completion_index(self):
+        index = CompletionIndex({u"content": 3, u"contest": 5, u"context": 1, u"ubuntu": 10})
+        self.assertEqual(index.complete(u"cont", 2), [u"contest", u"content"])
+        self.assertEqual(index.complete(u"conte", 10), [u"contest", u"content", u"context"])
+        self.assertEqual(index.complete(u"x", 10), [])
+
+        index.add(u"contract", 4)
+        index.add(u"context", 10)
+        self.assertEqual(index.complete(u"con", 2), [u"context", u"contest"])
+
+        index.remove(u"context", 11)
+        self.assertNotIn(u"context", index)
+        self.assertEqual(index.complete(u"conte", 10), [u"contest", u"content"])
@@ -1,6 +1,6 @@
 import os
 
-from apsw import SQLError, CantOpenError
+from apsw import SQLError, CantOpenError, ReadOnlyError
 
 import shutil
 from unittest import skipIf
@@ -8,7 +8,9 @@ from nose.tools import raises
 import sys
 
 from Tribler.Test.Core.base_test import TriblerCoreTest
-from Tribler.Core.CacheDB.sqlitecachedb import SQLiteCacheDB, DB_SCRIPT_NAME, CorruptedDatabaseError
+from Tribler.Core.CacheDB.sqlitecachedb import (SQLiteCacheDB, DB_SCRIPT_NAME, CorruptedDatabaseError,
+                                                ReadConnectionPool)
+from Tribler.Core.Utilities.twisted_thread import deferred
 from Tribler.dispersy.util import blocking_call_on_reactor_thread
 
 
@@ -194,3 +196,104 @@ class TestSqliteCacheDB(TriblerCoreTest):
         self.sqlite_test.update('person', "lastname == '4'", firstname=654, lastname=44)
         one = self.sqlite_test.fetchone("select firstname from person where lastname == 44")
         self.assertEqual(one, 654)
+
+    @deferred(timeout=10)
+    def test_fetchall_async(self):
+        self.test_insertmany()
+
+        def on_result(rows):
+            self.assertEqual(len(rows), 100)
+
+        return self.sqlite_test.fetchall_async(u"SELECT * FROM person").addCallback(on_result)
+
+    @deferred(timeout=10)
+    def test_fetch_async_sees_pending_writes(self):
+        """
+        Queries on the DB worker see the writes that are pending in its transaction, the read-only connections only see
+        them once they have been committed.
+        """
+        sqlite_test_2 = SQLiteCacheDB(os.path.join(self.session_base_dir, "test_db.db"))
+        sqlite_test_2.initialize()
+        sqlite_test_2.execute(u"CREATE TABLE person(lastname, firstname);")
+        sqlite_test_2.initial_begin()
+        sqlite_test_2.insert('person', lastname='a', firstname='b')
+
+        def on_result(firstname):
+            self.assertEqual(firstname, 'b')
+            self.assertEqual(sqlite_test_2.fetchall(u"SELECT * FROM person", read_only=True), [])
+            return sqlite_test_2.commit_now()
+
+        def on_commit(_):
+            self.assertEqual(sqlite_test_2.fetchall(u"SELECT * FROM person", read_only=True), [('a', 'b')])
+            sqlite_test_2.close()
+
+        return sqlite_test_2.fetchone_async(u"SELECT firstname FROM person WHERE lastname == 'a'")\
+            .addCallback(on_result).addCallback(on_commit)
+
+    @deferred(timeout=10)
+    def test_defer_to_db_worker(self):
+        self.test_create_db()
+
+        def insert_and_count():
+            self.sqlite_test.insert('person', lastname='a', firstname='b')
+            return self.sqlite_test.size('person')
+
+        def on_result(size):
+            self.assertEqual(size, 1)
+
+        return self.sqlite_test.defer_to_db_worker(insert_and_count).addCallback(on_result)
+
+    @blocking_call_on_reactor_thread
+    def test_transaction(self):
+        self.test_create_db()
+
+        with self.sqlite_test.transaction():
+            self.sqlite_test.execute_write(u"INSERT INTO person VALUES ('a', 'b')")
+        self.assertEqual(self.sqlite_test.size('person'), 1)
+
+        def insert_and_fail():
+            with self.sqlite_test.transaction():
+                self.sqlite_test.execute_write(u"INSERT INTO person VALUES ('c', 'd')")
+                raise RuntimeError()
+
+        self.assertRaises(RuntimeError, insert_and_fail)
+        self.assertEqual(self.sqlite_test.size('person'), 1)
+
+    @blocking_call_on_reactor_thread
+    def test_fetchall_read_only(self):
+        sqlite_test_2 = SQLiteCacheDB(os.path.join(self.session_base_dir, "test_db.db"))
+        sqlite_test_2.initialize()
+        sqlite_test_2.execute(u"CREATE TABLE person(lastname, firstname);")
+        sqlite_test_2.insert('person', lastname='a', firstname='b')
+
+        self.assertEqual(sqlite_test_2.fetchall(u"SELECT * FROM person", read_only=True), [('a', 'b')])
+        self.assertEqual(sqlite_test_2.fetchone(u"SELECT firstname FROM person", read_only=True), 'b')
+        sqlite_test_2.close()
+
+    @blocking_call_on_reactor_thread
+    @raises(ReadOnlyError)
+    def test_read_pool_no_write(self):
+        sqlite_test_2 = SQLiteCacheDB(os.path.join(self.session_base_dir, "test_db.db"))
+        sqlite_test_2.initialize()
+        sqlite_test_2.execute(u"CREATE TABLE person(lastname, firstname);")
+
+        pool = ReadConnectionPool(os.path.join(self.session_base_dir, "test_db.db"), 1)
+        with pool.connection() as connection:
+            connection.cursor().execute(u"INSERT INTO person VALUES ('a', 'b')")
+
+    @blocking_call_on_reactor_thread
+    def test_read_pool_bounded(self):
+        sqlite_test_2 = SQLiteCacheDB(os.path.join(self.session_base_dir, "test_db.db"))
+        sqlite_test_2.initialize()
+
+        pool = ReadConnectionPool(os.path.join(self.session_base_dir, "test_db.db"), 2)
+        with pool.connection() as connection_1:
+            with pool.connection() as connection_2:
+                self.assertNotEqual(connection_1, connection_2)
+                self.assertEqual(pool.num_connections, 2)
+        with pool.connection():
+            self.assertEqual(pool.num_connections, 2)
+
+        pool.close()
+        self.assertEqual(pool.num_connections, 0)
+        sqlite_test_2.close()
@@ -8,6 +8,7 @@ from Tribler.Core.CacheDB.sqlitecachedb import str2bin, SQLiteCacheDB, DB_SCRIPT
 from Tribler.Core.Session import Session
 from Tribler.Core.SessionConfig import SessionStartupConfig
 from Tribler.Test.Core.base_test import TriblerCoreTest
+from Tribler.Core.Utilities.twisted_thread import deferred
 from Tribler.Test.test_as_server import TESTS_DATA_DIR
 from Tribler.dispersy.util import blocking_call_on_reactor_thread
 
@@ -78,3 +79,17 @@ class TestSqliteBasicDBHandler(AbstractDB):
     def test_size(self):
         size = self.db.size()  # there are 3995 peers in the table, however the upgrade scripts remove 8 superpeers
         assert size == 3987, size
+
+    @deferred(timeout=10)
+    def test_get_one_async(self):
+        def on_result(name):
+            self.assertEqual(name, self.db.getOne(u"name", peer_id=7))
+
+        return self.db.getOneAsync(u"name", peer_id=7).addCallback(on_result)
+
+    @deferred(timeout=10)
+    def test_get_all_async(self):
+        def on_result(rows):
+            self.assertEqual(len(rows), 10)
+
+        return self.db.getAllAsync(u"peer_id", limit=10).addCallback(on_result)
@@ -1,10 +1,14 @@
 from binascii import unhexlify
+from hashlib import sha1
 import os
+from time import time
 from shutil import copy as copyfile
+from twisted.internet.threads import deferToThread
 from Tribler.Category.Category import Category
 from Tribler.Core.CacheDB.SqliteCacheDBHandler import TorrentDBHandler, MyPreferenceDBHandler
-from Tribler.Core.CacheDB.sqlitecachedb import str2bin
+from Tribler.Core.CacheDB.sqlitecachedb import str2bin, bin2str
 from Tribler.Core.TorrentDef import TorrentDef
+from Tribler.Core.Utilities.twisted_thread import deferred
 from Tribler.Core.leveldbstore import LevelDbStore
 from Tribler.Test.Core.test_sqlitecachedbhandler import AbstractDB
 from Tribler.Test.test_as_server import TESTS_DATA_DIR
@@ -202,6 +206,57 @@ class TestTorrentDBHandler(AbstractDB):
                                          [], 1234)
         self.assertFalse(self.tdb.getTorrentID(infohash))
 
+    @blocking_call_on_reactor_thread
+    def test_add_external_torrents(self):
+        single_tdef = TorrentDef.load(S_TORRENT_PATH_BACKUP)
+        multiple_tdef = TorrentDef.load(M_TORRENT_PATH_BACKUP)
+        old_size = self.tdb.size()
+
+        added = self.tdb.addExternalTorrents([single_tdef, (multiple_tdef, {'status': u'good'}), single_tdef])
+        self.assertItemsEqual(added, [single_tdef.get_infohash(), multiple_tdef.get_infohash()])
+        self.assertEqual(self.tdb.size(), old_size + 2)
+
+        multiple_torrent_id = self.tdb.getTorrentID(multiple_tdef.get_infohash())
+        self.assertEqual(self.tdb.getOne('status', torrent_id=multiple_torrent_id), u'good')
+        self.assertEqual(len(self.tdb.getTrackerListByInfohash(multiple_tdef.get_infohash())), 8)
+        swarmname = self.tdb._db.fetchone(u"SELECT swarmname FROM FullTextIndex WHERE rowid = ?",
+                                          (multiple_torrent_id,))
+        self.assertIn(u"tribler", swarmname)
+
+    @blocking_call_on_reactor_thread
+    def test_add_external_torrents_no_def(self):
+        existing = str2bin('AA8cTG7ZuPsyblbRE7CyxsrKUCg=')
+        one_file = unhexlify('49865489ac16e2f34ea0cd3043cfd970cc24ec09')
+        more_files = unhexlify('50865489ac16e2f34ea0cd3043cfd970cc24ec09')
+        invalid = unhexlify('51865489ac16e2f34ea0cd3043cfd970cc24ec09')
+
+        added = self.tdb.addExternalTorrentsNoDef([
+            (existing, u"test torrent", [(u"file1", 42)], [], 1234, {}),
+            (one_file, u"test torrent", [(u"file1", 42)], [u'http://localhost/announce'], 1234, {}),
+            (more_files, u"test torrent", [(u"file1", 42), (u"file2", 43)], [], 1234, {"seeder": 2, "leecher": 3}),
+            (invalid, u"test torrent", [(u"file1", {}), (u"file2", 43)], [], 1234, {})])
+
+        self.assertItemsEqual(added, [one_file, more_files])
+        self.assertIn(u'http://localhost/announce', self.tdb.getTrackerListByInfohash(one_file))
+        self.assertEqual(self.tdb.getOne('num_seeders', infohash=bin2str(more_files)), 2)
+        self.assertFalse(self.tdb.getTorrentID(invalid))
+
+    @blocking_call_on_reactor_thread
+    def test_add_external_torrents_no_def_benchmark(self):
+        num_torrents = 10000
+        trackers = [u'http://tracker%d.example.com/announce' % (i % 50) for i in xrange(num_torrents)]
+        torrents = [(sha1(str(i)).digest(), u"benchmark torrent %d" % i, [(u"file%d.mkv" % i, i + 1)], [trackers[i]],
+                     1234, {}) for i in xrange(num_torrents)]
+
+        start = time()
+        added = self.tdb.addExternalTorrentsNoDef(torrents)
+        duration = time() - start
+        self._logger.info(u"Added a batch of %d torrents in %.2f seconds (%.0f rows/sec)",
+                          num_torrents, duration, num_torrents / duration)
+
+        self.assertEqual(len(added), num_torrents)
+        self.assertItemsEqual(self.tdb.getTrackerListByInfohash(torrents[-1][0]), [u'DHT', trackers[-1]])
+
     @blocking_call_on_reactor_thread
     def test_add_get_torrent_id(self):
         infohash = str2bin('AA8cTG7ZuPsyblbRE7CyxsrKUCg=')
@@ -237,14 +292,116 @@ class TestTorrentDBHandler(AbstractDB):
         self.session.lm.torrent_store.close()
         self.assertEqual(res, old_res-20)
 
+    @blocking_call_on_reactor_thread
+    def test_search_names(self):
+        results = self.tdb.searchNames(["content"], keys=['infohash', 'T.name', 'num_seeders'])
+        self.assertTrue(results)
+        for result in results:
+            self.assertIn('content', result[4]['swarmname'] | result[4]['filenames'])
+            self.assertEqual(len(result), 15)
+
+    @blocking_call_on_reactor_thread
+    def test_search_names_remote_limit(self):
+        results = self.tdb.searchNames(["content"], local=False, keys=['infohash', 'T.name'])
+        self.assertLessEqual(len(results), 25)
+
+    @blocking_call_on_reactor_thread
+    def test_search_names_page(self):
+        keys = ['infohash', 'T.name']
+        all_results = self.tdb.searchNames(["content"], keys=keys)
+
+        first_page, after = self.tdb.searchNamesPage(["content"], keys, limit=1)
+        self.assertEqual(len(first_page), 1)
+        self.assertEqual(first_page[0][0], all_results[0][0])
+        if len(all_results) > 1:
+            second_page, _ = self.tdb.searchNamesPage(["content"], keys, limit=1, after=after)
+            self.assertEqual(second_page[0][0], all_results[1][0])
+            offset_page, _ = self.tdb.searchNamesPage(["content"], keys, limit=1, offset=1)
+            self.assertEqual(offset_page[0][0], all_results[1][0])
+
+    @blocking_call_on_reactor_thread
+    def test_search_names_offset_without_limit(self):
+        keys = ['infohash', 'T.name']
+        all_results = self.tdb.searchNames(["content"], keys=keys)
+        results = self.tdb.searchNames(["content"], keys=keys, offset=1)
+        self.assertEqual([result[0] for result in results], [result[0] for result in all_results[1:]])
+
+    @deferred(timeout=10)
+    def test_search_names_uncommitted(self):
+        """
+        Searches run on the read connections, which only see torrents that have been committed.
+        """
+        self.sqlitedb.initial_begin()
+        infohash = unhexlify('51865489ac16e2f34ea0cd3043cfd970cc24ec09')
+        self.tdb.addExternalTorrentNoDef(infohash, "xyzzyfoo torrent", [("file1", 42)], [], 1234)
+        self.assertEqual(self.tdb.searchNames(["xyzzyfoo"], keys=['infohash', 'T.name']), [])
+
+        def on_commit(_):
+            results = self.tdb.searchNames(["xyzzyfoo"], keys=['infohash', 'T.name'])
+            self.assertEqual([result[0] for result in results], [infohash])
+
+        return self.sqlitedb.commit_now().addCallback(on_commit)
+
+    @deferred(timeout=10)
+    def test_search_names_async(self):
+        self.sqlitedb.initial_begin()
+        infohash = unhexlify('52865489ac16e2f34ea0cd3043cfd970cc24ec09')
+        self.tdb.addExternalTorrentNoDef(infohash, "xyzzyfoo torrent", [("file1", 42)], [], 1234)
+
+        def on_results(results):
+            self.assertEqual([result[0] for result in results], [infohash])
+
+        return self.tdb.searchNamesAsync(["xyzzyfoo"], keys=['infohash', 'T.name']).addCallback(on_results)
+
     @blocking_call_on_reactor_thread
     def test_get_search_suggestions(self):
         self.assertEqual(self.tdb.getSearchSuggestion(["content", "cont"]), ["Content 1"])
 
+    @blocking_call_on_reactor_thread
+    def test_search_suggestion_index_updated(self):
+        self.assertEqual(self.tdb.getSearchSuggestion(["xyzzyfoa"]), [])
+        self.tdb._indexTorrent(1234567, u"xyzzyfoo", [])
+        self.assertEqual(self.tdb.getSearchSuggestion(["xyzzyfoa"]), [u"xyzzyfoo"])
+
     @blocking_call_on_reactor_thread
     def test_get_autocomplete_terms(self):
         self.assertEqual(len(self.tdb.getAutoCompleteTerms("content", 100)), 0)
 
+    @blocking_call_on_reactor_thread
+    def test_autocomplete_index_updated(self):
+        self.tdb._indexTorrent(1234567, u"xyzzyfoo", [])
+        self.assertEqual(self.tdb.getAutoCompleteTerms("xyzzy", 10), [u"xyzzyfoo"])
+
+    @blocking_call_on_reactor_thread
+    def test_autocomplete_index_reindexed(self):
+        """
+        Re-indexing a torrent should replace the terms of its old swarmname, instead of counting them again.
+        """
+        self.assertEqual(self.tdb.getAutoCompleteTerms("xyzzy", 10), [])
+        self.tdb._indexTorrent(1234567, u"xyzzyfoo", [])
+        self.tdb._indexTorrent(1234567, u"xyzzyfoo", [])
+        self.tdb._indexTorrents([(1234567, u"xyzzyfoo", [])])
+        self.assertEqual(self.tdb._completion_index.get_frequency(u"xyzzyfoo"), 1)
+
+        self.tdb._indexTorrent(1234567, u"xyzzybar", [])
+        self.assertEqual(self.tdb.getAutoCompleteTerms("xyzzy", 10), [u"xyzzybar"])
+
+    @deferred(timeout=10)
+    def test_autocomplete_waits_for_load(self):
+        """
+        Looking up terms while the term indexes are loaded in the background should wait for that load, instead of
+        loading them a second time. The reactor thread cannot wait, so it gets no terms until the load is done.
+        """
+        self.tdb._load_term_indexes_now = lambda: self.fail(u"The term indexes were loaded twice")
+        self.tdb._load_term_indexes()
+        self.tdb._indexTorrent(1234567, u"xyzzyfoo", [])
+        self.assertEqual(self.tdb.getAutoCompleteTerms("xyzzy", 10), [])
+
+        def on_terms(terms):
+            self.assertEqual(terms, [u"xyzzyfoo"])
+
+        return deferToThread(self.tdb.getAutoCompleteTerms, "xyzzy", 10).addCallback(on_terms)
+
     @blocking_call_on_reactor_thread
     def test_get_recently_randomly_collected_torrents(self):
         self.assertEqual(len(self.tdb.getRecentlyCollectedTorrents(limit=10)), 10)
@@ -4,8 +4,9 @@ This file contains the tests for the community.py for MultiChain community.
 import time
 from Tribler.Core.Session import Session
 from Tribler.community.multichain.community import (MultiChainCommunity, MultiChainCommunityCrawler, CRAWL_REQUEST,
-                                                    CRAWL_RESPONSE, CRAWL_RESUME)
-from Tribler.community.multichain.conversion import EMPTY_HASH
+                                                    CRAWL_RESPONSE, CRAWL_RESUME, CRAWL_RESUME_FROM)
+from Tribler.community.multichain.conversion import EMPTY_HASH, GENESIS_ID
+from Tribler.Test.test_multichain_utilities import TestBlock
 from Tribler.community.tunnel.routing import Circuit, RelayRoute
 from Tribler.community.tunnel.tunnel_community import TunnelExitSocket
 from Tribler.Test.test_as_server import AbstractServer
@@ -452,12 +453,15 @@ class TestMultiChainCommunity(AbstractServer, DispersyTestFunc):
         _, signature_response = node.receive_message(names=[u"dispersy-signature-response"]).next()
         node.give_message(signature_response, node)
 
+        # Only send one block per crawl request, so the crawler has to resume
+        node.community.crawl_page_size = 1
+
         # Act
         # Request the same block
         crawler.call(crawler.community.send_crawl_request, target_node_from_crawler)
         _, block_request = node.receive_message(names=[CRAWL_REQUEST]).next()
         node.give_message(block_request, crawler)
-        for _, block_response in crawler.receive_message(names=[CRAWL_RESPONSE, CRAWL_RESUME]):
+        for _, block_response in crawler.receive_message(names=[CRAWL_RESPONSE, CRAWL_RESUME_FROM, CRAWL_RESUME]):
             crawler.give_message(block_response, node)
             print "Got another block, %s" % block_response
 
@@ -471,6 +475,77 @@ class TestMultiChainCommunity(AbstractServer, DispersyTestFunc):
         self.assertBlocksInDatabase(crawler, 2)
         self.assertBlocksAreEqual(node, crawler)
 
+    def test_crawl_resume_before_resume_from(self):
+        """
+        Test that the crawler sends a single crawl request when the crawl resume message overtakes the crawl resume
+        from message.
+        """
+        # Arrange
+        node, other, crawler = self.create_nodes(3)
+        other.send_identity(node)
+        other.send_identity(crawler)
+        node.send_identity(crawler)
+
+        target_other_from_node = self._create_target(node, other)
+        target_node_from_crawler = self._create_target(crawler, node)
+
+        for _ in xrange(2):
+            node.call(node.community.publish_signature_request_message, target_other_from_node, 5, 5)
+            _, signature_request = other.receive_message(names=[u"dispersy-signature-request"]).next()
+            other.give_message(signature_request, node)
+            _, signature_response = node.receive_message(names=[u"dispersy-signature-response"]).next()
+            node.give_message(signature_response, node)
+
+        node.community.crawl_page_size = 1
+        crawler.call(crawler.community.send_crawl_request, target_node_from_crawler)
+        _, block_request = node.receive_message(names=[CRAWL_REQUEST]).next()
+        node.give_message(block_request, crawler)
+        _, block_response = crawler.receive_message(names=[CRAWL_RESPONSE]).next()
+        crawler.give_message(block_response, node)
+        _, resume_from = crawler.receive_message(names=[CRAWL_RESUME_FROM]).next()
+        _, resume = crawler.receive_message(names=[CRAWL_RESUME]).next()
+        task_name = crawler.community._get_crawl_resume_task_name(node.my_pub_member.mid)
+
+        # Act
+        crawler.give_message(resume, node)
+        resume_pending = crawler.community.is_pending_task_active(task_name)
+        crawler.give_message(resume_from, node)
+
+        # Assert
+        self.assertTrue(resume_pending)
+        self.assertFalse(crawler.community.is_pending_task_active(task_name))
+        self.assertIn(node.my_pub_member.mid, crawler.community._resume_from_mids)
+        _, block_request = node.receive_message(names=[CRAWL_REQUEST]).next()
+        self.assertEqual(block_request.payload.requested_sequence_number, 1)
+
+    def test_crawl_response_chain_linkage(self):
+        """
+        Test that crawled blocks that do not link to the chain of their requester are not persisted.
+        """
+        # Arrange
+        [node] = self.create_nodes(1)
+        public_key = node.community._public_key
+        blocks = [TestBlock() for _ in xrange(5)]
+        for block, sequence_number in zip(blocks, [0, 1, 1, 2, 4]):
+            block.public_key_requester = public_key
+            block.sequence_number_requester = sequence_number
+        blocks[0].previous_hash_requester = GENESIS_ID
+        blocks[1].previous_hash_requester = blocks[0].hash_requester
+        # Claims a sequence number that is already taken
+        blocks[2].previous_hash_requester = blocks[0].hash_requester
+        # Does not point to the previous block
+        blocks[3].previous_hash_requester = EMPTY_HASH
+        # The previous block is unknown
+        blocks[4].previous_hash_requester = EMPTY_HASH
+        node.call(node.community.persistence.add_block, blocks[0])
+
+        # Act
+        result = node.call(node.community._get_linked_blocks, blocks[1:])
+
+        # Assert
+        self.assertEqual([blocks[1].hash_requester, blocks[4].hash_requester],
+                         [block.hash_requester for block in result])
+
     def test_crawler_on_introduction_received(self):
         """
         Test the crawler takes a step when an introduction is made by the walker
@@ -4,9 +4,10 @@ from struct import unpack
 from Tribler.Test.test_multichain_utilities import TestBlock, MultiChainTestCase
 from Tribler.community.multichain.conversion import (MultiChainConversion, split_function, signature_format,
                                                      append_format)
-from Tribler.community.multichain.community import SIGNATURE, CRAWL_REQUEST, CRAWL_RESPONSE, CRAWL_RESUME
+from Tribler.community.multichain.community import (SIGNATURE, CRAWL_REQUEST, CRAWL_RESPONSE, CRAWL_RESUME,
+                                                    CRAWL_RESUME_FROM)
 from Tribler.community.multichain.payload import (SignaturePayload, CrawlRequestPayload, CrawlResponsePayload,
-                                                  CrawlResumePayload)
+                                                  CrawlResumePayload, CrawlResumeFromPayload)
 from Tribler.community.multichain.conversion import EMPTY_HASH
 from Tribler.dispersy.community import Community
 from Tribler.dispersy.authentication import NoAuthentication
@@ -143,6 +144,43 @@ class TestConversion(MultiChainTestCase):
         # Assert
         self.assertEqual(-1, result.requested_sequence_number)
 
+    def test_encoding_crawl_resume(self):
+        """
+        Test if a crawl resume message has an empty payload, as older versions expect.
+        """
+        # Arrange
+        meta = self.community.get_meta_message(CRAWL_RESUME)
+        message = meta.impl(distribution=(self.community.claim_global_time(),), payload=())
+        # Act
+        encoded_message = self.converter._encode_crawl_resume(message)[0]
+        # Assert
+        self.assertEqual('', encoded_message)
+
+    def test_encoding_decoding_crawl_resume_from(self):
+        """
+        Test if a responder can send a crawl resume from message with the sequence number to continue at.
+        """
+        # Arrange
+        meta = self.community.get_meta_message(CRAWL_RESUME_FROM)
+        resume_sequence_number = 500
+        message = meta.impl(distribution=(self.community.claim_global_time(),),
+                            payload=(resume_sequence_number,))
+        # Act
+        encoded_message = self.converter._encode_crawl_resume_from(message)[0]
+        result = self.converter._decode_crawl_resume_from(TestPlaceholder(meta), 0, encoded_message)[1]
+        # Assert
+        self.assertEqual(resume_sequence_number, result.resume_sequence_number)
+
+    def test_decoding_crawl_resume_from_empty(self):
+        """
+        Test if a crawl resume from message without a sequence number is dropped.
+        """
+        # Arrange
+        meta = self.community.get_meta_message(CRAWL_RESUME_FROM)
+        # Act & Assert
+        with self.assertRaises(DropPacket):
+            self.converter._decode_crawl_resume_from(TestPlaceholder(meta), 0, '')
+
     def test_encoding_decoding_crawl_response(self):
         """
         Test if a responder can send a crawl_response message.
@@ -257,6 +295,14 @@ class TestCommunity(Community):
                     CandidateDestination(),
                     CrawlResumePayload(),
                     lambda: None,
+                    lambda: None),
+            Message(self, CRAWL_RESUME_FROM,
+                    NoAuthentication(),
+                    PublicResolution(),
+                    DirectDistribution(),
+                    CandidateDestination(),
+                    CrawlResumeFromPayload(),
+                    lambda: None,
                     lambda: None)]
 
     def initiate_conversions(self):
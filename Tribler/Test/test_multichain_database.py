@@ -1,10 +1,14 @@
 import unittest
 import datetime
 import os
+from hashlib import sha256
 from math import pow
+from time import time
+from unittest import skipUnless
 from Tribler.Test.test_multichain_utilities import TestBlock, MultiChainTestCase
 from Tribler.community.multichain.database import MultiChainDB
 from Tribler.community.multichain.database import DATABASE_DIRECTORY
+from Tribler.community.multichain.conversion import EMPTY_HASH
 
 
 class TestDatabase(MultiChainTestCase):
@@ -204,3 +208,113 @@ class TestDatabase(MultiChainTestCase):
         self.assertEquals(time_difference.days, 0)
         self.assertLess(time_difference.seconds, 10,
                         "Difference in stored and retrieved time is too large.")
+
+    def test_add_blocks(self):
+        # Act
+        self.db.add_blocks([self.block1, self.block2])
+        # Assert
+        self.assertEqual_block(self.block1, self.db.get_by_hash_requester(self.block1.hash_requester))
+        self.assertEqual_block(self.block2, self.db.get_by_hash_requester(self.block2.hash_requester))
+
+    def test_get_known_hash_requester(self):
+        # Arrange
+        self.db.add_block(self.block1)
+        # Act & Assert
+        self.assertEqual({self.block1.hash_requester},
+                         self.db.get_known_hash_requester([self.block1.hash_requester, self.block2.hash_requester]))
+        self.assertEqual(set(), self.db.get_known_hash_requester([]))
+
+    def test_get_blocks_since(self):
+        """
+        Test if the blocks of a member are returned in order of sequence number, whatever its role in the block.
+        """
+        # Arrange
+        public_key = self.block1.public_key_requester
+        for sequence_number in xrange(5):
+            block = TestBlock()
+            if sequence_number % 2:
+                block.public_key_responder = public_key
+                block.sequence_number_responder = sequence_number
+            else:
+                block.public_key_requester = public_key
+                block.sequence_number_requester = sequence_number
+            self.db.add_block(block)
+        # Act
+        result = self.db.get_blocks_since(public_key, 1, 3)
+        # Assert
+        self.assertEqual([1, 2, 3], [block.sequence_number_requester if block.public_key_requester == public_key
+                                     else block.sequence_number_responder for block in result])
+        self.assertEqual(2, len(self.db.get_blocks_since(public_key, 3)))
+
+    def test_get_latest_after_add_block(self):
+        """
+        Test if the latest block of a member is updated when a block is added after it was looked up.
+        """
+        # Arrange
+        self.db.add_block(self.block1)
+        self.assertEqual(self.block1.sequence_number_requester,
+                         self.db.get_latest_sequence_number(self.block1.public_key_requester))
+        self.block2.public_key_responder = self.block1.public_key_requester
+        self.block2.sequence_number_responder = self.block1.sequence_number_requester + 1
+        # Act
+        self.db.add_block(self.block2)
+        # Assert
+        self.assertEqual(self.block2.sequence_number_responder,
+                         self.db.get_latest_sequence_number(self.block1.public_key_requester))
+        self.assertEqual(self.block2.hash_responder, self.db.get_latest_hash(self.block1.public_key_requester))
+        self.assertEqual((self.block2.total_up_responder, self.block2.total_down_responder),
+                         self.db.get_total(self.block1.public_key_requester))
+
+    @skipUnless(os.environ.get('TRIBLER_BENCHMARK'), "inserts a million blocks, set TRIBLER_BENCHMARK to run it")
+    def test_benchmark(self):
+        """
+        Time the lookups of the crawler and of signing on a chain of a million blocks.
+        """
+        # Arrange
+        # The member is requester in the blocks with an even sequence number and responder in the others.
+        block_count = 1000000
+        public_key = self.block1.public_key_requester
+        other_keys = [buffer(TestBlock().public_key_requester) for _ in xrange(10)]
+
+        def generate_rows(first_sequence_number, count):
+            for sequence_number in xrange(first_sequence_number, first_sequence_number + count):
+                keys = (buffer(public_key), other_keys[sequence_number % 10])
+                if sequence_number % 2:
+                    keys = keys[::-1]
+                yield keys + (1, 1, sequence_number, sequence_number, sequence_number, buffer(EMPTY_HASH),
+                              buffer(EMPTY_HASH), buffer(sha256(str(sequence_number)).digest()),
+                              sequence_number, sequence_number, sequence_number, buffer(EMPTY_HASH),
+                              buffer(EMPTY_HASH), buffer(sha256(str(-sequence_number - 1)).digest()))
+
+        start = time()
+        for first_sequence_number in xrange(0, block_count, 10000):
+            self.db.executemany(
+                u"INSERT INTO multi_chain (public_key_requester, public_key_responder, up, down, "
+                u"total_up_requester, total_down_requester, sequence_number_requester, previous_hash_requester, "
+                u"signature_requester, hash_requester, "
+                u"total_up_responder, total_down_responder, sequence_number_responder, previous_hash_responder, "
+                u"signature_responder, hash_responder) "
+                u"VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                list(generate_rows(first_sequence_number, 10000)))
+        self.db.commit()
+        self._logger.info("Inserted %d blocks in %.2f seconds", block_count, time() - start)
+
+        # Act & Assert
+        start = time()
+        self.assertEqual(block_count - 1, self.db.get_latest_sequence_number(public_key))
+        self._logger.info("get_latest_sequence_number: %.2f ms", (time() - start) * 1000)
+
+        start = time()
+        self.assertEqual((block_count - 1, block_count - 1), self.db.get_total(public_key))
+        self.assertIsNotNone(self.db.get_latest_hash(public_key))
+        self._logger.info("get_total and get_latest_hash: %.2f ms", (time() - start) * 1000)
+
+        start = time()
+        self.assertEqual(block_count / 2, self.db.get_by_public_key_and_sequence_number(
+            public_key, block_count / 2).sequence_number_requester)
+        self._logger.info("get_by_public_key_and_sequence_number: %.2f ms", (time() - start) * 1000)
+
+        start = time()
+        blocks = self.db.get_blocks_since(public_key, block_count / 2, 100)
+        self.assertEqual(100, len(blocks))
+        self._logger.info("get_blocks_since: %.2f ms", (time() - start) * 1000)
@@ -343,6 +343,12 @@ class ChannelCommunity(Community):
                                           torrentdef.get_name_as_unicode(), tuple(files),
                                           torrentdef.get_trackers_as_single_tuple(), store, update, forward))
 
+    def _disp_create_torrents_from_torrentdefs(self, torrentdefs, timestamp, store=True, update=True, forward=True):
+        torrentlist = [(torrentdef.get_infohash(), timestamp, torrentdef.get_name_as_unicode(),
+                        tuple(torrentdef.get_files_as_unicode_with_length()),
+                        torrentdef.get_trackers_as_single_tuple()) for torrentdef in torrentdefs]
+        return self._disp_create_torrents(torrentlist, store, update, forward)
+
     def _disp_create_torrent(self, infohash, timestamp, name, files, trackers, store=True, update=True, forward=True):
         meta = self.get_meta_message(u"torrent")
 
@@ -8,6 +8,9 @@ Full documentation will be available at http://repository.tudelft.nl/.
 
 import logging
 import base64
+from binascii import hexlify
+from collections import OrderedDict
+from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from Tribler.Core.Session import Session
 from Tribler.Core.CacheDB.sqlitecachedb import forceDBThread
@@ -21,7 +24,7 @@ from Tribler.dispersy.conversion import DefaultConversion
 from Tribler.community.tunnel.routing import Circuit, RelayRoute
 from Tribler.community.tunnel.tunnel_community import TunnelExitSocket
 from Tribler.community.multichain.payload import (SignaturePayload, CrawlRequestPayload, CrawlResponsePayload,
-                                                  CrawlResumePayload)
+                                                  CrawlResumePayload, CrawlResumeFromPayload)
 from Tribler.community.multichain.database import MultiChainDB, DatabaseBlock
 from Tribler.community.multichain.conversion import MultiChainConversion, split_function, GENESIS_ID
 
@@ -29,9 +32,16 @@ SIGNATURE = u"signature"
 CRAWL_REQUEST = u"crawl_request"
 CRAWL_RESPONSE = u"crawl_response"
 CRAWL_RESUME = u"crawl_resume"
+CRAWL_RESUME_FROM = u"crawl_resume_from"
 
 # Divide by this to convert from bytes to MegaBytes.
 MEGA_DIVIDER = 1024 * 1024
+# Maximum number of blocks sent in response to one crawl request.
+CRAWL_PAGE_SIZE = 25
+# Maximum number of members that are remembered to send crawl resume from messages.
+RESUME_FROM_CACHE_SIZE = 1024
+# Seconds to wait for a crawl resume from message before a crawl resume message of an unknown member is acted upon.
+CRAWL_RESUME_DELAY = 2.0
 
 
 class MultiChainCommunity(Community):
@@ -53,6 +63,11 @@ class MultiChainCommunity(Community):
         # No response is expected yet.
         self.expected_response = None
 
+        self.crawl_page_size = CRAWL_PAGE_SIZE
+        # The mids of the members that send crawl resume from messages, their crawl resume messages are ignored.
+        # Least recently used first, at most RESUME_FROM_CACHE_SIZE.
+        self._resume_from_mids = OrderedDict()
+
     @classmethod
     def get_master_members(cls, dispersy):
         # generated: Wed Dec  3 10:31:16 2014
@@ -115,7 +130,15 @@ class MultiChainCommunity(Community):
                     CandidateDestination(),
                     CrawlResumePayload(),
                     self._generic_timeline_check,
-                    self.received_craw_resumption)]
+                    self.received_craw_resumption),
+            Message(self, CRAWL_RESUME_FROM,
+                    MemberAuthentication(),
+                    PublicResolution(),
+                    DirectDistribution(),
+                    CandidateDestination(),
+                    CrawlResumeFromPayload(),
+                    self._generic_timeline_check,
+                    self.received_crawl_resumption_from)]
 
     def initiate_conversions(self):
         return [DefaultConversion(self), MultiChainConversion(self)]
@@ -289,8 +312,14 @@ class MultiChainCommunity(Community):
             self.crawl_requested(message.candidate, message.payload.requested_sequence_number)
 
     def crawl_requested(self, candidate, sequence_number):
-        blocks = self.persistence.get_blocks_since(self._public_key, sequence_number)
+        """
+        Send a page of at most crawl_page_size blocks starting at sequence_number. If there are more blocks, a crawl
+        resume from message tells the crawler at which sequence number to continue. Older crawlers do not know that
+        message, so a crawl resume message is sent as well, after which they continue at their latest known block.
+        """
+        blocks = self.persistence.get_blocks_since(self._public_key, sequence_number, self.crawl_page_size + 1)
         if len(blocks) > 0:
+            blocks, next_blocks = blocks[:self.crawl_page_size], blocks[self.crawl_page_size:]
             self.logger.info("Crawler: Sending %d blocks", len(blocks))
             messages = [self.get_meta_message(CRAWL_RESPONSE)
                             .impl(authentication=(self.my_member,),
@@ -298,17 +327,20 @@ class MultiChainCommunity(Community):
                                   destination=(candidate,),
                                   payload=block.to_payload()) for block in blocks]
             self.dispersy.store_update_forward(messages, False, False, True)
-            if len(blocks) > 1:
-                # we sent more than 1 block. Send a resumption token so the other side knows it should continue crawling
-                # last_block = blocks[-1]
-                # resumption_number = last_block.sequence_number_requster if
-                # last_block.mid_requester == self._mid else last_block.sequence_number_responder
-                message = self.get_meta_message(CRAWL_RESUME).impl(authentication=(self.my_member,),
-                                                                   distribution=(self.claim_global_time(),),
-                                                                   destination=(candidate,),
-                                                                   # payload=(resumption_number))
-                                                                   payload=())
-                self.dispersy.store_update_forward([message], False, False, True)
+            if next_blocks:
+                next_block = next_blocks[0]
+                resume_sequence_number = next_block.sequence_number_requester \
+                    if next_block.public_key_requester == self._public_key else next_block.sequence_number_responder
+                messages = [self.get_meta_message(CRAWL_RESUME_FROM).impl(authentication=(self.my_member,),
+                                                                          distribution=(self.claim_global_time(),),
+                                                                          destination=(candidate,),
+                                                                          payload=(resume_sequence_number,)),
+                            self.get_meta_message(CRAWL_RESUME).impl(authentication=(self.my_member,),
+                                                                     distribution=(self.claim_global_time(),),
+                                                                     destination=(candidate,),
+                                                                     payload=())]
+                for message in messages:
+                    self.dispersy.store_update_forward([message], False, False, True)
         else:
             # This is slightly worrying since the last block should always be returned.
             # Or rather, the other side is requesting blocks starting from a point in the future.
@@ -316,21 +348,116 @@ class MultiChainCommunity(Community):
 
     def received_crawl_response(self, messages):
         self.logger.info("Crawler: Valid %d block response(s) received.", len(messages))
+        blocks = OrderedDict()
         for message in messages:
-            requester = self.dispersy.get_member(public_key=message.payload.public_key_requester)
-            responder = self.dispersy.get_member(public_key=message.payload.public_key_responder)
-            block = DatabaseBlock.from_block_response_message(message, requester, responder)
-            # Create the hash of the message
-            if not self.persistence.contains(block.hash_requester):
-                self.logger.info("Crawler: Persisting id: %s" % base64.encodestring(block.hash_requester).strip())
-                self.persistence.add_block(block)
+            block = DatabaseBlock.from_block_response_message(message)
+            blocks.setdefault(block.hash_requester, block)
+
+        known = self.persistence.get_known_hash_requester(blocks.iterkeys())
+        if known:
+            self.logger.info("Crawler: Received %d already known block(s)", len(known))
+        blocks = self._get_linked_blocks([block for block in blocks.itervalues() if block.hash_requester not in known])
+
+        if blocks:
+            self.logger.info("Crawler: Persisting %d block(s)", len(blocks))
+            self.persistence.add_blocks(blocks)
+
+    def _get_linked_blocks(self, blocks):
+        """
+        Check the chain linkage of a batch of crawled blocks. A block is dropped when, for either of its members, it
+        claims a sequence number that another block in the batch already claimed, or when its previous hash is not
+        the hash of the previous block of that member. The previous block is looked up in the batch, or in the
+        database when it is the latest block we know of that member.
+        Only the requester half of a block is hashed the same way by both members, so the previous hash is only
+        checked when the member was the requester of its previous block.
+        :param blocks: The new blocks
+        :return: list of the blocks that link up.
+        """
+        # (public key, sequence number) -> block of that member with that sequence number
+        chains = {}
+        conflicting = set()
+        for block in blocks:
+            for public_key, sequence_number, _ in self._get_block_links(block):
+                if chains.setdefault((public_key, sequence_number), block) is not block:
+                    conflicting.add(block.hash_requester)
+
+        linked_blocks = []
+        for block in blocks:
+            if block.hash_requester not in conflicting and all(self._is_linked(chains, *link)
+                                                               for link in self._get_block_links(block)):
+                linked_blocks.append(block)
             else:
-                self.logger.info("Crawler: Received already known block")
+                self.logger.warning("Crawler: Dropping block %s that does not link to its chain",
+                                    base64.encodestring(block.hash_requester).strip())
+        return linked_blocks
+
+    def _is_linked(self, chains, public_key, sequence_number, previous_hash):
+        """
+        Check if the previous hash of a member in a block matches the previous block of that member, if it is known.
+        :param chains: Dictionary (public key, sequence number) -> block of the crawled blocks
+        :return: False if the previous hash does not match, else True.
+        """
+        if sequence_number == 0:
+            return previous_hash == GENESIS_ID
+
+        previous_block = chains.get((public_key, sequence_number - 1))
+        if previous_block is None and self.persistence.get_latest_sequence_number(public_key) == sequence_number - 1:
+            previous_block = self.persistence.get_by_public_key_and_sequence_number(public_key, sequence_number - 1)
+        if previous_block is None or previous_block.public_key_requester != public_key or \
+                previous_block.sequence_number_requester != sequence_number - 1:
+            return True
+        return previous_hash == previous_block.hash_requester
+
+    @staticmethod
+    def _get_block_links(block):
+        """
+        :return: (public key, sequence number, previous hash) of the members that signed the block.
+        """
+        links = [(block.public_key_requester, block.sequence_number_requester, block.previous_hash_requester)]
+        # A block that the responder has not signed yet has no sequence number for the responder.
+        if block.sequence_number_responder >= 0:
+            links.append((block.public_key_responder, block.sequence_number_responder, block.previous_hash_responder))
+        return links
 
     def received_craw_resumption(self, messages):
+        """
+        Continue crawling older members at their latest known block. Members that also send crawl resume from messages
+        have already told us where to continue, so their crawl resume messages are ignored. As both messages are sent
+        separately, a crawl resume of a member that is not known to send them is only acted upon after
+        CRAWL_RESUME_DELAY, unless a crawl resume from message arrives in the meantime.
+        """
         self.logger.info("Crawler: Valid %s crawl resumptions received.", len(messages))
         for message in messages:
-            self.send_crawl_request(message.candidate)
+            mid = message.authentication.member.mid
+            if mid in self._resume_from_mids:
+                self._remember_resume_from(mid)
+                continue
+
+            task_name = self._get_crawl_resume_task_name(mid)
+            if not self.is_pending_task_active(task_name):
+                self.register_task(task_name, reactor.callLater(CRAWL_RESUME_DELAY, self.send_crawl_request,
+                                                                message.candidate))
+
+    def received_crawl_resumption_from(self, messages):
+        self.logger.info("Crawler: Valid %s crawl resumptions with sequence number received.", len(messages))
+        for message in messages:
+            mid = message.authentication.member.mid
+            self._remember_resume_from(mid)
+            self.cancel_pending_task(self._get_crawl_resume_task_name(mid))
+            self.send_crawl_request(message.candidate, message.payload.resume_sequence_number)
+
+    def _remember_resume_from(self, mid):
+        """
+        Mark mid as the most recently seen member that sends crawl resume from messages.
+        """
+        self._resume_from_mids.pop(mid, None)
+        self._resume_from_mids[mid] = None
+        if len(self._resume_from_mids) > RESUME_FROM_CACHE_SIZE:
+            self._resume_from_mids.popitem(last=False)
+
+    @staticmethod
+    def _get_crawl_resume_task_name(mid):
+        return u"crawl resume %s" % hexlify(mid)
 
     def _get_next_total(self, up, down):
         """
@@ -32,6 +32,9 @@ append_size = calcsize(append_format)
 crawl_request_format = 'i'
 crawl_request_size = calcsize(crawl_request_format)
 
+crawl_resume_from_format = 'i'
+crawl_resume_from_size = calcsize(crawl_resume_from_format)
+
 # [signature, pk]
 authentication_format = str(PK_LENGTH) + 's ' + str(SIG_LENGTH) + 's '
 # [Up, Down, TotalUpRequester, TotalDownRequester, sequence_number_requester, previous_hash_requester,
@@ -48,7 +51,8 @@ class MultiChainConversion(BinaryConversion):
 
     def __init__(self, community):
         super(MultiChainConversion, self).__init__(community, "\x01")
-        from Tribler.community.multichain.community import SIGNATURE, CRAWL_REQUEST, CRAWL_RESPONSE, CRAWL_RESUME
+        from Tribler.community.multichain.community import SIGNATURE, CRAWL_REQUEST, CRAWL_RESPONSE, CRAWL_RESUME, \
+            CRAWL_RESUME_FROM
 
         # Define Request Signature.
         self.define_meta_message(chr(1), community.get_meta_message(SIGNATURE),
@@ -59,6 +63,9 @@ class MultiChainConversion(BinaryConversion):
                                  self._encode_crawl_response, self._decode_crawl_response)
         self.define_meta_message(chr(4), community.get_meta_message(CRAWL_RESUME),
                                  self._encode_crawl_resume, self._decode_crawl_resume)
+        # Older versions do not know this message and drop it.
+        self.define_meta_message(chr(5), community.get_meta_message(CRAWL_RESUME_FROM),
+                                 self._encode_crawl_resume_from, self._decode_crawl_resume_from)
 
     @staticmethod
     def _encode_signature(message):
@@ -164,6 +171,32 @@ class MultiChainConversion(BinaryConversion):
         """
         return offset, placeholder.meta.payload.implement()
 
+    @staticmethod
+    def _encode_crawl_resume_from(message):
+        """
+        Encode a crawl resume from message.
+        :param message: Message.impl of CrawlResumeFromPayload.impl
+        return encoding of the message ready to be sent over the network
+        """
+        return pack(crawl_resume_from_format, message.payload.resume_sequence_number),
+
+    @staticmethod
+    def _decode_crawl_resume_from(placeholder, offset, data):
+        """
+        Decode an incoming crawl resume from message.
+        :param placeholder:
+        :param offset: Start of the CrawlResumeFrom message in the data.
+        :param data: ByteStream containing the message.
+        :return: (offset, CrawlResumeFrom.impl)
+        """
+        if len(data) < offset + crawl_resume_from_size:
+            raise DropPacket("Unable to decode the payload")
+
+        values = unpack_from(crawl_resume_from_format, data, offset)
+        offset += crawl_resume_from_size
+
+        return offset, placeholder.meta.payload.implement(*values)
+
 
 def split_function(payload):
     """
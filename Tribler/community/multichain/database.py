@@ -1,5 +1,6 @@
 """ This file contains everything related to persistence for MultiChain.
 """
+from collections import OrderedDict
 from os import path
 from hashlib import sha256
 from Tribler.dispersy.database import Database
@@ -10,7 +11,9 @@ DATABASE_DIRECTORY = path.join(u"sqlite")
 # Path to the database location + dispersy._workingdirectory
 DATABASE_PATH = path.join(DATABASE_DIRECTORY, u"multichain.db")
 # Version to keep track if the db schema needs to be updated.
-LATEST_DB_VERSION = 1
+LATEST_DB_VERSION = 2
+# Maximum number of members of which the latest block is kept in memory.
+HEAD_CACHE_SIZE = 10000
 # Schema for the MultiChain DB.
 schema = u"""
 CREATE TABLE IF NOT EXISTS multi_chain(
@@ -39,6 +42,21 @@ CREATE TABLE IF NOT EXISTS multi_chain(
 CREATE TABLE option(key TEXT PRIMARY KEY, value BLOB);
 INSERT INTO option(key, value) VALUES('database_version', '""" + str(LATEST_DB_VERSION) + u"""');
 """
+# Indexes to look up the blocks of a member by sequence number, in either role, and blocks by their responder hash.
+indexes = u"""
+CREATE INDEX IF NOT EXISTS multi_chain_requester_idx ON multi_chain(public_key_requester, sequence_number_requester);
+CREATE INDEX IF NOT EXISTS multi_chain_responder_idx ON multi_chain(public_key_responder, sequence_number_responder);
+CREATE INDEX IF NOT EXISTS multi_chain_hash_responder_idx ON multi_chain(hash_responder);
+"""
+upgrade_to_version_2 = indexes + u"""
+UPDATE option SET value = '2' WHERE key = 'database_version';
+"""
+# The columns of a block, in the order expected by DatabaseBlock.
+block_columns = u"public_key_requester, public_key_responder, up, down, " \
+                u"total_up_requester, total_down_requester, sequence_number_requester, previous_hash_requester, " \
+                u"signature_requester, hash_requester, " \
+                u"total_up_responder, total_down_responder, sequence_number_responder, previous_hash_responder, " \
+                u"signature_responder, hash_responder, insert_time"
 
 
 class MultiChainDB(Database):
@@ -58,6 +76,8 @@ class MultiChainDB(Database):
         """
         super(MultiChainDB, self).__init__(path.join(working_directory, DATABASE_PATH))
         self._dispersy = dispersy
+        # public key -> (sequence number, hash, total up, total down) of the latest block of that member
+        self._heads = OrderedDict()
         self.open()
 
     def add_block(self, block):
@@ -65,15 +85,22 @@ class MultiChainDB(Database):
         Persist a block
         :param block: The data that will be saved.
         """
-        data = (buffer(block.public_key_requester), buffer(block.public_key_responder), block.up, block.down,
-                block.total_up_requester, block.total_down_requester,
-                block.sequence_number_requester, buffer(block.previous_hash_requester),
-                buffer(block.signature_requester), buffer(block.hash_requester),
-                block.total_up_responder, block.total_down_responder,
-                block.sequence_number_responder, buffer(block.previous_hash_responder),
-                buffer(block.signature_responder), buffer(block.hash_responder))
+        self.add_blocks([block])
 
-        self.execute(
+    def add_blocks(self, blocks):
+        """
+        Persist several blocks with a single statement.
+        :param blocks: The blocks that will be saved.
+        """
+        data = [(buffer(block.public_key_requester), buffer(block.public_key_responder), block.up, block.down,
+                 block.total_up_requester, block.total_down_requester,
+                 block.sequence_number_requester, buffer(block.previous_hash_requester),
+                 buffer(block.signature_requester), buffer(block.hash_requester),
+                 block.total_up_responder, block.total_down_responder,
+                 block.sequence_number_responder, buffer(block.previous_hash_responder),
+                 buffer(block.signature_responder), buffer(block.hash_responder)) for block in blocks]
+
+        self.executemany(
             u"INSERT INTO multi_chain (public_key_requester, public_key_responder, up, down, "
             u"total_up_requester, total_down_requester, sequence_number_requester, previous_hash_requester, "
             u"signature_requester, hash_requester, "
@@ -82,6 +109,12 @@ class MultiChainDB(Database):
             u"VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
             data)
 
+        for block in blocks:
+            self._update_head(block.public_key_requester, block.sequence_number_requester, block.hash_requester,
+                              block.total_up_requester, block.total_down_requester)
+            self._update_head(block.public_key_responder, block.sequence_number_responder, block.hash_responder,
+                              block.total_up_responder, block.total_down_responder)
+
     def update_block_with_responder(self, block):
         """
         Update an existing block
@@ -100,6 +133,42 @@ class MultiChainDB(Database):
             u"WHERE hash_requester = ?",
             data)
 
+        self._update_head(block.public_key_responder, block.sequence_number_responder, block.hash_responder,
+                          block.total_up_responder, block.total_down_responder)
+
+    def _get_head(self, public_key):
+        """
+        Get the latest block of a member, from the cache or else from the indexes of both roles.
+        :param public_key: The public key of the member
+        :return: (sequence number, hash, total up, total down) or None if no block is known
+        """
+        public_key = str(public_key)
+        head = self._heads.pop(public_key, None)
+        if head is None:
+            heads = [self.execute(u"SELECT sequence_number_%s, hash_%s, total_up_%s, total_down_%s FROM multi_chain "
+                                  u"WHERE public_key_%s = ? ORDER BY sequence_number_%s DESC LIMIT 1" % ((role,) * 6),
+                                  (buffer(public_key),)).fetchone() for role in (u"requester", u"responder")]
+            heads = [head for head in heads if head]
+            if not heads:
+                return None
+            sequence_number, block_hash, total_up, total_down = max(heads, key=lambda head: head[0])
+            head = (sequence_number, str(block_hash), total_up, total_down)
+
+        self._heads[public_key] = head
+        if len(self._heads) > HEAD_CACHE_SIZE:
+            self._heads.popitem(last=False)
+        return head
+
+    def _update_head(self, public_key, sequence_number, block_hash, total_up, total_down):
+        """
+        Update the cached latest block of a member after storing one of its blocks. Members that are not cached are
+        loaded from the database when they are needed.
+        """
+        public_key = str(public_key)
+        head = self._heads.get(public_key)
+        if head is not None and sequence_number > head[0]:
+            self._heads[public_key] = (sequence_number, str(block_hash), total_up, total_down)
+
     def get_latest_hash(self, public_key):
         """
         Get the relevant hash of the latest block in the chain for a specific public key.
@@ -108,17 +177,8 @@ class MultiChainDB(Database):
         :param public_key: The public_key for which the latest hash has to be found.
         :return: the relevant hash
         """
-        public_key = buffer(public_key)
-        db_query = u"SELECT block_hash, MAX(sequence_number) FROM (" \
-                   u"SELECT hash_requester AS block_hash, sequence_number_requester AS sequence_number " \
-                   u"FROM multi_chain WHERE public_key_requester = ? " \
-                   u"UNION " \
-                   u"SELECT hash_responder AS block_hash, sequence_number_responder AS sequence_number " \
-                   u"FROM multi_chain WHERE public_key_responder = ?)"
-
-        db_result = self.execute(db_query, (public_key, public_key)).fetchone()[0]
-
-        return str(db_result) if db_result else None
+        head = self._get_head(public_key)
+        return head[1] if head else None
 
     def get_latest_block(self, public_key):
         return self.get_by_hash(self.get_latest_hash(public_key))
@@ -161,45 +221,31 @@ class MultiChainDB(Database):
         :param public_key: The public key corresponding to the block
         :param sequence_number: The sequence number corresponding to the block.
         :return: The block that was requested or None"""
-        db_query = u"SELECT public_key_requester, public_key_responder, up, down, " \
-                   u"total_up_requester, total_down_requester, sequence_number_requester, previous_hash_requester, " \
-                   u"signature_requester, hash_requester, " \
-                   u"total_up_responder, total_down_responder, sequence_number_responder, previous_hash_responder, " \
-                   u"signature_responder, hash_responder, insert_time " \
-                   u"FROM (" \
-                   u"SELECT *, sequence_number_requester AS sequence_number, " \
-                   u"public_key_requester AS pk FROM `multi_chain` " \
-                   u"UNION " \
-                   u"SELECT *, sequence_number_responder AS sequence_number," \
-                   u"public_key_responder AS pk FROM `multi_chain`) " \
-                   u"WHERE sequence_number = ? AND pk = ? LIMIT 1"
-        db_result = self.execute(db_query, (sequence_number, buffer(public_key))).fetchone()
-        # Create a DB Block or return None
-        return self._create_database_block(db_result)
-
-    def get_blocks_since(self, public_key, sequence_number):
+        for role in (u"requester", u"responder"):
+            db_query = u"SELECT " + block_columns + u" FROM multi_chain " \
+                       u"WHERE public_key_%s = ? AND sequence_number_%s = ? LIMIT 1" % (role, role)
+            db_result = self.execute(db_query, (buffer(public_key), sequence_number)).fetchone()
+            if db_result:
+                return self._create_database_block(db_result)
+        return None
+
+    def get_blocks_since(self, public_key, sequence_number, limit=100):
         """
-        Returns database blocks with sequence number higher than or equal to sequence_number, at most 100 results
+        Returns database blocks with sequence number higher than or equal to sequence_number, at most limit results
         :param public_key: The public key corresponding to the member id
         :param sequence_number: The linear block number
-        :return A list of DB Blocks that match the criteria
+        :param limit: The maximum number of blocks to return
+        :return A list of DB Blocks that match the criteria, ordered by sequence number
         """
-        db_query = u"SELECT public_key_requester, public_key_responder, up, down, " \
-                   u"total_up_requester, total_down_requester, sequence_number_requester, previous_hash_requester, " \
-                   u"signature_requester, hash_requester, " \
-                   u"total_up_responder, total_down_responder, sequence_number_responder, previous_hash_responder, " \
-                   u"signature_responder, hash_responder, insert_time " \
-                   u"FROM (" \
-                   u"SELECT *, sequence_number_requester AS sequence_number," \
-                   u" public_key_requester AS public_key FROM `multi_chain` " \
-                   u"UNION " \
-                   u"SELECT *, sequence_number_responder AS sequence_number," \
-                   u" public_key_responder AS public_key FROM `multi_chain`) " \
-                   u"WHERE sequence_number >= ? AND public_key = ? " \
-                   u"ORDER BY sequence_number ASC " \
-                   u"LIMIT 100"
-        db_result = self.execute(db_query, (sequence_number, buffer(public_key))).fetchall()
-        return [self._create_database_block(db_item) for db_item in db_result]
+        db_results = []
+        for index, role in enumerate((u"requester", u"responder")):
+            db_query = u"SELECT " + block_columns + u" FROM multi_chain " \
+                       u"WHERE public_key_%s = ? AND sequence_number_%s >= ? " \
+                       u"ORDER BY sequence_number_%s ASC LIMIT ?" % (role, role, role)
+            db_results.extend((db_item[6 + 6 * index], db_item) for db_item in
+                              self.execute(db_query, (buffer(public_key), sequence_number, limit)).fetchall())
+        db_results.sort(key=lambda result: result[0])
+        return [self._create_database_block(db_item) for _, db_item in db_results[:limit]]
 
     def _create_database_block(self, db_result):
         """
@@ -231,6 +277,22 @@ class MultiChainDB(Database):
         db_result = self.execute(db_query, (buffer(hash_requester),)).fetchone()
         return db_result is not None
 
+    def get_known_hash_requester(self, hash_requesters):
+        """
+        Check which of the given blocks are existent in the persistence layer.
+        :param hash_requesters: The hash_requesters that are queried
+        :return: set of the hash_requesters that exist.
+        """
+        hash_requesters = list(hash_requesters)
+        known = set()
+        # Stay well below the maximum number of parameters of a SQLite statement
+        for index in xrange(0, len(hash_requesters), 500):
+            chunk = hash_requesters[index:index + 500]
+            db_query = u"SELECT hash_requester FROM multi_chain WHERE hash_requester IN (%s)" % \
+                       u",".join(u"?" * len(chunk))
+            known.update(str(x[0]) for x in self.execute(db_query, [buffer(x) for x in chunk]).fetchall())
+        return known
+
     def get_latest_sequence_number(self, public_key):
         """
         Return the latest sequence number known for this public_key.
@@ -238,14 +300,8 @@ class MultiChainDB(Database):
         :param public_key: Corresponding public key
         :return: sequence number (integer) or -1 if no block is known
         """
-        public_key = buffer(public_key)
-        db_query = u"SELECT MAX(sequence_number) FROM (" \
-                   u"SELECT sequence_number_requester AS sequence_number " \
-                   u"FROM multi_chain WHERE public_key_requester == ? UNION " \
-                   u"SELECT sequence_number_responder AS sequence_number " \
-                   u"FROM multi_chain WHERE public_key_responder = ? )"
-        db_result = self.execute(db_query, (public_key, public_key)).fetchone()[0]
-        return db_result if db_result is not None else -1
+        head = self._get_head(public_key)
+        return head[0] if head else -1
 
     def get_total(self, public_key):
         """
@@ -254,17 +310,8 @@ class MultiChainDB(Database):
         :param public_key: public_key of the node
         :return: (total_up (int), total_down (int)) or (-1, -1) if no block is known.
         """
-        public_key = buffer(public_key)
-        db_query = u"SELECT total_up, total_down, MAX(sequence_number) FROM (" \
-                   u"SELECT total_up_requester AS total_up, total_down_requester AS total_down, " \
-                   u"sequence_number_requester AS sequence_number FROM multi_chain " \
-                   u"WHERE public_key_requester == ? UNION " \
-                   u"SELECT total_up_responder AS total_up, total_down_responder AS total_down, " \
-                   u"sequence_number_responder AS sequence_number FROM multi_chain WHERE public_key_responder = ? )" \
-                   u"LIMIT 1"
-        db_result = self.execute(db_query, (public_key, public_key)).fetchone()
-        return (db_result[0], db_result[1]) if db_result[0] is not None and db_result[1] is not None \
-            else (-1, -1)
+        head = self._get_head(public_key)
+        return (head[2], head[3]) if head and head[2] is not None and head[3] is not None else (-1, -1)
 
     def open(self, initial_statements=True, prepare_visioning=True):
         return super(MultiChainDB, self).open(initial_statements, prepare_visioning)
@@ -284,7 +331,10 @@ class MultiChainDB(Database):
         database_version = int(database_version)
 
         if database_version < 1:
-            self.executescript(schema)
+            self.executescript(schema + indexes)
+            self.commit()
+        elif database_version < 2:
+            self.executescript(upgrade_to_version_2)
             self.commit()
 
         return LATEST_DB_VERSION
@@ -348,9 +398,9 @@ class DatabaseBlock:
                     None))
 
     @classmethod
-    def from_block_response_message(cls, message, requester, responder):
+    def from_block_response_message(cls, message):
         payload = message.payload
-        return cls((requester.public_key, responder.public_key, payload.up, payload.down,
+        return cls((payload.public_key_requester, payload.public_key_responder, payload.up, payload.down,
                     payload.total_up_requester, payload.total_down_requester,
                     payload.sequence_number_requester, payload.previous_hash_requester,
                     payload.signature_requester,
@@ -180,3 +180,18 @@ class CrawlResumePayload(Payload):
     class Implementation(Payload.Implementation):
         def __init__(self, meta):
             super(CrawlResumePayload.Implementation, self).__init__(meta)
+
+
+class CrawlResumeFromPayload(Payload):
+    """
+    Tells the crawler that more blocks are available, starting with a specific sequence number.
+    """
+
+    class Implementation(Payload.Implementation):
+        def __init__(self, meta, resume_sequence_number):
+            super(CrawlResumeFromPayload.Implementation, self).__init__(meta)
+            self._resume_sequence_number = resume_sequence_number
+
+        @property
+        def resume_sequence_number(self):
+            return self._resume_sequence_number
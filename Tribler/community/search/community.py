@@ -1,13 +1,15 @@
 # Written by Niels Zeilemaker
+from collections import OrderedDict, deque
 from random import shuffle
 from time import time
 from binascii import hexlify
 from traceback import print_exc
 
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.task import LoopingCall
 
-from Tribler.Core.CacheDB.sqlitecachedb import bin2str
 from Tribler.Core.TorrentDef import TorrentDef
+from Tribler.Core.Utilities.search_utils import filter_keywords
 from Tribler.community.channel.payload import TorrentPayload
 from Tribler.community.channel.preview import PreviewChannelCommunity
 from Tribler.community.search.conversion import SearchConversion
@@ -26,12 +28,27 @@ from Tribler.dispersy.exception import CommunityNotFoundException
 from Tribler.dispersy.message import Message
 from Tribler.dispersy.requestcache import RandomNumberCache, IntroductionRequestCache
 from Tribler.dispersy.resolution import PublicResolution
+from Tribler.dispersy.util import call_on_reactor_thread
 
 
 DEBUG = False
 SWIFT_INFOHASHES = 0
 CREATE_TORRENT_COLLECT_INTERVAL = 5
 
+# The results of remote searches are cached for SEARCH_CACHE_TTL seconds, for at most SEARCH_CACHE_SIZE keyword sets
+SEARCH_CACHE_TTL = 60
+SEARCH_CACHE_SIZE = 1000
+# Every candidate can have SEARCH_BURST searches answered at once, after which it gets one search per
+# SEARCH_INTERVAL seconds. Up to SEARCH_QUEUE_SIZE searches per candidate are queued, older ones are dropped.
+SEARCH_BURST = 5
+SEARCH_INTERVAL = 1.0
+SEARCH_QUEUE_SIZE = 5
+
+# The number of most recent preferences that are put in the taste bloom filter
+TASTE_PREFERENCES_LIMIT = 500
+# The overlap with a received taste bloom filter is remembered for the last TASTE_OVERLAP_CACHE_SIZE filters
+TASTE_OVERLAP_CACHE_SIZE = 1024
+
 
 class SearchCommunity(Community):
 
@@ -69,11 +86,28 @@ class SearchCommunity(Community):
 
         self._rtorrent_handler = None
 
+        # the infohashes of the most recent preferences, oldest first, loaded on first use and kept up to date
+        # through the notifier
+        self._my_preferences = None
+        self._my_preferences_version = 0
+
         self.taste_bloom_filter = None
         self.taste_bloom_filter_key = None
+        # (bloom filter functions, prefix, bytes) -> overlap with the preferences of version taste_overlap_version
+        self._taste_overlap_cache = OrderedDict()
+        self._taste_overlap_version = 0
 
         self.torrent_cache = None
 
+        # keyword set -> (time of the search, search-response results)
+        self._search_cache = OrderedDict()
+        # keyword set -> Deferreds waiting for the search that is running for it
+        self._pending_searches = {}
+        # sock_addr -> [search tokens, time of the last update]
+        self._search_tokens = {}
+        # sock_addr -> queued search-request messages
+        self._search_queue = OrderedDict()
+
     def initialize(self, tribler_session=None, log_incomming_searches=False):
         self.tribler_session = tribler_session
         self.integrate_with_tribler = tribler_session is not None
@@ -84,13 +118,14 @@ class SearchCommunity(Community):
         # self.taste_buddies.append([1, time(), Candidate(("127.0.0.1", 1234), False))
 
         if self.integrate_with_tribler:
-            from Tribler.Core.simpledefs import NTFY_CHANNELCAST, NTFY_TORRENTS, NTFY_MYPREFERENCES
+            from Tribler.Core.simpledefs import NTFY_CHANNELCAST, NTFY_TORRENTS, NTFY_MYPREFERENCES, NTFY_INSERT
 
             # tribler channelcast database
             self._channelcast_db = tribler_session.open_dbhandler(NTFY_CHANNELCAST)
             self._torrent_db = tribler_session.open_dbhandler(NTFY_TORRENTS)
             self._mypref_db = tribler_session.open_dbhandler(NTFY_MYPREFERENCES)
             self._notifier = tribler_session.notifier
+            self._notifier.add_observer(self.on_my_preference_added, NTFY_MYPREFERENCES, [NTFY_INSERT])
 
             # torrent collecting
             self._rtorrent_handler = tribler_session.lm.rtorrent_handler
@@ -103,6 +138,13 @@ class SearchCommunity(Community):
         self.register_task(u"create torrent collect requests",
                            LoopingCall(self.create_torrent_collect_requests)).start(CREATE_TORRENT_COLLECT_INTERVAL,
                                                                                     now=True)
+        self.register_task(u"process search queue",
+                           LoopingCall(self.process_search_queue)).start(SEARCH_INTERVAL, now=False)
+
+    def unload_community(self):
+        if self._notifier:
+            self._notifier.remove_observer(self.on_my_preference_added)
+        super(SearchCommunity, self).unload_community()
 
     def initiate_meta_messages(self):
         return super(SearchCommunity, self).initiate_meta_messages() + [
@@ -233,11 +275,11 @@ class SearchCommunity(Community):
 
         advice = True
         if not is_fast_walker:
-            my_preferences = sorted(self._mypref_db.getMyPrefListInfohash(limit=500))
+            my_preferences = self.get_my_preferences()
             num_preferences = len(my_preferences)
 
-            my_pref_key = u",".join(map(bin2str, my_preferences))
-            if my_pref_key != self.taste_bloom_filter_key:
+            # the bloom filter is only rebuilt when the preferences have changed
+            if self._my_preferences_version != self.taste_bloom_filter_key:
                 if num_preferences > 0:
                     # no prefix changing, we want false positives (make sure it is a single char)
                     self.taste_bloom_filter = BloomFilter(0.005, len(my_preferences), prefix=' ')
@@ -245,7 +287,7 @@ class SearchCommunity(Community):
                 else:
                     self.taste_bloom_filter = None
 
-                self.taste_bloom_filter_key = my_pref_key
+                self.taste_bloom_filter_key = self._my_preferences_version
 
             taste_bloom_filter = self.taste_bloom_filter
 
@@ -273,7 +315,7 @@ class SearchCommunity(Community):
         super(SearchCommunity, self).on_introduction_request(messages)
 
         if any(message.payload.taste_bloom_filter for message in messages):
-            my_preferences = self._mypref_db.getMyPrefListInfohash(limit=500)
+            my_preferences = self.get_my_preferences()
         else:
             my_preferences = []
 
@@ -282,7 +324,7 @@ class SearchCommunity(Community):
             taste_bloom_filter = message.payload.taste_bloom_filter
             num_preferences = message.payload.num_preferences
             if taste_bloom_filter:
-                overlap = sum(infohash in taste_bloom_filter for infohash in my_preferences)
+                overlap = self._get_taste_overlap(taste_bloom_filter, my_preferences)
             else:
                 overlap = 0
 
@@ -297,6 +339,46 @@ class SearchCommunity(Community):
                 self._notifier.notify(NTFY_ACTIVITIES, NTFY_INSERT, NTFY_ACT_MEET,
                                       "%s:%d" % message.candidate.sock_addr)
 
+    def get_my_preferences(self):
+        """
+        Returns the infohashes of the TASTE_PREFERENCES_LIMIT most recent preferences.
+        """
+        if self._my_preferences is None:
+            infohashes = self._mypref_db.getMyPrefListInfohash(limit=TASTE_PREFERENCES_LIMIT)
+            self._my_preferences = OrderedDict((infohash, None) for infohash in reversed(infohashes))
+            self._my_preferences_version += 1
+        return self._my_preferences.keys()
+
+    @call_on_reactor_thread
+    def on_my_preference_added(self, subject, change_type, infohash):
+        # removed preferences stay in the preference list (see MyPreferenceDBHandler.getMyPrefListInfohash), so only
+        # new ones change it
+        if self._my_preferences is None or infohash in self._my_preferences:
+            return
+
+        self._my_preferences[infohash] = None
+        if len(self._my_preferences) > TASTE_PREFERENCES_LIMIT:
+            self._my_preferences.popitem(last=False)
+        self._my_preferences_version += 1
+
+    def _get_taste_overlap(self, taste_bloom_filter, my_preferences):
+        """
+        Returns the number of my_preferences in taste_bloom_filter. A peer sends the same bloom filter until its
+        preferences change, so the overlap is remembered per bloom filter until our preferences change.
+        """
+        if self._taste_overlap_version != self._my_preferences_version:
+            self._taste_overlap_cache.clear()
+            self._taste_overlap_version = self._my_preferences_version
+
+        key = (taste_bloom_filter.functions, taste_bloom_filter.prefix, taste_bloom_filter.bytes)
+        overlap = self._taste_overlap_cache.pop(key, None)
+        if overlap is None:
+            overlap = sum(infohash in taste_bloom_filter for infohash in my_preferences)
+        self._taste_overlap_cache[key] = overlap
+        if len(self._taste_overlap_cache) > TASTE_OVERLAP_CACHE_SIZE:
+            self._taste_overlap_cache.popitem(last=False)
+        return overlap
+
     class SearchRequest(RandomNumberCache):
 
         def __init__(self, request_cache, keywords):
@@ -338,31 +420,111 @@ class SearchCommunity(Community):
             if self.log_incomming_searches:
                 self.log_incomming_searches(message.candidate.sock_addr, keywords)
 
-            results = []
-            dbresults = self._torrent_db.searchNames(keywords, local=False, keys=['infohash', 'T.name', 'T.length', 'T.num_files', 'T.category', 'T.creation_date', 'T.num_seeders', 'T.num_leechers'])
-            if len(dbresults) > 0:
-                for dbresult in dbresults:
-                    channel_details = dbresult[-10:]
-
-                    dbresult = list(dbresult[:8])
-                    dbresult[2] = long(dbresult[2])  # length
-                    dbresult[3] = int(dbresult[3])  # num_files
-                    dbresult[4] = [dbresult[4]]  # category
-                    dbresult[5] = long(dbresult[5])  # creation_date
-                    dbresult[6] = int(dbresult[6] or 0)  # num_seeders
-                    dbresult[7] = int(dbresult[7] or 0)  # num_leechers
-
-                    # cid
-                    if channel_details[1]:
-                        channel_details[1] = str(channel_details[1])
-                    dbresult.append(channel_details[1])
-
-                    results.append(tuple(dbresult))
-            elif DEBUG:
+            if self._take_search_token(message.candidate.sock_addr):
+                self._answer_search(message)
+            else:
+                queue = self._search_queue.get(message.candidate.sock_addr)
+                if queue is None:
+                    queue = self._search_queue[message.candidate.sock_addr] = deque(maxlen=SEARCH_QUEUE_SIZE)
+                queue.append(message)
+
+    def _take_search_token(self, sock_addr):
+        """
+        Returns whether the candidate at sock_addr may have a search answered now, in which case it uses up a token.
+        """
+        now = time()
+        tokens, last_update = self._search_tokens.get(sock_addr, (SEARCH_BURST, now))
+        tokens = min(SEARCH_BURST, tokens + (now - last_update) / SEARCH_INTERVAL)
+        if tokens < 1:
+            self._search_tokens[sock_addr] = [tokens, now]
+            return False
+        self._search_tokens[sock_addr] = [tokens - 1, now]
+        return True
+
+    def process_search_queue(self):
+        for sock_addr in self._search_queue.keys():
+            queue = self._search_queue[sock_addr]
+            while queue and self._take_search_token(sock_addr):
+                self._answer_search(queue.popleft())
+            if not queue:
+                del self._search_queue[sock_addr]
+
+        # forget the candidates that have all their tokens again
+        now = time()
+        for sock_addr, (tokens, last_update) in self._search_tokens.items():
+            if tokens + (now - last_update) / SEARCH_INTERVAL >= SEARCH_BURST:
+                del self._search_tokens[sock_addr]
+
+        # the search cache is ordered by the time of the search, so the expired results are at the front
+        while self._search_cache:
+            key, (timestamp, _) = next(self._search_cache.iteritems())
+            if timestamp + SEARCH_CACHE_TTL > now:
+                break
+            del self._search_cache[key]
+
+    def _answer_search(self, message):
+        def on_results(results):
+            if DEBUG and not results:
                 self._logger.debug(u"no results")
 
             self._create_search_response(message.payload.identifier, results, message.candidate)
 
+        def on_error(failure):
+            self._logger.error(u"Failed to search for %s: %s", message.payload.keywords, failure.getErrorMessage())
+
+        self._get_search_results(message.payload.keywords).addCallbacks(on_results, on_error)
+
+    def _get_search_results(self, keywords):
+        """
+        Returns a Deferred that fires with the search-response results for keywords. As every peer searching for
+        popular keywords sends a search-request to many nodes, the results are cached per set of keywords that is
+        actually searched for, and identical searches that arrive while the query runs wait for its results.
+        """
+        key = frozenset(keyword.lower() for keyword in filter_keywords(keywords))
+
+        cached = self._search_cache.get(key)
+        if cached and cached[0] + SEARCH_CACHE_TTL > time():
+            return succeed(cached[1])
+
+        if key in self._pending_searches:
+            deferred = Deferred()
+            self._pending_searches[key].append(deferred)
+            return deferred
+
+        def on_failure(failure):
+            for deferred in self._pending_searches.pop(key, []):
+                deferred.errback(failure)
+            return failure
+
+        self._pending_searches[key] = []
+        return self._torrent_db.searchNamesAsync(keywords, local=False,
+                                                 keys=['infohash', 'T.name', 'T.length', 'T.num_files', 'T.category',
+                                                       'T.creation_date', 'T.num_seeders', 'T.num_leechers'])\
+            .addCallback(self._on_search_results, key).addErrback(on_failure)
+
+    def _on_search_results(self, dbresults, key):
+        results = []
+        for dbresult in dbresults:
+            cid = dbresult[-9]
+            results.append((dbresult[0],
+                            dbresult[1],
+                            long(dbresult[2]),  # length
+                            int(dbresult[3]),  # num_files
+                            [dbresult[4]],  # category
+                            long(dbresult[5]),  # creation_date
+                            int(dbresult[6] or 0),  # num_seeders
+                            int(dbresult[7] or 0),  # num_leechers
+                            str(cid) if cid else cid))
+
+        self._search_cache.pop(key, None)
+        self._search_cache[key] = (time(), results)
+        while len(self._search_cache) > SEARCH_CACHE_SIZE:
+            self._search_cache.popitem(last=False)
+
+        for deferred in self._pending_searches.pop(key):
+            deferred.callback(results)
+        return results
+
     def _create_search_response(self, identifier, results, candidate):
         # create search-response message
         meta = self.get_meta_message(u"search-response")
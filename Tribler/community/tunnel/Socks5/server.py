@@ -66,7 +66,9 @@ class SocksUDPConnection(DatagramProtocol):
                         "Circuit is not ready, dropping %d bytes to %s", len(request.payload), request.destination)
                 else:
                     self._logger.debug("Sending data over circuit destined for %r:%r", *request.destination)
-                    circuit.tunnel_data(request.destination, request.payload)
+                    if not circuit.queue_data(request.destination, request.payload):
+                        self._logger.debug("Circuit %d is congested, dropping %d bytes to %s",
+                                           circuit.circuit_id, len(request.payload), request.destination)
             else:
                 self._logger.debug("No support for fragmented data, dropping")
         else:
@@ -30,3 +30,15 @@ CIRCUIT_STATE_BROKEN = 'BROKEN'
 
 CIRCUIT_ID_PORT = 1024
 PING_INTERVAL = 15.0
+TRAFFIC_AGGREGATE_INTERVAL = 1.0
+
+# flow control of the data that we tunnel over our own circuits. The send window is the number of packets a circuit
+# may send per round-trip time: it grows while packets have to wait for it and is halved when the round-trip time
+# shows that the circuit is congested.
+CIRCUIT_SEND_WINDOW = 256  # the initial send window
+CIRCUIT_MIN_SEND_WINDOW = 16
+CIRCUIT_MAX_SEND_WINDOW = 16384
+CIRCUIT_CONGESTION_RTT_FACTOR = 2.0  # a round-trip time this many times the lowest one measured means congestion
+CIRCUIT_MAX_QUEUE_SIZE = 256  # the number of packets that may wait for the send window before we drop them
+CIRCUIT_DEFAULT_RTT = 0.5  # the round-trip time assumed until the first pong arrives
+CIRCUIT_FLUSH_INTERVAL = 0.05
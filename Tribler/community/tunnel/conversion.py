@@ -449,9 +449,13 @@ class TunnelConversion(BinaryConversion):
         circuit_id, = unpack_from('!I', packet, circuit_id_pos)
         return circuit_id
 
+    @staticmethod
+    def get_encrypted_pos(message_type):
+        return 4 if message_type == u"data" else 36
+
     @staticmethod
     def split_encrypted_packet(packet, message_type):
-        encryped_pos = 4 if message_type == u"data" else 36
+        encryped_pos = TunnelConversion.get_encrypted_pos(message_type)
         return packet[:encryped_pos], packet[encryped_pos:]
 
     @staticmethod
@@ -1,15 +1,60 @@
 import struct
+from collections import OrderedDict
+from threading import Lock
 
-from cryptowrapper import crypto_box_beforenm, crypto_auth, crypto_auth_verify, Cipher, algorithms, modes, HKDFExpand, hashes, default_backend
+from cryptowrapper import crypto_box_beforenm, crypto_auth, crypto_auth_verify, Cipher, algorithms, modes, HKDFExpand, hashes, default_backend, AESGCM
 from Tribler.dispersy.crypto import ECCrypto, LibNaCLPK
 
+# the number of session keys for which the cipher objects are kept around
+CIPHER_CACHE_SIZE = 1024
+GCM_TAG_LENGTH = 16
+
 
 class CryptoException(Exception):
     pass
 
 
+class GCMCipher(object):
+    """
+    AES-GCM encryption and decryption with a fixed key. The key schedule is set up once, for every packet only the IV
+    changes.
+    """
+
+    def __init__(self, key):
+        self._backend = default_backend()
+        self._algorithm = algorithms.AES(key)
+        self._aead = AESGCM(key) if AESGCM else None
+
+    def encrypt(self, content, iv):
+        """
+        :return: A (ciphertext, tag) tuple.
+        """
+        # AESGCM does not accept IVs shorter than 8 bytes, which happens for small salt_explicit values
+        if self._aead and len(iv) >= 8:
+            ciphertext = self._aead.encrypt(iv, content, None)
+            return ciphertext[:-GCM_TAG_LENGTH], ciphertext[-GCM_TAG_LENGTH:]
+
+        encryptor = Cipher(self._algorithm, modes.GCM(initialization_vector=iv), backend=self._backend).encryptor()
+        ciphertext = encryptor.update(content) + encryptor.finalize()
+        return ciphertext, encryptor.tag
+
+    def decrypt(self, ciphertext, iv, tag):
+        if self._aead and len(iv) >= 8:
+            return self._aead.decrypt(iv, ciphertext + tag, None)
+
+        decryptor = Cipher(self._algorithm, modes.GCM(initialization_vector=iv, tag=tag),
+                           backend=self._backend).decryptor()
+        return decryptor.update(ciphertext) + decryptor.finalize()
+
+
 class TunnelCrypto(ECCrypto):
 
+    def __init__(self, *args, **kwargs):
+        super(TunnelCrypto, self).__init__(*args, **kwargs)
+        # the cipher cache is shared by the reactor and the crypto workers
+        self._ciphers = OrderedDict()
+        self._ciphers_lock = Lock()
+
     def initialize(self, community):
         self.community = community
         self.key = self.community.my_member._ec
@@ -61,24 +106,58 @@ class TunnelCrypto(ECCrypto):
 
         return salt + str(salt_explicit)
 
-    def encrypt_str(self, content, key, salt, salt_explicit):
+    def _get_cipher(self, key):
+        with self._ciphers_lock:
+            cipher = self._ciphers.pop(key, None)
+            if cipher is not None:
+                self._ciphers[key] = cipher
+                return cipher
+
+        # setting up the key schedule does not need the lock, if two threads race the last one is cached
+        cipher = GCMCipher(key)
+        with self._ciphers_lock:
+            self._ciphers.pop(key, None)
+            if len(self._ciphers) >= CIPHER_CACHE_SIZE:
+                self._ciphers.popitem(last=False)
+            self._ciphers[key] = cipher
+        return cipher
+
+    def encrypt_str(self, content, key, salt, salt_explicit, offset=0, prefix=''):
         # return the encrypted content prepended with the
         # gcm tag and salt_explicit
-        cipher = Cipher(algorithms.AES(key),
-                        modes.GCM(initialization_vector=self._bulid_iv(salt, salt_explicit)),
-                        backend=default_backend()
-                        ).encryptor()
-        ciphertext = cipher.update(content) + cipher.finalize()
-        return struct.pack('!q16s', salt_explicit, cipher.tag) + ciphertext
-
-    def decrypt_str(self, content, key, salt):
-        # content contains the gcm tag and salt_explicit in plaintext
-        salt_explicit, gcm_tag = struct.unpack_from('!q16s', content)
-        cipher = Cipher(algorithms.AES(key),
-                        modes.GCM(initialization_vector=self._bulid_iv(salt, salt_explicit), tag=gcm_tag),
-                        backend=default_backend()
-                        ).decryptor()
-        return cipher.update(content[24:]) + cipher.finalize()
+        # when relaying, only the content after offset is encrypted and the result is joined with prefix right away.
+        # The payload is still copied out of the packet by the slice, as cryptography does not accept buffers for
+        # every version we support, and the join copies the result. The relay no longer splits the packet and swaps
+        # the circuit id in a second full copy, though.
+        ciphertext, tag = self._get_cipher(key).encrypt(content[offset:] if offset else content,
+                                                        self._bulid_iv(salt, salt_explicit))
+        return ''.join((prefix, struct.pack('!q16s', salt_explicit, tag), ciphertext))
+
+    def decrypt_str(self, content, key, salt, offset=0, prefix=''):
+        # content contains the gcm tag and salt_explicit in plaintext. Like in encrypt_str, the slice copies the
+        # ciphertext out of the packet.
+        salt_explicit, gcm_tag = struct.unpack_from('!q16s', content, offset)
+        plaintext = self._get_cipher(key).decrypt(content[offset + 24:], self._bulid_iv(salt, salt_explicit), gcm_tag)
+        return prefix + plaintext if prefix else plaintext
+
+    def encrypt_str_batch(self, contents, key, salt, salt_explicits):
+        """
+        Encrypts a list of packets with the same key, the n-th packet uses the n-th salt_explicit.
+        """
+        cipher = self._get_cipher(key)
+        encrypted = []
+        for content, salt_explicit in zip(contents, salt_explicits):
+            ciphertext, tag = cipher.encrypt(content, self._bulid_iv(salt, salt_explicit))
+            encrypted.append(struct.pack('!q16s', salt_explicit, tag) + ciphertext)
+        return encrypted
+
+    def decrypt_str_batch(self, contents, key, salt):
+        cipher = self._get_cipher(key)
+        decrypted = []
+        for content in contents:
+            salt_explicit, gcm_tag = struct.unpack_from('!q16s', content)
+            decrypted.append(cipher.decrypt(content[24:], self._bulid_iv(salt, salt_explicit), gcm_tag))
+        return decrypted
 
 class NoTunnelCrypto(TunnelCrypto):
 
@@ -101,11 +180,17 @@ class NoTunnelCrypto(TunnelCrypto):
     def generate_session_keys(self, shared_secret):
         return '\0' * 16, '\0' * 16, '\0' * 4, '\0' * 4, 1, 1
 
-    def encrypt_str(self, content, key, salt, salt_explicit):
-        return content
+    def encrypt_str(self, content, key, salt, salt_explicit, offset=0, prefix=''):
+        return prefix + content[offset:]
+
+    def decrypt_str(self, content, key, salt, offset=0, prefix=''):
+        return prefix + content[offset:]
+
+    def encrypt_str_batch(self, contents, key, salt, salt_explicits):
+        return list(contents)
 
-    def decrypt_str(self, content, key, salt):
-        return content
+    def decrypt_str_batch(self, contents, key, salt):
+        return list(contents)
 
 if __name__ == "__main__":
     tc = TunnelCrypto()
@@ -0,0 +1,94 @@
+import logging
+from Queue import Empty, Queue
+from threading import Thread
+
+from twisted.internet import reactor
+
+# the maximum number of queued jobs that a worker runs before handing the results back
+WORKER_BATCH_SIZE = 64
+
+
+class CryptoWorkerPool(object):
+    """
+    Runs crypto jobs on a number of worker threads. The OpenSSL calls of the cryptography package release the GIL,
+    so the workers can use multiple cores. All jobs submitted with the same key (e.g. a circuit id) are handled by the
+    same worker, which means their callbacks are called in the order in which the jobs were submitted.
+    """
+
+    def __init__(self, num_workers, call_in_thread=reactor.callFromThread):
+        """
+        :param num_workers: the number of worker threads
+        :param call_in_thread: the function with which the callbacks are scheduled, by default on the reactor thread
+        """
+        assert num_workers > 0, num_workers
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._call_in_thread = call_in_thread
+        self._queues = [Queue() for _ in xrange(num_workers)]
+        self._workers = []
+
+        for index, queue in enumerate(self._queues):
+            worker = Thread(target=self._run, args=(queue,), name="CryptoWorker-%d" % index)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def num_workers(self):
+        return len(self._workers)
+
+    def submit(self, key, job, callback, errback=None):
+        """
+        Schedule job to be called on a worker thread.
+        :param key: jobs with the same key are called, and their results are delivered, in order
+        :param job: a function without arguments doing the crypto work
+        :param callback: called with the result of the job
+        :param errback: called with the exception raised by the job, if any
+        """
+        self._queues[hash(key) % len(self._queues)].put((job, callback, errback))
+
+    def shutdown(self, timeout=5):
+        """
+        Stop all workers after the jobs that have been submitted so far.
+        """
+        for queue in self._queues:
+            queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def _run(self, queue):
+        while True:
+            jobs = [queue.get()]
+            try:
+                while len(jobs) < WORKER_BATCH_SIZE:
+                    jobs.append(queue.get_nowait())
+            except Empty:
+                pass
+
+            stop = None in jobs
+            results = []
+            for job in jobs:
+                if job is None:
+                    break
+
+                func, callback, errback = job
+                try:
+                    results.append((callback, func()))
+                except Exception as e:
+                    if errback:
+                        results.append((errback, e))
+                    else:
+                        self._logger.exception("Crypto job failed")
+
+            if results:
+                self._call_in_thread(self._deliver, results)
+            if stop:
+                return
+
+    def _deliver(self, results):
+        for callback, result in results:
+            try:
+                callback(result)
+            except Exception:
+                self._logger.exception("Crypto job callback failed")
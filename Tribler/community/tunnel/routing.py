@@ -1,7 +1,9 @@
 import time
+from collections import deque
 
 from Tribler.community.tunnel import CIRCUIT_STATE_READY, CIRCUIT_STATE_BROKEN, CIRCUIT_STATE_EXTENDING, \
-    CIRCUIT_TYPE_DATA
+    CIRCUIT_TYPE_DATA, CIRCUIT_SEND_WINDOW, CIRCUIT_MIN_SEND_WINDOW, CIRCUIT_MAX_SEND_WINDOW, \
+    CIRCUIT_CONGESTION_RTT_FACTOR, CIRCUIT_MAX_QUEUE_SIZE, CIRCUIT_DEFAULT_RTT
 from Tribler.dispersy.crypto import LibNaCLPK
 from Tribler.dispersy.candidate import Candidate
 import logging
@@ -9,6 +11,30 @@ import logging
 __author__ = 'chris'
 
 
+class TrafficCounter(object):
+
+    """
+    Byte counters of a circuit, relay or exit socket. The packet path only adds to bytes_up and
+    bytes_down, the statistics are updated periodically with the bytes that have not been collected yet.
+    """
+
+    __slots__ = ('bytes_up', 'bytes_down', 'collected_up', 'collected_down')
+
+    def __init__(self):
+        self.bytes_up = self.bytes_down = 0
+        self.collected_up = self.collected_down = 0
+
+    def collect(self):
+        """
+        Return the number of bytes sent and received since the previous call
+        @rtype: (int, int)
+        """
+        bytes_up, bytes_down = self.bytes_up, self.bytes_down
+        delta = bytes_up - self.collected_up, bytes_down - self.collected_down
+        self.collected_up, self.collected_down = bytes_up, bytes_down
+        return delta
+
+
 class Circuit(object):
 
     """ Circuit data structure storing the id, state and hops """
@@ -40,7 +66,18 @@ class Circuit(object):
         self.creation_time = time.time()
         self.last_incoming = time.time()
         self.unverified_hop = None
-        self.bytes_up = self.bytes_down = 0
+        self.traffic = TrafficCounter()
+
+        # flow control, see queue_data
+        self.rtt = None
+        self.min_rtt = None
+        self.congested = False
+        self.send_window = CIRCUIT_SEND_WINDOW
+        self.max_send_window = CIRCUIT_MAX_SEND_WINDOW
+        self.send_queue = deque()
+        self.send_tokens = CIRCUIT_SEND_WINDOW
+        self.last_refill = time.time()
+        self.dropped_packets = 0
 
         self.proxy = proxy
         self.ctype = ctype
@@ -52,6 +89,14 @@ class Circuit(object):
 
         self._logger = logging.getLogger(self.__class__.__name__)
 
+    @property
+    def bytes_up(self):
+        return self.traffic.bytes_up
+
+    @property
+    def bytes_down(self):
+        return self.traffic.bytes_down
+
     @property
     def hops(self):
         """
@@ -100,11 +145,86 @@ class Circuit(object):
         self._logger.info("Tunnel data (len %d) to end for circuit %s with ultimate destination %s", len(payload),
                            self.circuit_id, destination)
 
-        num_bytes = self.proxy.send_data([Candidate(self.first_hop, False)], self.circuit_id, destination, ('0.0.0.0', 0), payload)
-        self.proxy.increase_bytes_sent(self.circuit_id, num_bytes)
-
+        num_bytes = self.proxy.send_data([Candidate(self.first_hop, False)], self.circuit_id, destination,
+                                         ('0.0.0.0', 0), payload, sent_by=self)
         return num_bytes > 0
 
+    def update_rtt(self, sample):
+        """
+        Update the smoothed round-trip time of this circuit, in the same way as TCP does (RFC 6298). A sample that is
+        well above the lowest round-trip time means that packets are queueing up along the circuit, so the send window
+        is halved.
+        @param float sample: the measured round-trip time in seconds
+        """
+        self.rtt = sample if self.rtt is None else 0.875 * self.rtt + 0.125 * sample
+        self.min_rtt = sample if self.min_rtt is None else min(self.min_rtt, sample)
+
+        self.congested = sample > CIRCUIT_CONGESTION_RTT_FACTOR * self.min_rtt
+        if self.congested:
+            self.send_window = max(CIRCUIT_MIN_SEND_WINDOW, self.send_window / 2)
+            self.send_tokens = min(self.send_tokens, self.send_window)
+
+    @property
+    def send_rate(self):
+        """
+        The number of packets per second this circuit may send
+        @rtype: float
+        """
+        return self.send_window / (self.rtt or CIRCUIT_DEFAULT_RTT)
+
+    @property
+    def load(self):
+        """
+        The expected number of seconds before a newly queued packet is sent
+        @rtype: float
+        """
+        return (len(self.send_queue) + 1) / self.send_rate
+
+    def _refill_send_window(self):
+        now = time.time()
+        self.send_tokens = min(self.send_window, self.send_tokens + (now - self.last_refill) * self.send_rate)
+        self.last_refill = now
+
+    def queue_data(self, destination, payload):
+        """
+        Tunnel data over this circuit if the send window allows it, otherwise queue it until flush_queue is called.
+        While the circuit is not congested, every packet that has to wait grows the send window by one packet, so it
+        doubles every round-trip time (like TCP slow start) until it fits the data.
+        @param (str, int) destination: the destination of the packet
+        @param str payload: the packet's payload
+        @return bool: False if the queue is full and the packet has been dropped
+        """
+        self._refill_send_window()
+        if not self.send_queue and self.send_tokens >= 1:
+            self.send_tokens -= 1
+            self.tunnel_data(destination, payload)
+            return True
+
+        if not self.congested:
+            self.send_window = min(self.max_send_window, self.send_window + 1)
+
+        if len(self.send_queue) >= CIRCUIT_MAX_QUEUE_SIZE:
+            self.dropped_packets += 1
+            return False
+
+        self.send_queue.append((destination, payload))
+        return True
+
+    def flush_queue(self):
+        """
+        Tunnel the queued data as far as the send window allows
+        """
+        self._refill_send_window()
+        packets = []
+        while self.send_queue and self.send_tokens >= 1:
+            self.send_tokens -= 1
+            destination, payload = self.send_queue.popleft()
+            packets.append((destination, ('0.0.0.0', 0), payload))
+
+        if packets:
+            # the encryption layers are added to all packets at once
+            self.proxy.send_data_batch([Candidate(self.first_hop, False)], self.circuit_id, packets, sent_by=self)
+
     def destroy(self, reason='unknown'):
         """
         Destroys the circuit and calls the error callback of the circuit's
@@ -113,6 +233,7 @@ class Circuit(object):
         @param str reason: the reason why the circuit is being destroyed
         """
         self._broken = True
+        self.send_queue.clear()
 
 
 class Hop(object):
@@ -192,9 +313,28 @@ class RelayRoute(object):
         self.circuit_id = circuit_id
         self.creation_time = time.time()
         self.last_incoming = time.time()
-        self.bytes_up = self.bytes_down = 0
+        self.traffic = TrafficCounter()
         self.rendezvous_relay = rendezvous_relay
         self.mid = 0
+        self._candidate = None
+
+    @property
+    def bytes_up(self):
+        return self.traffic.bytes_up
+
+    @property
+    def bytes_down(self):
+        return self.traffic.bytes_down
+
+    @property
+    def candidate(self):
+        """
+        The candidate of the socket address, which is created once and reused for every relayed packet
+        @rtype: Candidate
+        """
+        if self._candidate is None:
+            self._candidate = Candidate(self.sock_addr, False)
+        return self._candidate
 
 class RendezvousPoint(object):
 
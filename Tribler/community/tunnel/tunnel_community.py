@@ -3,7 +3,8 @@
 import random
 import socket
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from functools import partial
 from cryptography.exceptions import InvalidTag
 
 from twisted.internet import reactor
@@ -12,18 +13,22 @@ from twisted.internet.task import LoopingCall
 
 from Tribler import dispersy
 from Tribler.Core.Utilities.encoding import decode, encode
+from Tribler.Core.simpledefs import DLSTATUS_STOPPED, DLSTATUS_STOPPED_ON_ERROR
 from Tribler.community.bartercast4.statistics import BartercastStatisticTypes, _barter_statistics
 from Tribler.community.tunnel import (CIRCUIT_ID_PORT, CIRCUIT_STATE_EXTENDING, CIRCUIT_STATE_READY, CIRCUIT_TYPE_DATA,
                                       CIRCUIT_TYPE_RENDEZVOUS, CIRCUIT_TYPE_RP, EXIT_NODE, EXIT_NODE_SALT, ORIGINATOR,
-                                      ORIGINATOR_SALT, PING_INTERVAL)
+                                      ORIGINATOR_SALT, PING_INTERVAL, TRAFFIC_AGGREGATE_INTERVAL,
+                                      CIRCUIT_FLUSH_INTERVAL, CIRCUIT_DEFAULT_RTT, CIRCUIT_SEND_WINDOW,
+                                      CIRCUIT_MAX_SEND_WINDOW)
 from Tribler.community.tunnel.Socks5.server import Socks5Server
 from Tribler.community.tunnel.conversion import TunnelConversion
 from Tribler.community.tunnel.crypto.tunnelcrypto import CryptoException, TunnelCrypto
+from Tribler.community.tunnel.crypto.workerpool import CryptoWorkerPool
 from Tribler.community.tunnel.payload import (CellPayload, CreatePayload, CreatedPayload, DestroyPayload, ExtendPayload,
                                               ExtendedPayload, PingPayload, PongPayload, StatsRequestPayload,
                                               StatsResponsePayload, TunnelIntroductionRequestPayload,
                                               TunnelIntroductionResponsePayload)
-from Tribler.community.tunnel.routing import Circuit, Hop, RelayRoute
+from Tribler.community.tunnel.routing import Circuit, Hop, RelayRoute, TrafficCounter
 from Tribler.dispersy.authentication import MemberAuthentication, NoAuthentication
 from Tribler.dispersy.candidate import Candidate
 from Tribler.dispersy.community import Community
@@ -86,6 +91,7 @@ class PingRequestCache(RandomNumberCache):
         self.tunnel_logger = logging.getLogger('TunnelLogger')
         self.circuit = circuit
         self.community = community
+        self.send_time = time.time()
 
     @property
     def timeout_delay(self):
@@ -119,10 +125,18 @@ class TunnelExitSocket(DatagramProtocol):
         self.circuit_id = circuit_id
         self.community = community
         self.ips = defaultdict(int)
-        self.bytes_up = self.bytes_down = 0
+        self.traffic = TrafficCounter()
         self.creation_time = time.time()
         self.mid = mid
 
+    @property
+    def bytes_up(self):
+        return self.traffic.bytes_up
+
+    @property
+    def bytes_down(self):
+        return self.traffic.bytes_down
+
     def enable(self):
         if not self.enabled:
             self.port = reactor.listenUDP(0, self)
@@ -214,6 +228,19 @@ class TunnelSettings(object):
         self.max_packets_without_reply = 50
         self.dht_lookup_interval = 30
 
+        # circuits of a hop count stay built this long after the last download that used them stopped
+        self.circuit_demand_time = 10 * 60
+        # circuits that are about to expire are replaced this many seconds in advance
+        self.circuit_renew_time = 60
+
+        # the number of threads that relay and exit data packets are encrypted and decrypted on, 0 to use the
+        # reactor thread
+        self.crypto_workers = 0
+
+        # the initial and the maximum number of packets that our own circuits may send per round-trip time
+        self.circuit_send_window = CIRCUIT_SEND_WINDOW
+        self.circuit_max_send_window = CIRCUIT_MAX_SEND_WINDOW
+
         if tribler_session:
             self.become_exitnode = tribler_session.get_tunnel_community_exitnode_enabled()
         else:
@@ -245,14 +272,16 @@ class RoundRobin(object):
                circuit.ctype == CIRCUIT_TYPE_RENDEZVOUS:
                 return circuit
 
-        circuit_ids = sorted(self.community.active_data_circuits(hops).keys())
+        circuits = self.community.active_data_circuits(hops)
+        circuit_ids = sorted(circuits.keys())
 
         if not circuit_ids:
             return None
 
+        # pick the least loaded circuit, starting at the round robin position so circuits with the same load take turns
         self.index = (self.index + 1) % len(circuit_ids)
-        circuit_id = circuit_ids[self.index]
-        return self.community.active_data_circuits()[circuit_id]
+        return min((circuits[circuit_id] for circuit_id in circuit_ids[self.index:] + circuit_ids[:self.index]),
+                   key=lambda circuit: circuit.load)
 
 
 class TunnelCommunity(Community):
@@ -268,6 +297,7 @@ class TunnelCommunity(Community):
         self.relay_session_keys = {}
         self.exit_sockets = {}
         self.circuits_needed = defaultdict(int)
+        self.circuit_demand = {}
         self.exit_candidates = {}
         self.notifier = None
         self.selection_strategy = RoundRobin(self)
@@ -277,6 +307,12 @@ class TunnelCommunity(Community):
                              '43e8807e6f86ef2f0a784fbc8fa21f8bc49a82ae'.decode('hex'),
                              'e79efd8853cef1640b93c149d7b0f067f6ccf221'.decode('hex')]
         self.bittorrent_peers = {}
+        self.crypto_pool = None
+
+        # data packets are received and sent in batches, once per reactor iteration
+        self.ingress_queue = []
+        self.egress_queue = OrderedDict()
+        self._process_ingress_call = self._flush_egress_call = None
 
         self.trsession = self.settings = self.socks_server = None
 
@@ -292,10 +328,17 @@ class TunnelCommunity(Community):
 
         self.crypto.initialize(self)
 
+        if self.settings.crypto_workers > 0:
+            self.crypto_pool = CryptoWorkerPool(self.settings.crypto_workers)
+
         self.dispersy.endpoint.listen_to(self.data_prefix, self.on_data)
 
         self.register_task("do_circuits", LoopingCall(self.do_circuits)).start(5, now=True)
         self.register_task("do_ping", LoopingCall(self.do_ping)).start(PING_INTERVAL)
+        self.register_task("aggregate_traffic",
+                           LoopingCall(self.aggregate_traffic)).start(TRAFFIC_AGGREGATE_INTERVAL)
+        self.register_task("flush_circuit_queues",
+                           LoopingCall(self.flush_circuit_queues)).start(CIRCUIT_FLUSH_INTERVAL)
 
         self.socks_server = Socks5Server(self, tribler_session.get_tunnel_community_socks5_listen_ports()
                                          if tribler_session else self.settings.socks_listen_ports)
@@ -386,6 +429,15 @@ class TunnelCommunity(Community):
         for circuit_id in self.exit_sockets.keys():
             self.remove_exit_socket(circuit_id, 'unload', destroy=True)
 
+        if self.crypto_pool:
+            self.crypto_pool.shutdown()
+            self.crypto_pool = None
+
+        for call in (self._process_ingress_call, self._flush_egress_call):
+            if call and call.active():
+                call.cancel()
+        self._process_ingress_call = self._flush_egress_call = None
+
         super(TunnelCommunity, self).unload_community()
 
     @property
@@ -397,6 +449,12 @@ class TunnelCommunity(Community):
         keys[direction + 4] += 1
         return keys[direction], keys[direction + 2], keys[direction + 4]
 
+    def get_session_keys_batch(self, keys, direction, count):
+        # reserve count salt_explicits
+        first_salt_explicit = keys[direction + 4] + 1
+        keys[direction + 4] += count
+        return keys[direction], keys[direction + 2], range(first_salt_explicit, first_salt_explicit + count)
+
     @property
     def dispersy_enable_bloom_filter_sync(self):
         return False
@@ -416,8 +474,12 @@ class TunnelCommunity(Community):
 
     @call_on_reactor_thread
     def do_circuits(self):
+        self.update_circuit_pool()
+
         for circuit_length, num_circuits in self.circuits_needed.items():
-            num_to_build = num_circuits - len(self.data_circuits(circuit_length))
+            # circuits that are about to expire are not counted, so their replacements are ready in time
+            num_to_build = num_circuits - len([circuit for circuit in self.data_circuits(circuit_length).itervalues()
+                                               if not self.is_circuit_expiring(circuit)])
             self.tunnel_logger.info("want %d data circuits of length %d", num_to_build, circuit_length)
             for _ in range(num_to_build):
                 if not self.create_circuit(circuit_length):
@@ -436,9 +498,61 @@ class TunnelCommunity(Community):
 
     def build_tunnels(self, hops):
         if hops > 0:
+            self.circuit_demand[hops] = time.time()
             self.circuits_needed[hops] = max(1, self.settings.max_circuits, self.circuits_needed[hops])
             self.do_circuits()
 
+    def get_active_downloads_per_hops(self):
+        """
+        :return: A dictionary with the number of anonymous downloads that are not stopped per hop count.
+        """
+        downloads_per_hops = defaultdict(int)
+        if self.trsession:
+            for download in self.trsession.lm.downloads.values():
+                hops = download.get_hops()
+                if hops > 0 and download.get_status() not in (DLSTATUS_STOPPED, DLSTATUS_STOPPED_ON_ERROR):
+                    downloads_per_hops[hops] += 1
+        return downloads_per_hops
+
+    def update_circuit_pool(self):
+        """
+        Sets the number of circuits that are kept ready per hop count. While there are downloads using a hop count,
+        max_circuits circuits are kept. Once the last one stopped, min_circuits circuits are kept warm for
+        circuit_demand_time seconds, so a new download can start right away. After that the circuits are not rebuilt.
+        Ready circuits exceeding these numbers are removed, the lowest scoring ones first.
+        """
+        now = time.time()
+        hops_in_demand = set(self.get_active_downloads_per_hops())
+        for hops in hops_in_demand:
+            self.circuit_demand[hops] = now
+
+        for hops, last_demand in self.circuit_demand.items():
+            if hops in hops_in_demand:
+                self.circuits_needed[hops] = max(1, self.settings.max_circuits)
+            elif last_demand > now - self.settings.circuit_demand_time:
+                self.circuits_needed[hops] = min(self.circuits_needed[hops], self.settings.min_circuits)
+            else:
+                self.tunnel_logger.info("No demand for circuits of length %d anymore", hops)
+                del self.circuit_demand[hops]
+                self.circuits_needed[hops] = 0
+
+        for hops, num_circuits in self.circuits_needed.items():
+            ready = sorted(self.active_data_circuits(hops).itervalues(), key=self.get_circuit_score)
+            for circuit in ready[:max(0, len(ready) - num_circuits)]:
+                self.remove_circuit(circuit.circuit_id, 'surplus', destroy=True)
+
+    def is_circuit_expiring(self, circuit):
+        return circuit.creation_time < time.time() - self.settings.max_time + self.settings.circuit_renew_time
+
+    def get_circuit_score(self, circuit):
+        """
+        Scores a circuit on the part of its lifetime (in time and traffic) that is left and its round-trip time.
+        :return: A score between 0 (e.g. about to expire) and 1 (new and fast).
+        """
+        age = (time.time() - circuit.creation_time) / self.settings.max_time
+        traffic = (circuit.bytes_up + circuit.bytes_down) / float(self.settings.max_traffic)
+        return max(0.0, 1.0 - max(age, traffic)) / (1.0 + (circuit.rtt or CIRCUIT_DEFAULT_RTT))
+
     def do_remove(self):
         # Remove circuits that are inactive / are too old / have transferred too many bytes.
         for key, circuit in self.circuits.items():
@@ -524,6 +638,8 @@ class TunnelCommunity(Community):
         circuit_id = self._generate_circuit_id(first_hop.sock_addr)
         circuit = Circuit(circuit_id, goal_hops, first_hop.sock_addr, self, ctype, callback,
                           required_endpoint, first_hop.get_member().mid.encode('hex'), info_hash)
+        circuit.send_window = circuit.send_tokens = self.settings.circuit_send_window
+        circuit.max_send_window = self.settings.circuit_max_send_window
 
         self.request_cache.add(CircuitRequestCache(self, circuit))
 
@@ -566,6 +682,7 @@ class TunnelCommunity(Community):
                 self.destroy_circuit(circuit_id)
 
             circuit = self.circuits.pop(circuit_id)
+            self.aggregate_circuit_traffic(circuit)
             if self.notifier:
                 peer = (circuit.first_hop[0], circuit.first_hop[1])
                 candidate = self.get_candidate(peer)
@@ -616,6 +733,7 @@ class TunnelCommunity(Community):
                 self.tunnel_logger.warning("Removing relay %d %s", cid, additional_info)
                 # Remove the relay
                 relay = self.relay_from_to.pop(cid)
+                self.aggregate_relay_traffic(relay)
                 if self.notifier:
                     peer = (relay.sock_addr[0], relay.sock_addr[1])
                     candidate = self.get_candidate(peer)
@@ -640,6 +758,7 @@ class TunnelCommunity(Community):
 
             # Close socket
             exit_socket = self.exit_sockets.pop(circuit_id)
+            self.aggregate_exit_socket_traffic(exit_socket)
             if self.notifier:
                 peer = (exit_socket.sock_addr[0], exit_socket.sock_addr[1])
                 candidate = self.get_candidate(peer)
@@ -707,6 +826,10 @@ class TunnelCommunity(Community):
     def is_exit(self, circuit_id):
         return circuit_id > 0 and circuit_id in self.exit_sockets
 
+    def is_exit_only(self, circuit_id):
+        # crypto_in/crypto_out give precedence to our own circuits
+        return self.is_exit(circuit_id) and circuit_id not in self.circuits
+
     def send_cell(self, candidates, message_type, payload):
         meta = self.get_meta_message(message_type)
         message = meta.impl(distribution=(self.global_time,), payload=payload)
@@ -714,16 +837,42 @@ class TunnelCommunity(Community):
 
         return self.send_message(candidates, message_type, packet, message.payload.circuit_id)
 
-    def send_data(self, candidates, circuit_id, dest_address, source_address, data):
+    def send_data(self, candidates, circuit_id, dest_address, source_address, data, sent_by=None):
         packet = TunnelConversion.encode_data(circuit_id, dest_address, source_address, data)
-        return self.send_message(candidates, u"data", packet, circuit_id)
+        return self.send_message(candidates, u"data", packet, circuit_id, sent_by)
+
+    def send_data_batch(self, candidates, circuit_id, packets, sent_by=None):
+        """
+        Sends a list of (dest_address, source_address, data) tuples over our circuit circuit_id, adding the encryption
+        layers to all packets at once.
+        :return: the number of bytes that have been queued
+        """
+        encrypted_pos = TunnelConversion.get_encrypted_pos(u"data")
+        packets = [TunnelConversion.encode_data(circuit_id, dest_address, source_address, data)
+                   for dest_address, source_address, data in packets]
+        try:
+            contents = self.crypto_out_batch(circuit_id, [packet[encrypted_pos:] for packet in packets], is_data=True)
+        except CryptoException, e:
+            self.tunnel_logger.error(str(e))
+            return 0
+
+        return sum(self.send_packet(candidates, u"data", packet[:encrypted_pos] + content, sent_by)
+                   for packet, content in zip(packets, contents))
 
-    def send_message(self, candidates, message_type, packet, circuit_id):
+    def send_message(self, candidates, message_type, packet, circuit_id, sent_by=None):
         is_data = message_type == u"data"
 
         if message_type not in [u'create', u'created']:
             plaintext, encrypted = TunnelConversion.split_encrypted_packet(packet, message_type)
             try:
+                if is_data and self.crypto_pool and self.is_exit_only(circuit_id):
+                    # the packet is sent once a crypto worker has encrypted it
+                    crypt, keys = self.get_relay_crypto(circuit_id, ORIGINATOR)
+                    self.crypto_pool.submit(circuit_id, partial(crypt, encrypted, *keys, prefix=plaintext),
+                                            partial(self.send_packet, candidates, message_type, sent_by=sent_by),
+                                            partial(self.on_exit_crypto_error, circuit_id))
+                    return len(packet)
+
                 encrypted = self.crypto_out(circuit_id, encrypted, is_data=is_data)
                 packet = plaintext + encrypted
 
@@ -731,15 +880,43 @@ class TunnelCommunity(Community):
                 self.tunnel_logger.error(str(e))
                 return 0
 
-        return self.send_packet(candidates, message_type, packet)
+        return self.send_packet(candidates, message_type, packet, sent_by)
+
+    def send_packet(self, candidates, message_type, packet, sent_by=None):
+        """
+        Sends packet to candidates. Data packets are queued per destination and sent in bulk at the end of this reactor
+        iteration, see flush_egress.
+        :param sent_by: the circuit, relay or exit socket whose sent bytes are increased once the packet has been sent
+        :return: the number of bytes that have been sent, or queued in case of a data packet
+        """
+        if message_type == u"data":
+            for candidate in candidates:
+                self.egress_queue.setdefault(candidate.sock_addr, (candidate, []))[1].append((packet, sent_by))
+            if not self._flush_egress_call:
+                self._flush_egress_call = reactor.callLater(0, self.flush_egress)
+            return len(packet)
 
-    def send_packet(self, candidates, message_type, packet):
-        if self.dispersy.endpoint.send(candidates, [packet], prefix=self.data_prefix if message_type == u"data" else None):
+        if self.dispersy.endpoint.send(candidates, [packet], prefix=None):
             self.statistics.increase_msg_count(u"outgoing", message_type, len(candidates))
             self.tunnel_logger.debug("send %s to %s candidates: %s", message_type, len(candidates), map(str, candidates))
+            if sent_by is not None:
+                self.increase_bytes_sent(sent_by, len(packet))
             return len(packet)
         return 0
 
+    def flush_egress(self):
+        self._flush_egress_call = None
+        egress_queue, self.egress_queue = self.egress_queue, OrderedDict()
+
+        for candidate, packets in egress_queue.itervalues():
+            if self.dispersy.endpoint.send([candidate], [packet for packet, _ in packets], prefix=self.data_prefix):
+                self.statistics.increase_msg_count(u"outgoing", u"data", len(packets))
+                self.tunnel_logger.debug("send %d data packets to %s", len(packets), candidate)
+                # the bytes are only counted once they have actually been sent
+                for packet, sent_by in packets:
+                    if sent_by is not None:
+                        self.increase_bytes_sent(sent_by, len(packet))
+
     def send_destroy(self, candidate, circuit_id, reason):
         meta = self.get_meta_message(u"destroy")
         destroy = meta.impl(authentication=(self._my_member,), distribution=(
@@ -750,31 +927,69 @@ class TunnelCommunity(Community):
         return self.relay_packet(circuit_id, message_type, message.packet)
 
     def relay_packet(self, circuit_id, message_type, packet):
+        return self.relay_packets(circuit_id, message_type, [packet])
+
+    def relay_packets(self, circuit_id, message_type, packets):
+        """
+        Relays packets received for the same circuit, looking up the route only once.
+        :return: False if any of the packets could not be relayed.
+        """
         next_relay = self.relay_from_to[circuit_id]
         this_relay = self.relay_from_to.get(next_relay.circuit_id, None)
 
-        self.tunnel_logger.debug("Relay %s from %d to %d", message_type, circuit_id, next_relay.circuit_id)
+        self.tunnel_logger.debug("Relay %d %s from %d to %d", len(packets), message_type, circuit_id,
+                                 next_relay.circuit_id)
 
         if this_relay:
             this_relay.last_incoming = time.time()
-            self.increase_bytes_received(this_relay, len(packet))
+            self.increase_bytes_received(this_relay, sum(len(packet) for packet in packets))
 
-        plaintext, encrypted = TunnelConversion.split_encrypted_packet(packet, message_type)
-        try:
-            if next_relay.rendezvous_relay:
-                decrypted = self.crypto_in(circuit_id, encrypted)
-                encrypted = self.crypto_out(next_relay.circuit_id, decrypted)
+        encrypted_pos = TunnelConversion.get_encrypted_pos(message_type)
+        if len(packets) > 1 and not next_relay.rendezvous_relay and not self.crypto_pool:
+            # the encryption layer of this relay is added to, or removed from, all packets with one cipher lookup
+            try:
+                contents = self.crypto_relay_batch(circuit_id, [packet[encrypted_pos:] for packet in packets])
+            except CryptoException:
+                # at least one of the packets is corrupt, relay them one by one so the others still get through
+                pass
             else:
-                encrypted = self.crypto_relay(circuit_id, encrypted)
-            packet = plaintext + encrypted
+                for packet, content in zip(packets, contents):
+                    header = TunnelConversion.swap_circuit_id(packet[:encrypted_pos], message_type, circuit_id,
+                                                              next_relay.circuit_id)
+                    self.send_relayed_packet(next_relay, message_type, header + content)
+                return True
+
+        success = True
+        for packet in packets:
+            # the circuit id is swapped in the (small) plaintext header only
+            header = TunnelConversion.swap_circuit_id(packet[:encrypted_pos], message_type, circuit_id,
+                                                      next_relay.circuit_id)
+            try:
+                if next_relay.rendezvous_relay:
+                    decrypted = self.crypto_in(circuit_id, packet[encrypted_pos:])
+                    packet = header + self.crypto_out(next_relay.circuit_id, decrypted)
+                elif self.crypto_pool:
+                    crypt, keys = self.get_relay_crypto(circuit_id, self.directions[circuit_id])
+                    self.crypto_pool.submit(circuit_id,
+                                            partial(crypt, packet, *keys, offset=encrypted_pos, prefix=header),
+                                            partial(self.send_relayed_packet, next_relay, message_type),
+                                            partial(self.on_relay_crypto_error, circuit_id, packet))
+                    continue
+                else:
+                    # fast path: the ciphertext is read from the packet at encrypted_pos and the new header is joined
+                    # with the result of the crypto operation, instead of swapping the circuit id in the full packet
+                    packet = self.crypto_relay(circuit_id, packet, encrypted_pos, header)
 
-        except CryptoException, e:
-            self.tunnel_logger.error(str(e))
-            return False
+            except CryptoException, e:
+                self.tunnel_logger.error(str(e))
+                success = False
+                continue
 
-        packet = TunnelConversion.swap_circuit_id(packet, message_type, circuit_id, next_relay.circuit_id)
-        self.increase_bytes_sent(next_relay, self.send_packet([Candidate(next_relay.sock_addr, False)], message_type, packet))
-        return True
+            self.send_relayed_packet(next_relay, message_type, packet)
+        return success
+
+    def send_relayed_packet(self, next_relay, message_type, packet):
+        self.send_packet([next_relay.candidate], message_type, packet, sent_by=next_relay)
 
     def check_create(self, messages):
         for message in messages:
@@ -1107,11 +1322,10 @@ class TunnelCommunity(Community):
                                                       extend_candidate.sock_addr, extend_candidate_mid))
 
 
-            self.increase_bytes_sent(to_circuit_id, self.send_cell([extend_candidate],
-                                                                    u"create", (to_circuit_id,
-                                                                                message.payload.node_id,
-                                                                                message.payload.node_public_key,
-                                                                                message.payload.key)))
+            self.send_cell([extend_candidate], u"create", (to_circuit_id,
+                                                           message.payload.node_id,
+                                                           message.payload.node_public_key,
+                                                           message.payload.key))
 
     def on_extended(self, messages):
         for message in messages:
@@ -1121,51 +1335,107 @@ class TunnelCommunity(Community):
 
     @call_on_reactor_thread
     def on_data(self, sock_addr, packet):
-        # If its our circuit, the messenger is the candidate assigned to that circuit and the DATA's destination
-        # is set to the zero-address then the packet is from the outside world and addressed to us from.
-
+        # data packets are handled in a batch once per reactor iteration
+        self.ingress_queue.append((sock_addr, packet))
+        if not self._process_ingress_call:
+            self._process_ingress_call = reactor.callLater(0, self.process_ingress)
+
+    def process_ingress(self):
+        self._process_ingress_call = None
+        ingress_queue, self.ingress_queue = self.ingress_queue, []
+        self.on_data_batch(ingress_queue)
+
+    def on_data_batch(self, packets):
+        """
+        Handles a list of (sock_addr, packet) tuples. The packets that we relay are grouped per circuit.
+        """
         message_type = u'data'
-        circuit_id = TunnelConversion.get_circuit_id(packet, message_type)
+        relayed = OrderedDict()
+        received = OrderedDict()
 
-        self.tunnel_logger.debug("Got data (%d) from %s", circuit_id, sock_addr)
+        for sock_addr, packet in packets:
+            circuit_id = TunnelConversion.get_circuit_id(packet, message_type)
+            self.tunnel_logger.debug("Got data (%d) from %s", circuit_id, sock_addr)
 
-        if self.is_relay(circuit_id):
-            self.relay_packet(circuit_id, message_type, packet)
+            if self.is_relay(circuit_id):
+                relayed.setdefault(circuit_id, []).append(packet)
+            elif circuit_id in self.circuits:
+                received.setdefault(circuit_id, []).append((sock_addr, packet))
+            else:
+                self.on_data_packet(sock_addr, circuit_id, packet)
+
+        for circuit_id, circuit_packets in relayed.iteritems():
+            self.relay_packets(circuit_id, message_type, circuit_packets)
+        for circuit_id, circuit_packets in received.iteritems():
+            self.on_data_packets(circuit_id, circuit_packets)
+
+    def on_data_packets(self, circuit_id, packets):
+        """
+        Handles a list of (sock_addr, packet) tuples received for our circuit circuit_id, removing the encryption
+        layers from all packets at once.
+        """
+        if len(packets) > 1:
+            encrypted_pos = TunnelConversion.get_encrypted_pos(u'data')
+            try:
+                contents = self.crypto_in_batch(circuit_id, [packet[encrypted_pos:] for _, packet in packets],
+                                                is_data=True)
+            except CryptoException:
+                # at least one of the packets is corrupt, handle them one by one so the others still get through
+                pass
+            else:
+                for (sock_addr, packet), content in zip(packets, contents):
+                    self.on_decrypted_data(sock_addr, packet[:encrypted_pos] + content)
+                return
 
-        else:
-            plaintext, encrypted = TunnelConversion.split_encrypted_packet(packet, message_type)
+        for sock_addr, packet in packets:
+            self.on_data_packet(sock_addr, circuit_id, packet)
 
-            try:
-                encrypted = self.crypto_in(circuit_id, encrypted, is_data=True)
+    def on_data_packet(self, sock_addr, circuit_id, packet):
+        # If its our circuit, the messenger is the candidate assigned to that circuit and the DATA's destination
+        # is set to the zero-address then the packet is from the outside world and addressed to us from.
 
-            except CryptoException, e:
-                self.tunnel_logger.warning(str(e))
+        plaintext, encrypted = TunnelConversion.split_encrypted_packet(packet, u'data')
+
+        try:
+            if self.crypto_pool and self.is_exit_only(circuit_id):
+                crypt, keys = self.get_relay_crypto(circuit_id, EXIT_NODE)
+                self.crypto_pool.submit(circuit_id, partial(crypt, encrypted, *keys, prefix=plaintext),
+                                        partial(self.on_decrypted_data, sock_addr),
+                                        partial(self.on_relay_crypto_error, circuit_id, packet))
                 return
 
-            packet = plaintext + encrypted
-            circuit_id, destination, origin, data = TunnelConversion.decode_data(packet)
+            encrypted = self.crypto_in(circuit_id, encrypted, is_data=True)
 
-            circuit = self.circuits.get(circuit_id, None)
-            if circuit and origin and sock_addr == circuit.first_hop:
-                circuit.beat_heart()
-                self.increase_bytes_received(circuit, len(packet))
+        except CryptoException, e:
+            self.tunnel_logger.warning(str(e))
+            return
 
-                if TunnelConversion.could_be_dispersy(data):
-                    self.tunnel_logger.debug("Giving incoming data packet to dispersy")
-                    self.dispersy.on_incoming_packets([(Candidate(origin, False),
-                                                        data[TUNNEL_PREFIX_LENGHT:])],
-                                                      False, source=u"circuit_%d" % circuit_id)
-                else:
-                    anon_seed = circuit.ctype == CIRCUIT_TYPE_RP
-                    self.socks_server.on_incoming_from_tunnel(self, circuit, origin, data, anon_seed)
+        self.on_decrypted_data(sock_addr, plaintext + encrypted)
+
+    def on_decrypted_data(self, sock_addr, packet):
+        circuit_id, destination, origin, data = TunnelConversion.decode_data(packet)
 
-            # It is not our circuit so we got it from a relay, we need to EXIT it!
+        circuit = self.circuits.get(circuit_id, None)
+        if circuit and origin and sock_addr == circuit.first_hop:
+            circuit.beat_heart()
+            self.increase_bytes_received(circuit, len(packet))
+
+            if TunnelConversion.could_be_dispersy(data):
+                self.tunnel_logger.debug("Giving incoming data packet to dispersy")
+                self.dispersy.on_incoming_packets([(Candidate(origin, False),
+                                                    data[TUNNEL_PREFIX_LENGHT:])],
+                                                  False, source=u"circuit_%d" % circuit_id)
             else:
-                self.tunnel_logger.debug("data for circuit %d exiting tunnel (%s)", circuit_id, destination)
-                if destination != ('0.0.0.0', 0):
-                    self.exit_data(circuit_id, sock_addr, destination, data)
-                else:
-                    self.tunnel_logger.warning("cannot exit data, destination is 0.0.0.0:0")
+                anon_seed = circuit.ctype == CIRCUIT_TYPE_RP
+                self.socks_server.on_incoming_from_tunnel(self, circuit, origin, data, anon_seed)
+
+        # It is not our circuit so we got it from a relay, we need to EXIT it!
+        else:
+            self.tunnel_logger.debug("data for circuit %d exiting tunnel (%s)", circuit_id, destination)
+            if destination != ('0.0.0.0', 0):
+                self.exit_data(circuit_id, sock_addr, destination, data)
+            else:
+                self.tunnel_logger.warning("cannot exit data, destination is 0.0.0.0:0")
 
     def on_ping(self, messages):
         for message in messages:
@@ -1174,8 +1444,15 @@ class TunnelCommunity(Community):
 
     def on_pong(self, messages):
         for message in messages:
-            self.request_cache.pop(u"ping", message.payload.identifier)
-            self.tunnel_logger.info("Got pong from %s", message.candidate)
+            cache = self.request_cache.pop(u"ping", message.payload.identifier)
+            cache.circuit.update_rtt(time.time() - cache.send_time)
+            self.tunnel_logger.info("Got pong from %s, rtt of circuit %d is %.3f", message.candidate,
+                                    cache.circuit.circuit_id, cache.circuit.rtt)
+
+    def flush_circuit_queues(self):
+        for circuit in self.circuits.values():
+            if circuit.send_queue:
+                circuit.flush_queue()
 
     def do_ping(self):
         # Ping circuits. Pings are only sent to the first hop, subsequent hops will relay the ping.
@@ -1205,6 +1482,7 @@ class TunnelCommunity(Community):
     def on_stats_request(self, messages):
         for request in messages:
             if request.candidate.get_member().mid in self.crawler_mids:
+                self.aggregate_traffic()
                 meta = self.get_meta_message(u"stats-response")
                 stats = dict(self.stats)
                 stats['uptime'] = time.time() - self.creation_time
@@ -1250,23 +1528,37 @@ class TunnelCommunity(Community):
             self.tunnel_logger.error("Dropping data packets with unknown circuit_id")
 
     def crypto_out(self, circuit_id, content, is_data=False):
+        return self.crypto_out_batch(circuit_id, [content], is_data)[0]
+
+    def crypto_out_batch(self, circuit_id, contents, is_data=False):
+        """
+        Adds the encryption layers to a list of packets for the same circuit, using the cipher of every hop only once.
+        """
         circuit = self.circuits.get(circuit_id, None)
         if circuit:
             if circuit and is_data and circuit.ctype in [CIRCUIT_TYPE_RENDEZVOUS, CIRCUIT_TYPE_RP]:
                 direction = int(circuit.ctype == CIRCUIT_TYPE_RP)
-                content = self.crypto.encrypt_str(content, *self.get_session_keys(circuit.hs_session_keys, direction))
+                contents = self.crypto.encrypt_str_batch(
+                    contents, *self.get_session_keys_batch(circuit.hs_session_keys, direction, len(contents)))
 
             for hop in reversed(circuit.hops):
-                content = self.crypto.encrypt_str(content, *self.get_session_keys(hop.session_keys, EXIT_NODE))
-            return content
+                contents = self.crypto.encrypt_str_batch(
+                    contents, *self.get_session_keys_batch(hop.session_keys, EXIT_NODE, len(contents)))
+            return contents
 
         elif circuit_id in self.relay_session_keys:
-            return self.crypto.encrypt_str(content,
-                                           *self.get_session_keys(self.relay_session_keys[circuit_id], ORIGINATOR))
+            return self.crypto.encrypt_str_batch(
+                contents, *self.get_session_keys_batch(self.relay_session_keys[circuit_id], ORIGINATOR, len(contents)))
 
         raise CryptoException("Don't know how to encrypt outgoing message for circuit_id %d" % circuit_id)
 
     def crypto_in(self, circuit_id, content, is_data=False):
+        return self.crypto_in_batch(circuit_id, [content], is_data)[0]
+
+    def crypto_in_batch(self, circuit_id, contents, is_data=False):
+        """
+        Removes the encryption layers from a list of packets received for the same circuit.
+        """
         circuit = self.circuits.get(circuit_id, None)
         if circuit:
             if len(circuit.hops) > 0:
@@ -1275,104 +1567,149 @@ class TunnelCommunity(Community):
                 for hop in self.circuits[circuit_id].hops:
                     layer += 1
                     try:
-                        content = self.crypto.decrypt_str(content,
-                                                          hop.session_keys[ORIGINATOR],
-                                                          hop.session_keys[ORIGINATOR_SALT])
+                        contents = self.crypto.decrypt_str_batch(contents,
+                                                                 hop.session_keys[ORIGINATOR],
+                                                                 hop.session_keys[ORIGINATOR_SALT])
                     except InvalidTag as e:
                         raise CryptoException("Got exception %r when trying to remove encryption layer %s "
-                                              "for message: %r received for circuit_id: %s, is_data: %i, "
-                                              "circuit_hops: %r" % (e, layer, content, circuit_id, is_data, circuit.hops
-                                                                    ))
+                                              "for messages: %r received for circuit_id: %s, is_data: %i, "
+                                              "circuit_hops: %r" % (e, layer, contents, circuit_id, is_data,
+                                                                    circuit.hops))
 
                 if is_data and circuit.ctype in [CIRCUIT_TYPE_RENDEZVOUS, CIRCUIT_TYPE_RP]:
                     direction = int(circuit.ctype != CIRCUIT_TYPE_RP)
                     direction_salt = direction + 2
-                    content = self.crypto.decrypt_str(content,
-                                                      circuit.hs_session_keys[direction],
-                                                      circuit.hs_session_keys[direction_salt])
-                return content
+                    contents = self.crypto.decrypt_str_batch(contents,
+                                                             circuit.hs_session_keys[direction],
+                                                             circuit.hs_session_keys[direction_salt])
+                return contents
 
             else:
                 raise CryptoException("Error decrypting message for circuit %d, circuit is set to 0 hops.")
 
         elif circuit_id in self.relay_session_keys:
             try:
-                return self.crypto.decrypt_str(content,
-                                               self.relay_session_keys[circuit_id][EXIT_NODE],
-                                               self.relay_session_keys[circuit_id][EXIT_NODE_SALT])
+                return self.crypto.decrypt_str_batch(contents,
+                                                     self.relay_session_keys[circuit_id][EXIT_NODE],
+                                                     self.relay_session_keys[circuit_id][EXIT_NODE_SALT])
             except InvalidTag as e:
-                raise CryptoException("Got exception %r when trying to decrypt relay message: "
-                                      "%r received for circuit_id: %s, is_data: %i, "
-                                      "circuit_hops: %r" % (e, content, circuit_id, is_data, circuit.hops
-                                      ))
+                raise CryptoException("Got exception %r when trying to decrypt relay messages: "
+                                      "%r received for circuit_id: %s, is_data: %i" % (e, contents, circuit_id,
+                                                                                       is_data))
 
         raise CryptoException("Received message for unknown circuit ID: %d" % circuit_id)
 
-    def crypto_relay(self, circuit_id, content):
+    def get_relay_crypto(self, circuit_id, direction):
+        """
+        Returns the crypto function and the session keys with which this node adds (ORIGINATOR) or removes (EXIT_NODE)
+        its encryption layer for circuit_id. The keys are taken on the calling thread, so the function can be called
+        on a crypto worker.
+        """
+        if direction == ORIGINATOR:
+            return self.crypto.encrypt_str, self.get_session_keys(self.relay_session_keys[circuit_id], ORIGINATOR)
+        elif direction == EXIT_NODE:
+            return self.crypto.decrypt_str, (self.relay_session_keys[circuit_id][EXIT_NODE],
+                                             self.relay_session_keys[circuit_id][EXIT_NODE_SALT])
+
+        raise CryptoException("Direction must be either ORIGINATOR or EXIT_NODE")
+
+    def crypto_relay(self, circuit_id, content, offset=0, prefix=''):
+        """
+        Adds or removes the encryption layer of this relay to content[offset:], and prepends prefix to the result.
+        """
+        crypt, keys = self.get_relay_crypto(circuit_id, self.directions[circuit_id])
+        try:
+            return crypt(content, *keys, offset=offset, prefix=prefix)
+        except InvalidTag as e:
+            self.on_relay_crypto_error(circuit_id, content, e)
+            raise CryptoException("Could not decrypt message for circuit_id %d" % circuit_id)
+
+    def crypto_relay_batch(self, circuit_id, contents):
+        """
+        Adds or removes the encryption layer of this relay to a list of packets for circuit_id.
+        """
         direction = self.directions[circuit_id]
+        keys = self.relay_session_keys[circuit_id]
         if direction == ORIGINATOR:
-            return self.crypto.encrypt_str(content,
-                                           *self.get_session_keys(self.relay_session_keys[circuit_id], ORIGINATOR))
+            return self.crypto.encrypt_str_batch(contents, *self.get_session_keys_batch(keys, ORIGINATOR,
+                                                                                         len(contents)))
         elif direction == EXIT_NODE:
             try:
-                return self.crypto.decrypt_str(content,
-                                               self.relay_session_keys[circuit_id][EXIT_NODE],
-                                               self.relay_session_keys[circuit_id][EXIT_NODE_SALT])
+                return self.crypto.decrypt_str_batch(contents, keys[EXIT_NODE], keys[EXIT_NODE_SALT])
             except InvalidTag:
-                # Reasons that can cause this:
-                # - The introductionpoint circuit is extended with a candidate
-                # that is already part of the circuit, causing a crypto error.
-                # Should not happen anyway, thorough analysis of the debug log
-                # may reveal why and how this candidate is discovered.
-                #
-                # - The pubkey of the introduction point changed (e.g. due to a
-                # restart), while other peers in the network are still exchanging
-                # the old key information.
-                #- A hostile peer may have forged the key of a candidate while
-                # pexing information about candidates, thus polluting the network
-                # with wrong information. I doubt this is the case but it's
-                # possible. :)
-                # (from https://github.com/Tribler/tribler/issues/1932#issuecomment-182035383)
-
-                self._logger.warning("Could not decrypt message:\n"
-                                     "  direction %s\n"
-                                     "  circuit_id: %r\n"
-                                     "  content: : %r\n"
-                                     "  Possibly corrupt data?",
-                                     direction, circuit_id, content)
+                raise CryptoException("Could not decrypt messages for circuit_id %d" % circuit_id)
 
         raise CryptoException("Direction must be either ORIGINATOR or EXIT_NODE")
 
+    def on_exit_crypto_error(self, circuit_id, exception):
+        self.tunnel_logger.error("Could not encrypt data for circuit_id %d: %r", circuit_id, exception)
+
+    def on_relay_crypto_error(self, circuit_id, content, exception):
+        if not isinstance(exception, InvalidTag):
+            self.tunnel_logger.error("Crypto error for circuit_id %d: %r", circuit_id, exception)
+            return
+
+        # Reasons that can cause this:
+        # - The introductionpoint circuit is extended with a candidate
+        # that is already part of the circuit, causing a crypto error.
+        # Should not happen anyway, thorough analysis of the debug log
+        # may reveal why and how this candidate is discovered.
+        #
+        # - The pubkey of the introduction point changed (e.g. due to a
+        # restart), while other peers in the network are still exchanging
+        # the old key information.
+        #- A hostile peer may have forged the key of a candidate while
+        # pexing information about candidates, thus polluting the network
+        # with wrong information. I doubt this is the case but it's
+        # possible. :)
+        # (from https://github.com/Tribler/tribler/issues/1932#issuecomment-182035383)
+
+        self._logger.warning("Could not decrypt message:\n"
+                             "  direction %s\n"
+                             "  circuit_id: %r\n"
+                             "  content: : %r\n"
+                             "  Possibly corrupt data?",
+                             self.directions.get(circuit_id), circuit_id, content)
+
     def increase_bytes_sent(self, obj, num_bytes):
-        if isinstance(obj, Circuit):
-            obj.bytes_up += num_bytes
-            self.stats['bytes_up'] += num_bytes
-            _barter_statistics.dict_inc_bartercast(BartercastStatisticTypes.TUNNELS_BYTES_SENT, "%s:%s" %
-                                                   (obj.first_hop[0], obj.first_hop[1]), num_bytes)
-        elif isinstance(obj, RelayRoute):
-            obj.bytes_up += num_bytes
-            self.stats['bytes_relay_up'] += num_bytes
-            _barter_statistics.dict_inc_bartercast(BartercastStatisticTypes.TUNNELS_RELAY_BYTES_SENT, "%s:%s" %
-                                                   (obj.sock_addr[0], obj.sock_addr[1]), num_bytes)
-        elif isinstance(obj, TunnelExitSocket):
-            obj.bytes_up += num_bytes
-            self.stats['bytes_exit'] += num_bytes
-            _barter_statistics.dict_inc_bartercast(BartercastStatisticTypes.TUNNELS_EXIT_BYTES_SENT, "%s:%s" %
-                                                   (obj.sock_addr[0], obj.sock_addr[1]), num_bytes)
+        obj.traffic.bytes_up += num_bytes
 
     def increase_bytes_received(self, obj, num_bytes):
-        if isinstance(obj, Circuit):
-            obj.bytes_down += num_bytes
-            self.stats['bytes_down'] += num_bytes
-            _barter_statistics.dict_inc_bartercast(BartercastStatisticTypes.TUNNELS_BYTES_RECEIVED, "%s:%s" %
-                                                   (obj.first_hop[0], obj.first_hop[1]), num_bytes)
-        elif isinstance(obj, RelayRoute):
-            obj.bytes_down += num_bytes
-            self.stats['bytes_relay_down'] += num_bytes
-            _barter_statistics.dict_inc_bartercast(BartercastStatisticTypes.TUNNELS_RELAY_BYTES_RECEIVED, "%s:%s" %
-                                                   (obj.sock_addr[0], obj.sock_addr[1]), num_bytes)
-        elif isinstance(obj, TunnelExitSocket):
-            obj.bytes_down += num_bytes
-            self.stats['bytes_enter'] += num_bytes
-            _barter_statistics.dict_inc_bartercast(BartercastStatisticTypes.TUNNELS_EXIT_BYTES_RECEIVED, "%s:%s" %
-                                                   (obj.sock_addr[0], obj.sock_addr[1]), num_bytes)
+        obj.traffic.bytes_down += num_bytes
+
+    def aggregate_traffic(self):
+        """
+        Add the traffic of all circuits, relays and exit sockets since the previous aggregation to the
+        tunnel and bartercast statistics.
+        """
+        for circuit in self.circuits.itervalues():
+            self.aggregate_circuit_traffic(circuit)
+        for relay in self.relay_from_to.itervalues():
+            self.aggregate_relay_traffic(relay)
+        for exit_socket in self.exit_sockets.itervalues():
+            self.aggregate_exit_socket_traffic(exit_socket)
+
+    def aggregate_circuit_traffic(self, circuit):
+        self._aggregate_traffic(circuit.traffic, circuit.first_hop, 'bytes_up', 'bytes_down',
+                                BartercastStatisticTypes.TUNNELS_BYTES_SENT,
+                                BartercastStatisticTypes.TUNNELS_BYTES_RECEIVED)
+
+    def aggregate_relay_traffic(self, relay):
+        self._aggregate_traffic(relay.traffic, relay.sock_addr, 'bytes_relay_up', 'bytes_relay_down',
+                                BartercastStatisticTypes.TUNNELS_RELAY_BYTES_SENT,
+                                BartercastStatisticTypes.TUNNELS_RELAY_BYTES_RECEIVED)
+
+    def aggregate_exit_socket_traffic(self, exit_socket):
+        self._aggregate_traffic(exit_socket.traffic, exit_socket.sock_addr, 'bytes_exit', 'bytes_enter',
+                                BartercastStatisticTypes.TUNNELS_EXIT_BYTES_SENT,
+                                BartercastStatisticTypes.TUNNELS_EXIT_BYTES_RECEIVED)
+
+    def _aggregate_traffic(self, traffic, sock_addr, key_up, key_down, stats_type_up, stats_type_down):
+        bytes_up, bytes_down = traffic.collect()
+        if bytes_up:
+            self.stats[key_up] += bytes_up
+            _barter_statistics.dict_inc_bartercast(stats_type_up, "%s:%s" % (sock_addr[0], sock_addr[1]), bytes_up)
+        if bytes_down:
+            self.stats[key_down] += bytes_down
+            _barter_statistics.dict_inc_bartercast(stats_type_down, "%s:%s" % (sock_addr[0], sock_addr[1]),
+                                                   bytes_down)